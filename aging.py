@@ -0,0 +1,116 @@
+from dataclasses import dataclass
+from datetime import date as DateObject, datetime
+import time
+
+import numpy as np
+
+# Faixas de idade (em dias) da dívida em aberto
+FAIXAS_ENVELHECIMENTO = ("0-30", "31-90", "91-180", "180+")
+_INICIO_FAIXAS = np.array([31, 91, 181]) # Primeiro dia de cada faixa a partir da segunda
+
+
+@dataclass
+class RelatorioEnvelhecimento:
+    pessoa_ids: np.ndarray  # (n,) IDs das pessoas com saldo em aberto
+    por_pessoa: np.ndarray  # (n, 4) valor em aberto por faixa
+    total: np.ndarray       # (4,) soma de todas as pessoas
+
+
+def calcular_envelhecimento(
+    pessoas: np.ndarray, datas: np.ndarray, em_aberto: np.ndarray,
+    hoje: DateObject | None = None,
+) -> RelatorioEnvelhecimento:
+    """
+    Distribui o saldo em aberto de cada pessoa nas faixas de idade.
+    Recebe o valor em aberto de cada empréstimo não quitado, que as alocações
+    já calculam quitando primeiro os empréstimos mais antigos (FIFO por data e id).
+    """
+    hoje = np.datetime64(hoje or datetime.now().date(), "D")
+    if em_aberto.size == 0:
+        vazio = np.empty(0, dtype=np.int64)
+        return RelatorioEnvelhecimento(vazio, np.zeros((0, 4)), np.zeros(4))
+
+    # Índice compacto de cada pessoa (0..n-1), sem ordenar as linhas
+    pessoa_ids, idx_pessoa = np.unique(pessoas, return_inverse=True)
+
+    idade_dias = (hoje - datas).astype(np.int64)
+    faixa = np.digitize(idade_dias, _INICIO_FAIXAS)
+    por_pessoa = np.bincount(idx_pessoa * 4 + faixa, weights=em_aberto, minlength=pessoa_ids.size * 4)
+    por_pessoa = np.round(por_pessoa.reshape(-1, 4), 2)
+
+    # Mantém só quem ainda deve algo
+    com_saldo = por_pessoa.sum(axis=1) > 0
+    return RelatorioEnvelhecimento(pessoa_ids[com_saldo], por_pessoa[com_saldo], np.round(por_pessoa.sum(axis=0), 2))
+
+
+def _popular_banco(db_mod, n_transacoes: int, n_pessoas: int, hoje: DateObject, seed: int = 42) -> None:
+    """
+    Grava transações sintéticas direto pelo driver. A tabela de alocações fica
+    vazia, mas o valor_em_aberto de cada empréstimo é o do FIFO, como o bot manteria.
+    """
+    rng = np.random.default_rng(seed)
+    n_emp = int(n_transacoes * 0.7)
+    n_pag = n_transacoes - n_emp
+    emp_pessoas = rng.integers(1, n_pessoas + 1, n_emp)
+    emp_datas = np.datetime64(hoje, "D") - rng.integers(0, 720, n_emp)
+    emp_valores = np.round(rng.uniform(5, 500, n_emp), 2)
+    pag_pessoas = rng.integers(1, n_pessoas + 1, n_pag)
+    pag_valores = np.round(rng.uniform(5, 600, n_pag), 2)
+
+    # FIFO: em aberto = clip(acumulado até o empréstimo - total pago pela pessoa, 0, valor)
+    ordem = np.lexsort((emp_datas, emp_pessoas))
+    acumulado = np.cumsum(emp_valores[ordem])
+    inicio_grupo = np.flatnonzero(np.r_[True, np.diff(emp_pessoas[ordem]) != 0])
+    acumulado -= np.repeat((acumulado - emp_valores[ordem])[inicio_grupo], np.diff(np.r_[inicio_grupo, n_emp]))
+    pago = np.bincount(pag_pessoas, weights=pag_valores, minlength=n_pessoas + 1)
+    emp_em_aberto = np.empty(n_emp)
+    emp_em_aberto[ordem] = np.round(np.clip(acumulado - pago[emp_pessoas[ordem]], 0.0, emp_valores[ordem]), 2)
+
+    with db_mod.SessionLocal() as db:
+        conexao = db.connection()
+        conexao.exec_driver_sql("INSERT INTO pessoas (id, nome) VALUES (?, ?)",
+                                [(i, f"aging-{i}") for i in range(1, n_pessoas + 1)])
+        conexao.exec_driver_sql("INSERT INTO emprestimos (pessoa_id, data, valor, valor_em_aberto) VALUES (?, ?, ?, ?)",
+                                list(zip(emp_pessoas.tolist(), emp_datas.astype(str).tolist(), emp_valores.tolist(), emp_em_aberto.tolist())))
+        conexao.exec_driver_sql("INSERT INTO pagamentos (pessoa_id, data, valor, valor_nao_alocado) VALUES (?, ?, ?, ?)",
+                                [(pessoa_id, hoje.isoformat(), valor, 0.0)
+                                 for pessoa_id, valor in zip(pag_pessoas.tolist(), pag_valores.tolist())])
+        db.commit()
+
+
+# Benchmark (para teste local): python aging.py
+# Mede o caminho do /envelhecimento inteiro: leitura do banco (SQLite temporário) + cálculo.
+if __name__ == "__main__":
+    import os
+    import tempfile
+
+    N_TRANSACOES = 1_000_000
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='paytrack-aging-'), 'aging.db')}"
+    import database as db_mod # Cria o engine com a URL acima
+    db_mod.inicializar_banco()
+
+    hoje = datetime.now().date()
+    inicio = time.perf_counter()
+    _popular_banco(db_mod, N_TRANSACOES, n_pessoas=2_000, hoje=hoje)
+    print(f"Banco populado com {N_TRANSACOES:,} transações em {time.perf_counter() - inicio:.1f}s")
+
+    tempos_leitura, tempos_calculo = [], []
+    with db_mod.SessionLocal() as db:
+        for _ in range(5):
+            inicio = time.perf_counter()
+            colunas = db_mod.db_get_colunas_envelhecimento(db)
+            meio = time.perf_counter()
+            relatorio = calcular_envelhecimento(*colunas, hoje=hoje)
+            tempos_leitura.append(meio - inicio)
+            tempos_calculo.append(time.perf_counter() - meio)
+            db.rollback() # Cada rodada numa transação nova, como cada /envelhecimento
+
+    tempos = [leitura + calculo for leitura, calculo in zip(tempos_leitura, tempos_calculo)]
+    print(f"Pessoas com saldo: {relatorio.pessoa_ids.size}")
+    print("Total por faixa: " + ", ".join(f"{f}: R$ {v:,.2f}" for f, v in zip(FAIXAS_ENVELHECIMENTO, relatorio.total)))
+    print(f"Leitura do banco: melhor {min(tempos_leitura):.3f}s | cálculo: melhor {min(tempos_calculo):.3f}s")
+    print(f"Total (leitura + cálculo): melhor {min(tempos):.3f}s | pior {max(tempos):.3f}s")
+    if max(tempos) >= 1.0:
+        print("❌ Envelhecimento acima de 1s para 1 milhão de transações.")
+        raise SystemExit(1)
+    print("✅ Abaixo de 1s.")
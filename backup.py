@@ -0,0 +1,233 @@
+"""
+Backups online do banco SQLite.
+
+    python backup.py criar                  # snapshot agora
+    python backup.py verificar [arquivo]    # verifica um snapshot (padrão: o mais recente)
+    python backup.py restaurar <arquivo> <destino.db>
+"""
+import argparse
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from sqlalchemy.engine import make_url
+
+logger = logging.getLogger(__name__)
+
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "14")) # Snapshots mantidos
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "6"))
+# Páginas copiadas por passo da API de backup; entre passos o banco fica livre para escritas
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "256"))
+BACKUP_STEP_SLEEP = float(os.getenv("BACKUP_STEP_SLEEP", "0.005")) # Pausa entre passos, em segundos
+# Recomeços tolerados (escritas durante a cópia) antes de copiar tudo num passo só
+BACKUP_MAX_RESTARTS = int(os.getenv("BACKUP_MAX_RESTARTS", "3"))
+_PREFIXO = "paytrack-"
+_SUFIXO = ".db.gz"
+
+
+def caminho_banco_sqlite(database_url: str) -> str | None:
+    """Arquivo do banco, ou None se não for SQLite em arquivo (ex: Postgres, :memory:)."""
+    url = make_url(database_url)
+    if not url.drivername.startswith("sqlite") or url.database in (None, "", ":memory:"):
+        return None
+    return os.path.abspath(url.database)
+
+
+def listar_snapshots(pasta: str = BACKUP_DIR) -> list[str]:
+    """Snapshots do mais antigo para o mais recente (o nome começa pela data)."""
+    if not os.path.isdir(pasta):
+        return []
+    nomes = sorted(n for n in os.listdir(pasta) if n.startswith(_PREFIXO) and n.endswith(_SUFIXO))
+    return [os.path.join(pasta, n) for n in nomes]
+
+
+def _hash_arquivo(caminho: str) -> str:
+    h = hashlib.sha256()
+    with open(caminho, "rb") as f:
+        for bloco in iter(lambda: f.read(1 << 20), b""):
+            h.update(bloco)
+    return h.hexdigest()
+
+
+def _hash_do_snapshot(caminho: str) -> str:
+    # paytrack-AAAAMMDD-HHMMSS-<hash>.db.gz
+    return os.path.basename(caminho)[len(_PREFIXO):-len(_SUFIXO)].rsplit("-", 1)[-1]
+
+
+class _CopiaRecomecou(Exception):
+    pass
+
+
+def copiar_online(origem: str, destino: str, paginas_por_passo: int = BACKUP_PAGES_PER_STEP,
+                  pausa: float = BACKUP_STEP_SLEEP, max_recomecos: int = BACKUP_MAX_RESTARTS) -> None:
+    """
+    Copia o banco com a API de backup do SQLite em passos de poucas páginas:
+    cada passo segura o lock de leitura só por um instante, então o bot continua
+    escrevendo. Se o banco mudar no meio, o SQLite recomeça a cópia; depois de
+    `max_recomecos` recomeços, copia o resto num passo só para não ficar em loop
+    sob escrita contínua.
+    """
+    recomecos = 0
+    anterior = None
+
+    def progresso(status, restantes, total):
+        nonlocal recomecos, anterior
+        if anterior is not None and restantes > anterior:
+            recomecos += 1
+            if recomecos > max_recomecos:
+                raise _CopiaRecomecou
+        anterior = restantes
+
+    conexao_origem = sqlite3.connect(f"file:{origem}?mode=ro", uri=True)
+    conexao_destino = sqlite3.connect(destino)
+    try:
+        try:
+            conexao_origem.backup(conexao_destino, pages=paginas_por_passo, progress=progresso, sleep=pausa)
+        except _CopiaRecomecou:
+            logger.info(f"Backup: banco alterado durante a cópia {recomecos} vezes; copiando num passo só.")
+            conexao_origem.backup(conexao_destino, pages=-1)
+    finally:
+        conexao_destino.close()
+        conexao_origem.close()
+
+
+def criar_snapshot(origem: str, pasta: str = BACKUP_DIR, manter: int = BACKUP_KEEP) -> tuple[str, bool]:
+    """
+    Cria um snapshot comprimido e faz a rotação. Se o conteúdo for igual ao do
+    último snapshot, nada é gravado. Retorna (snapshot mais recente, se é novo).
+    Bloqueante: no bot, rode numa thread.
+    """
+    os.makedirs(pasta, exist_ok=True)
+    inicio = time.perf_counter()
+    descritor, temporario = tempfile.mkstemp(prefix=".backup-", suffix=".db", dir=pasta)
+    os.close(descritor)
+    try:
+        copiar_online(origem, temporario)
+        digest = _hash_arquivo(temporario)[:16]
+        existentes = listar_snapshots(pasta)
+        if existentes and _hash_do_snapshot(existentes[-1]) == digest:
+            logger.info(f"Backup: banco sem alterações desde {os.path.basename(existentes[-1])}.")
+            return existentes[-1], False
+
+        final = os.path.join(pasta, f"{_PREFIXO}{datetime.now():%Y%m%d-%H%M%S}-{digest}{_SUFIXO}")
+        with open(temporario, "rb") as entrada, gzip.open(final + ".tmp", "wb", compresslevel=6) as saida:
+            shutil.copyfileobj(entrada, saida, 1 << 20)
+        os.replace(final + ".tmp", final) # Só aparece na pasta quando estiver completo
+    finally:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+
+    snapshots = listar_snapshots(pasta)
+    for antigo in snapshots[:max(0, len(snapshots) - manter)]:
+        os.remove(antigo)
+    logger.info(f"Backup: {os.path.basename(final)} ({os.path.getsize(final) / 1024:.0f} KiB) em {time.perf_counter() - inicio:.2f}s.")
+    return final, True
+
+
+@dataclass
+class ResultadoVerificacao:
+    integridade: list[str]
+    chaves_estrangeiras: list[tuple]
+    contagens: dict[str, int] = field(default_factory=dict)
+
+    @property
+    def ok(self) -> bool:
+        return self.integridade == ["ok"] and not self.chaves_estrangeiras
+
+
+def descomprimir(snapshot: str, destino: str) -> None:
+    with gzip.open(snapshot, "rb") as entrada, open(destino, "wb") as saida:
+        shutil.copyfileobj(entrada, saida, 1 << 20)
+
+
+def verificar_banco(caminho: str) -> ResultadoVerificacao:
+    conexao = sqlite3.connect(f"file:{caminho}?mode=ro", uri=True)
+    try:
+        integridade = [linha[0] for linha in conexao.execute("PRAGMA integrity_check")]
+        chaves = conexao.execute("PRAGMA foreign_key_check").fetchall()
+        # Só tabelas comuns: a busca textual (FTS5) é reconstruível e tem tabelas internas
+        tabelas = sorted(linha[1] for linha in conexao.execute("PRAGMA table_list")
+                         if linha[0] == "main" and linha[2] == "table" and not linha[1].startswith("sqlite_"))
+        contagens = {t: conexao.execute(f'SELECT count(*) FROM "{t}"').fetchone()[0] for t in tabelas}
+    finally:
+        conexao.close()
+    return ResultadoVerificacao(integridade, chaves, contagens)
+
+
+def verificar_snapshot(snapshot: str) -> ResultadoVerificacao:
+    """Descomprime numa pasta temporária e roda integrity_check, foreign_key_check e contagens."""
+    with tempfile.TemporaryDirectory() as pasta:
+        caminho = os.path.join(pasta, "restaurado.db")
+        descomprimir(snapshot, caminho)
+        return verificar_banco(caminho)
+
+
+def restaurar_snapshot(snapshot: str, destino: str, forcar: bool = False) -> ResultadoVerificacao:
+    """Restaura para `destino` somente se o snapshot passar na verificação."""
+    if os.path.exists(destino) and not forcar:
+        raise FileExistsError(f"{destino} já existe (use --forcar para sobrescrever).")
+    temporario = destino + ".restaurando"
+    descomprimir(snapshot, temporario)
+    resultado = verificar_banco(temporario)
+    if not resultado.ok:
+        os.remove(temporario)
+        return resultado
+    os.replace(temporario, destino)
+    return resultado
+
+
+def _imprimir_verificacao(snapshot: str, resultado: ResultadoVerificacao, referencia: ResultadoVerificacao | None) -> None:
+    print(f"Snapshot: {snapshot}")
+    print(f"  integrity_check: {', '.join(resultado.integridade[:5])}")
+    print(f"  foreign_key_check: {'ok' if not resultado.chaves_estrangeiras else f'{len(resultado.chaves_estrangeiras)} violações'}")
+    for tabela, total in resultado.contagens.items():
+        atual = f" (banco atual: {referencia.contagens.get(tabela, 0)})" if referencia else ""
+        print(f"  {tabela:<24} {total:>8}{atual}")
+    print("✅ Snapshot íntegro." if resultado.ok else "❌ Snapshot com problemas.")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description="Backups online do banco SQLite do PayTrack.")
+    sub = parser.add_subparsers(dest="comando", required=True)
+    sub.add_parser("criar", help="Cria um snapshot agora.")
+    verificar = sub.add_parser("verificar", help="Verifica um snapshot (padrão: o mais recente).")
+    verificar.add_argument("snapshot", nargs="?")
+    restaurar = sub.add_parser("restaurar", help="Restaura um snapshot verificado para um arquivo novo.")
+    restaurar.add_argument("snapshot")
+    restaurar.add_argument("destino")
+    restaurar.add_argument("--forcar", action="store_true")
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv()
+    banco = caminho_banco_sqlite(os.getenv("DATABASE_URL", "sqlite:///./debt_manager.db"))
+
+    if args.comando == "criar":
+        if banco is None:
+            sys.exit("Backups online só se aplicam a bancos SQLite em arquivo.")
+        caminho, novo = criar_snapshot(banco)
+        print(caminho if novo else f"Sem alterações: {caminho}")
+    elif args.comando == "verificar":
+        snapshot = args.snapshot or (listar_snapshots() or [None])[-1]
+        if snapshot is None:
+            sys.exit(f"Nenhum snapshot em {BACKUP_DIR}/.")
+        resultado = verificar_snapshot(snapshot)
+        referencia = verificar_banco(banco) if banco and os.path.exists(banco) else None
+        _imprimir_verificacao(snapshot, resultado, referencia)
+        sys.exit(0 if resultado.ok else 1)
+    else:
+        resultado = restaurar_snapshot(args.snapshot, args.destino, forcar=args.forcar)
+        _imprimir_verificacao(args.snapshot, resultado, None)
+        if resultado.ok:
+            print(f"Restaurado em {args.destino}.")
+        sys.exit(0 if resultado.ok else 1)
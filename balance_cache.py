@@ -0,0 +1,48 @@
+import threading
+from typing import Callable, Iterable
+
+
+class CacheSaldos:
+    """
+    Saldos por pessoa em memória para respostas de baixa latência (modo inline).
+    Entradas são invalidadas quando as transações da pessoa mudam; as que faltam
+    são carregadas juntas, numa única consulta.
+    A carga roda fora do lock, então cada pessoa tem uma geração que `invalidar`
+    incrementa: um saldo lido antes de uma invalidação não é guardado, senão o
+    valor anterior à escrita ficaria no cache até a próxima alteração.
+    """
+
+    def __init__(self, carregar: Callable[[Iterable[int]], dict[int, float]]):
+        self._carregar = carregar
+        self._lock = threading.Lock()
+        self._saldos: dict[int, float] = {}
+        self._geracoes: dict[int, int] = {}
+        self._epoca = 0 # Incrementada por limpar()
+
+    def obter(self, pessoa_ids: Iterable[int]) -> dict[int, float]:
+        pessoa_ids = list(pessoa_ids) # Percorrido mais de uma vez: aceita geradores
+        with self._lock:
+            faltando = [pid for pid in pessoa_ids if pid not in self._saldos]
+            geracoes = {pid: self._geracoes.get(pid, 0) for pid in faltando}
+            epoca = self._epoca
+        carregados = self._carregar(faltando) if faltando else {}
+        with self._lock:
+            if self._epoca == epoca:
+                for pid in faltando:
+                    if self._geracoes.get(pid, 0) == geracoes[pid]:
+                        self._saldos[pid] = carregados.get(pid, 0.0)
+            return {pid: self._saldos.get(pid, carregados.get(pid, 0.0)) for pid in pessoa_ids}
+
+    def invalidar(self, pessoa_ids: Iterable[int]) -> None:
+        with self._lock:
+            for pid in pessoa_ids:
+                self._saldos.pop(pid, None)
+                self._geracoes[pid] = self._geracoes.get(pid, 0) + 1
+
+    def limpar(self) -> None:
+        with self._lock:
+            self._saldos.clear()
+            self._epoca += 1
+
+    def __len__(self) -> int:
+        return len(self._saldos)
@@ -0,0 +1,311 @@
+"""
+Benchmark da extração de transações sobre um corpus rotulado em PT-BR.
+
+    python benchmark_extracao.py            # offline: parser regex local + Gemini com as respostas gravadas, se houver
+    python benchmark_extracao.py --gravar   # chama a API de verdade e grava as respostas que faltam
+    python benchmark_extracao.py --ao-vivo  # chama a API sem usar nem gravar respostas
+    python benchmark_extracao.py --extrator meu_parser:extrair   # qualquer função com a assinatura do extrator
+
+Relata, para cada extrator, acerto por campo (valor, data, descrição),
+latência por etapa (prompt, chamada, parse, normalização) e vazão.
+"""
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import re
+import statistics
+import sys
+import time
+import unicodedata
+from datetime import date as DateObject
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dados", "corpus_extracao.jsonl")
+GRAVACOES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dados", "gravacoes_gemini.json")
+# Data de referência do corpus: "hoje", "ontem" e o prompt são calculados a partir dela
+HOJE_CORPUS = DateObject(2025, 6, 15)
+ETAPAS = ("prompt", "chamada", "parse", "normalizacao")
+
+
+class GravacaoAusente(KeyError):
+    pass
+
+
+class _RespostaGravada:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class ModeloGravado:
+    """
+    Substituto de `model.generate_content` que responde com gravações indexadas
+    pelo hash do prompt. Com `gravar=True`, o que falta é pedido ao modelo real
+    e guardado (com a latência original) para as próximas execuções.
+    """
+
+    def __init__(self, arquivo: str, modelo_real=None, nome_modelo: str = "", gravar: bool = False):
+        self._arquivo = arquivo
+        self._modelo_real = modelo_real
+        self._nome_modelo = nome_modelo
+        self._gravar = gravar
+        self.novas = 0
+        self.latencias_gravadas: list[float] = []
+        self._gravacoes = {}
+        if os.path.exists(arquivo):
+            with open(arquivo, encoding="utf-8") as f:
+                self._gravacoes = json.load(f)
+
+    def _chave(self, prompt: str) -> str:
+        return hashlib.sha256(f"{self._nome_modelo}\n{prompt}".encode("utf-8")).hexdigest()
+
+    def generate_content(self, partes):
+        prompt = "".join(partes)
+        chave = self._chave(prompt)
+        gravacao = self._gravacoes.get(chave)
+        if gravacao is None:
+            if not self._gravar:
+                raise GravacaoAusente(f"Sem resposta gravada para o prompt {chave[:12]} (rode com --gravar).")
+            inicio = time.perf_counter()
+            texto = self._modelo_real.generate_content(partes).text
+            gravacao = {"texto": texto, "latencia_s": time.perf_counter() - inicio}
+            self._gravacoes[chave] = gravacao
+            self.novas += 1
+        self.latencias_gravadas.append(gravacao["latencia_s"])
+        return _RespostaGravada(gravacao["texto"])
+
+    def salvar(self) -> None:
+        if self.novas:
+            with open(self._arquivo, "w", encoding="utf-8") as f:
+                json.dump(self._gravacoes, f, ensure_ascii=False, indent=1, sort_keys=True)
+
+
+def carregar_corpus(caminho: str = CORPUS) -> list[dict]:
+    with open(caminho, encoding="utf-8") as f:
+        return [json.loads(linha) for linha in f if linha.strip()]
+
+
+def _palavras(texto: str) -> set[str]:
+    sem_acentos = unicodedata.normalize("NFKD", texto).encode("ascii", "ignore").decode("ascii")
+    return set(re.findall(r"[a-z0-9]+", sem_acentos.lower()))
+
+
+def descricao_confere(extraida: str, esperada: str, tipo: str) -> bool:
+    """Descrição vazia no corpus aceita a padrão; as demais comparam palavras (Jaccard >= 0.5)."""
+    extraida = (extraida or "").strip()
+    if not esperada:
+        return extraida == "" or _palavras(extraida) <= _palavras(tipo) | {"pagamento", "emprestimo"}
+    a, b = _palavras(extraida), _palavras(esperada)
+    return bool(a | b) and len(a & b) / len(a | b) >= 0.5
+
+
+def avaliar(resultado: dict, exemplo: dict) -> dict[str, bool]:
+    esperado = exemplo["esperado"]
+    if "error" in resultado:
+        return {"valor": False, "data": False, "descricao": False}
+    try:
+        valor_ok = abs(float(resultado.get("valor")) - esperado["valor"]) < 0.005
+    except (TypeError, ValueError):
+        valor_ok = False
+    return {
+        "valor": valor_ok,
+        "data": resultado.get("data") == esperado["data"],
+        "descricao": descricao_confere(str(resultado.get("descricao", "")), esperado["descricao"], exemplo["tipo"]),
+    }
+
+
+# --- Extrator local de referência: regex, sem API, para comparar com a Gemini ---
+EXTRATOR_GEMINI = "gemini_service:extract_transaction_data"
+EXTRATOR_LOCAL = "benchmark_extracao:extrator_regex"
+
+_MESES = {"janeiro": 1, "fevereiro": 2, "março": 3, "marco": 3, "abril": 4, "maio": 5, "junho": 6, "julho": 7,
+          "agosto": 8, "setembro": 9, "outubro": 10, "novembro": 11, "dezembro": 12}
+_RE_DATA_NUMERICA = re.compile(r"\b\d{1,2}[/.-]\d{1,2}[/.-](?:\d{4}|\d{2})\b")
+_RE_DATA_POR_EXTENSO = re.compile(r"\b(\d{1,2}) de (" + "|".join(_MESES) + r")(?: de (\d{4}))?\b", re.IGNORECASE)
+_RE_DATA_RELATIVA = re.compile(r"\b(?:anteontem|ontem|hoje)(?: cedo)?\b", re.IGNORECASE)
+_RE_PARCELADO = re.compile(r"\b(\d+)\s*x\s*de\s*(?:r\$\s*)?(\d+(?:,\d{1,2})?)", re.IGNORECASE)
+_RE_VALOR = re.compile(r"(?:r\$\s*)?\b(\d{1,3}(?:\.\d{3})+(?:,\d{1,2})?|\d+(?:[.,]\d{1,2})?)\b(\s*mil\b)?"
+                       r"(?!\s*(?:parcelas|vezes|x)\b)(?:\s*(?:reais|pila|conto)\b)?", re.IGNORECASE)
+# Depois de "pra"/"para", o que não for uma pessoa ("pro João", "pra Ana", "para o meu irmão") é o propósito
+_RE_PROPOSITO = re.compile(r"\b(?:pra|para|referente)\s+(?!(?:o |a )?(?:[A-ZÀ-Ú]|meu\b|minha\b|ela\b|ele\b))(.+)$")
+_RE_DO_QUE = re.compile(r"^(?:os\s+)?(?:do|da)\s+(?![A-ZÀ-Ú])(\w+)") # "18 do uber", "40 da pizza"
+
+
+def _numero_br(texto: str) -> float:
+    """'1.200' -> 1200, '2.500,00' -> 2500, '25.50' -> 25.5, '35,90' -> 35.9."""
+    if "," in texto:
+        return float(texto.replace(".", "").replace(",", "."))
+    if re.fullmatch(r"\d{1,3}(?:\.\d{3})+", texto):
+        return float(texto.replace(".", ""))
+    return float(texto)
+
+
+def extrator_regex(texto: str, tipo: str, hoje: DateObject | None = None, tempos: dict | None = None) -> dict:
+    """
+    Linha de base determinística: valor e data por expressões regulares, descrição
+    por heurística, e a mesma normalização da extração pela Gemini
+    (normalize_extracted_data). Mesma assinatura de extract_transaction_data.
+    """
+    from gemini_service import normalize_extracted_data # Importa só quando usado: exige GEMINI_API_KEY definida
+    hoje = hoje or DateObject.today()
+    tempos = tempos if tempos is not None else {}
+
+    inicio = time.perf_counter()
+    resto, data = texto, None
+    for padrao in (_RE_DATA_NUMERICA, _RE_DATA_POR_EXTENSO, _RE_DATA_RELATIVA):
+        encontrada = padrao.search(resto)
+        if encontrada:
+            if padrao is _RE_DATA_POR_EXTENSO:
+                dia, mes, ano = encontrada.groups()
+                data = f"{ano or hoje.year}-{_MESES[mes.lower()]:02d}-{int(dia):02d}"
+            else:
+                data = encontrada.group(0)
+            resto = resto[:encontrada.start()] + resto[encontrada.end():]
+            break
+    resto = _RE_DATA_RELATIVA.sub("", resto)
+    resto = re.sub(r"\b(?:no dia|dia|em)\s*(?=,|$)", "", resto.strip()) # Conectivos que sobraram da data
+
+    valor, depois_do_valor = None, resto
+    parcelado = _RE_PARCELADO.search(resto)
+    encontrado = parcelado or _RE_VALOR.search(resto)
+    if parcelado:
+        valor = int(parcelado.group(1)) * _numero_br(parcelado.group(2))
+    elif encontrado:
+        valor = _numero_br(encontrado.group(1)) * (1000 if encontrado.group(2) else 1)
+    if encontrado:
+        depois_do_valor = resto[encontrado.end():].strip(" ,.")
+        resto = resto[:encontrado.start()] + resto[encontrado.end():]
+
+    partes = [parte.strip(" .") for parte in resto.split(",") if parte.strip(" .")]
+    descricao = ""
+    proposito = _RE_PROPOSITO.search(resto)
+    do_que = _RE_DO_QUE.match(depois_do_valor.split(",")[0])
+    if len(partes) > 1 and not _RE_VALOR.search(partes[-1]) and len(partes[-1].split()) <= 4:
+        descricao = re.sub(r"^(?:foi\s+)?(?:pro|pra|para)\s+(?:o\s+|a\s+)?", "", partes[-1])
+    elif proposito:
+        descricao = proposito.group(1)
+    elif do_que:
+        descricao = do_que.group(1)
+    descricao = re.sub(r"\s+(?:em|no dia|dia)\s*$", "", descricao.strip(" ,."))
+    tempos["parse"] = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    resultado = normalize_extracted_data({"valor": valor, "data": data, "descricao": descricao}, texto, tipo, hoje)
+    tempos["normalizacao"] = time.perf_counter() - inicio
+    return resultado
+
+
+def carregar_extrator(especificacao: str):
+    """'modulo:funcao' -> a função, ex: gemini_service:extract_transaction_data."""
+    modulo, _, funcao = especificacao.partition(":")
+    if not modulo or not funcao:
+        raise ValueError(f"Extrator inválido: {especificacao!r}. Use modulo:funcao.")
+    return getattr(importlib.import_module(modulo), funcao)
+
+
+def _percentil(valores: list[float], p: float) -> float:
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p * (len(ordenados) - 1))))]
+
+
+def executar_benchmark(extrator, corpus: list[dict], hoje: DateObject = HOJE_CORPUS, mostrar_erros: bool = True) -> dict:
+    """
+    Roda `extrator(texto, tipo, hoje=..., tempos=...)` em todo o corpus.
+    Qualquer extrator com essa assinatura (ex: um parser local) pode ser comparado.
+    """
+    acertos = {"valor": 0, "data": 0, "descricao": 0, "todos": 0}
+    tempos_etapas = {etapa: [] for etapa in ETAPAS}
+    totais = []
+    inicio_total = time.perf_counter()
+    for exemplo in corpus:
+        tempos = {}
+        inicio = time.perf_counter()
+        resultado = extrator(exemplo["texto"], exemplo["tipo"], hoje=hoje, tempos=tempos)
+        totais.append(time.perf_counter() - inicio)
+        for etapa, duracao in tempos.items():
+            tempos_etapas.setdefault(etapa, []).append(duracao)
+
+        avaliacao = avaliar(resultado, exemplo)
+        for campo, ok in avaliacao.items():
+            acertos[campo] += ok
+        acertos["todos"] += all(avaliacao.values())
+        if mostrar_erros and not all(avaliacao.values()):
+            errados = ", ".join(campo for campo, ok in avaliacao.items() if not ok)
+            print(f"  ✗ [{errados}] {exemplo['texto']!r}\n      esperado {exemplo['esperado']} | obtido {resultado}")
+    duracao_total = time.perf_counter() - inicio_total
+    return {
+        "n": len(corpus),
+        "acertos": acertos,
+        "tempos_etapas": tempos_etapas,
+        "totais": totais,
+        "vazao": len(corpus) / duracao_total if duracao_total else 0.0,
+    }
+
+
+def imprimir_relatorio(nome: str, relatorio: dict, latencias_gravadas: list[float] | None = None) -> None:
+    n = relatorio["n"]
+    print(f"\n=== {nome}: {n} exemplos ===")
+    for campo, acertos in relatorio["acertos"].items():
+        print(f"  acerto {campo:<10} {acertos:>3}/{n} ({acertos / n:.0%})")
+    print("  latência por etapa (ms)      média      p50      p95")
+    for etapa, duracoes in relatorio["tempos_etapas"].items():
+        if duracoes:
+            ms = [d * 1000 for d in duracoes]
+            print(f"    {etapa:<24} {statistics.mean(ms):>8.3f} {_percentil(ms, 0.5):>8.3f} {_percentil(ms, 0.95):>8.3f}")
+    if latencias_gravadas:
+        ms = [d * 1000 for d in latencias_gravadas]
+        print(f"    {'chamada (gravada)':<24} {statistics.mean(ms):>8.1f} {_percentil(ms, 0.5):>8.1f} {_percentil(ms, 0.95):>8.1f}")
+    print(f"  vazão: {relatorio['vazao']:.1f} mensagens/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark da extração de transações.")
+    modo = parser.add_mutually_exclusive_group()
+    modo.add_argument("--gravar", action="store_true", help="Chama a API para prompts sem gravação e salva as respostas.")
+    modo.add_argument("--ao-vivo", action="store_true", help="Chama a API em todos os exemplos, sem gravações.")
+    parser.add_argument("--extrator", action="append", metavar="MODULO:FUNCAO",
+                        help=f"Extrator a avaliar (pode repetir). Padrão: {EXTRATOR_LOCAL} e {EXTRATOR_GEMINI}.")
+    parser.add_argument("--corpus", default=CORPUS)
+    parser.add_argument("--gravacoes", default=GRAVACOES)
+    parser.add_argument("--quieto", action="store_true", help="Não lista os exemplos errados.")
+    args = parser.parse_args()
+
+    if not (args.gravar or args.ao_vivo):
+        os.environ.setdefault("GEMINI_API_KEY", "offline") # A API não é chamada no modo replay
+    import gemini_service
+
+    corpus = carregar_corpus(args.corpus)
+    modelo_gravado = None
+    if not args.ao_vivo and (args.gravar or os.path.exists(args.gravacoes)):
+        modelo_gravado = ModeloGravado(args.gravacoes, gemini_service.model, gemini_service.MODEL_NAME, gravar=args.gravar)
+        gemini_service.model = modelo_gravado
+
+    avaliados = 0
+    try:
+        for especificacao in args.extrator or [EXTRATOR_LOCAL, EXTRATOR_GEMINI]:
+            try:
+                extrator = carregar_extrator(especificacao)
+            except (ImportError, AttributeError, ValueError) as e:
+                sys.exit(f"Não foi possível carregar o extrator {especificacao}: {e}")
+            nome = especificacao
+            latencias_gravadas = None
+            if extrator.__module__ == "gemini_service": # Extratores que chamam gemini_service.model
+                if not args.ao_vivo and modelo_gravado is None:
+                    print(f"\n⚠️ {especificacao} ignorado: nenhuma resposta gravada em {args.gravacoes}. "
+                          "Rode uma vez com --gravar (requer GEMINI_API_KEY).")
+                    continue
+                nome += " (ao vivo)" if args.ao_vivo else " (gravações)"
+                ja_gravadas = len(modelo_gravado.latencias_gravadas) if modelo_gravado else 0
+
+            relatorio = executar_benchmark(extrator, corpus, mostrar_erros=not args.quieto)
+            if extrator.__module__ == "gemini_service" and modelo_gravado:
+                latencias_gravadas = modelo_gravado.latencias_gravadas[ja_gravadas:]
+            imprimir_relatorio(nome, relatorio, latencias_gravadas)
+            avaliados += 1
+    finally:
+        if modelo_gravado:
+            modelo_gravado.salvar()
+    if not avaliados:
+        sys.exit("Nenhum extrator foi avaliado.")
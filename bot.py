@@ -1,15 +1,22 @@
 import asyncio
+import calendar
 import logging
 import os
+import re
 from dotenv import load_dotenv
-from datetime import datetime, date as DateObject # Renomeado para evitar conflito
+from datetime import datetime, time as TimeObject, date as DateObject # Renomeado para evitar conflito
+from zoneinfo import ZoneInfo
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove,
+    InlineQueryResultArticle, InputTextMessageContent
+)
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, ConversationHandler,
-    CallbackQueryHandler, filters, ContextTypes
+    CallbackQueryHandler, InlineQueryHandler, TypeHandler, filters, ContextTypes
 )
 from telegram.constants import ParseMode, ChatAction
+from telegram.helpers import escape_markdown
 
 
 # Carregar variáveis de ambiente
@@ -17,15 +24,33 @@ load_dotenv()
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 if not TELEGRAM_BOT_TOKEN:
     raise ValueError("Token do Telegram não encontrado. Defina TELEGRAM_BOT_TOKEN no .env")
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL") # Opcional, padrão: api.telegram.org
+# IDs do Telegram (separados por vírgula) autorizados a usar comandos administrativos como /backup
+ADMIN_USER_IDS = {int(i) for i in os.getenv("ADMIN_USER_IDS", "").replace(" ", "").split(",") if i}
 
 # Importar do projeto
 from database import (
-    get_db, Pessoa, Emprestimo, Pagamento,
+    Pessoa, Emprestimo, Pagamento, EmprestimoArquivado, PagamentoArquivado,
     db_add_pessoa, db_get_all_pessoas, db_get_pessoa_by_id,
     db_edit_pessoa, db_remove_pessoa, db_add_emprestimo,
-    db_add_pagamento, db_get_transacoes_pessoa, SessionLocal
+    db_add_pagamento, db_get_transacoes_pessoa, SessionLocal,
+    db_get_colunas_envelhecimento, db_reconstruir_alocacoes, db_reconstruir_saldos_mensais, db_verificar_alocacoes,
+    db_buscar_transacoes, db_get_extrato_pessoa, db_get_serie_saldo,
+    registrar_ouvinte_alteracoes, db_get_saldos, db_get_transacao_por_chave, DATABASE_URL,
+    db_arquivar_periodos_quitados, db_get_resumo_arquivado,
+    gerar_cronograma, db_get_resumo_parcelas, db_get_parcelas_a_lembrar, db_marcar_lembretes_enviados,
+    db_add_emprestimos_divididos, db_get_divisao_por_chave, inicializar_banco
 )
-from gemini_service import extract_transaction_data
+from gemini_service import extract_transaction_data, extract_split_data, normalize_date_string
+from divisao import calcular_partes
+from charts import encerrar_pool, gerar_grafico_saldo
+from name_index import IndiceNomes, normalizar
+from balance_cache import CacheSaldos
+from aging import FAIXAS_ENVELHECIMENTO, calcular_envelhecimento
+from metrics import coletar_metricas, memoria_residente_mb, registrar_gauge
+from rate_limiter import LimitadorEnvios, PRIORIDADE_SEGUNDO_PLANO
+from session_middleware import ContextoPaytrack, PaytrackApplication
+from backup import BACKUP_INTERVAL_HOURS, caminho_banco_sqlite, criar_snapshot
 
 # Configuração de logging
 logging.basicConfig(
@@ -40,17 +65,35 @@ TYPING_PESSOA_NOME, CONFIRM_PESSOA_EDIT_NOME, SELECT_PESSOA_TO_EDIT, SELECT_PESS
 SELECT_PESSOA_TRANSACAO, TYPING_TRANSACAO_DETALHES, CONFIRM_TRANSACAO = range(5, 8) # Continuar a numeração
 # Para Status
 SELECT_PESSOA_STATUS = range(8,9)
+# Para Extrato
+SELECT_PESSOA_EXTRATO, TYPING_EXTRATO_PERIODO = range(9, 11)
+# Para Despesa Dividida (parte da conversa de transações)
+SELECT_PESSOAS_DIVISAO, TYPING_DIVISAO_DETALHES, CONFIRM_DIVISAO = range(11, 14)
 
 
 # --- Funções Auxiliares ---
-def get_pessoas_keyboard(callback_prefix: str, include_cancel=True, db_session=None):
-    """Cria um teclado inline com as pessoas cadastradas."""
-    close_session_locally = False
-    if db_session is None:
-        db_session = next(get_db())
-        close_session_locally = True
+def _carregar_nomes_pessoas() -> list[tuple[int, str]]:
+    with SessionLocal() as db:
+        return [(p.id, p.nome) for p in db_get_all_pessoas(db)]
+
+# Índice fuzzy dos nomes para mensagens livres; recarregado quando pessoas mudam
+indice_pessoas = IndiceNomes(_carregar_nomes_pessoas)
+
+def _carregar_saldos(pessoa_ids) -> dict[int, float]:
+    with SessionLocal() as db:
+        return db_get_saldos(db, list(pessoa_ids))
+
+# Saldos em memória para o modo inline (uma consulta por lote de pessoas sem cache)
+cache_saldos = CacheSaldos(_carregar_saldos)
+
+@registrar_ouvinte_alteracoes
+def _invalidar_indice_pessoas(pessoas_alteradas: bool, pessoa_ids: set[int]) -> None:
+    if pessoas_alteradas:
+        indice_pessoas.invalidar()
+    cache_saldos.invalidar(pessoa_ids)
 
-    pessoas = db_get_all_pessoas(db_session)
+def get_pessoas_keyboard(callback_prefix: str, pessoas: list[Pessoa], include_cancel=True):
+    """Cria um teclado inline com as pessoas cadastradas."""
     keyboard = []
     if not pessoas:
         keyboard.append([InlineKeyboardButton("Nenhuma pessoa cadastrada.", callback_data="no_pessoas_found")])
@@ -61,12 +104,18 @@ def get_pessoas_keyboard(callback_prefix: str, include_cancel=True, db_session=N
     if include_cancel:
         keyboard.append([InlineKeyboardButton("↩️ Cancelar", callback_data="cancel_operation")])
 
-    if close_session_locally:
-        db_session.close()
     return InlineKeyboardMarkup(keyboard) if keyboard else None
 
+def get_pessoas_multiselect_keyboard(pessoas: list[Pessoa], selecionadas: set[int]) -> InlineKeyboardMarkup:
+    """Teclado com marcação por pessoa (toque alterna) e o botão para continuar."""
+    keyboard = [[InlineKeyboardButton(f"{'✅' if p.id in selecionadas else '⬜'} {p.nome}", callback_data=f"div_tog_p_{p.id}")]
+                for p in pessoas]
+    keyboard.append([InlineKeyboardButton(f"➡️ Continuar ({len(selecionadas)})", callback_data="div_continuar")])
+    keyboard.append([InlineKeyboardButton("↩️ Cancelar", callback_data="cancel_operation")])
+    return InlineKeyboardMarkup(keyboard)
+
 # --- Comando /start ---
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def start_command(update: Update, context: ContextoPaytrack) -> None:
     user = update.effective_user
     await update.message.reply_html(
         rf"Olá, {user.mention_html()}! 👋"
@@ -75,15 +124,20 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         "\n/pessoas - 🧍 Gerenciar pessoas devedoras"
         "\n/emprestimos - 💸 Registrar novo empréstimo"
         "\n/pagamentos - 💰 Registrar pagamento recebido"
+        "\n/dividir - 🧮 Dividir uma despesa entre várias pessoas"
         "\n/status - 📊 Ver status de um devedor"
-        "\n/cancel - ❌ Cancelar operação atual",
+        "\n/extrato - 🧾 Extrato de um devedor por período"
+        "\n/buscar - 🔎 Buscar transações pela descrição"
+        "\n/grafico - 📈 Evolução do saldo"
+        "\n/cancel - ❌ Cancelar operação atual"
+        "\n\nOu simplesmente escreva: \"emprestei 50 pro João ontem\"",
         reply_markup=ReplyKeyboardRemove() # Remove qualquer teclado customizado anterior
     )
     return ConversationHandler.END # Garante que qualquer conversa anterior seja encerrada
 
 
 # --- Gerenciamento de Pessoas (/pessoas) ---
-async def pessoas_menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def pessoas_menu_command(update: Update, context: ContextoPaytrack) -> None:
     keyboard = [
         [InlineKeyboardButton("➕ Adicionar Pessoa", callback_data="add_pessoa_start")],
         [InlineKeyboardButton("📝 Editar Pessoa", callback_data="edit_pessoa_select")],
@@ -100,12 +154,11 @@ async def pessoas_menu_command(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text(message_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
 
 # Listar Pessoas
-async def list_pessoas_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def list_pessoas_callback(update: Update, context: ContextoPaytrack) -> None:
     query = update.callback_query
     await query.answer()
-    db = next(get_db())
+    db = context.db
     pessoas = db_get_all_pessoas(db)
-    db.close()
 
     message_text = "📋 *Pessoas Cadastradas*\n\n"
     if not pessoas:
@@ -119,30 +172,28 @@ async def list_pessoas_callback(update: Update, context: ContextTypes.DEFAULT_TY
     await query.edit_message_text(text=message_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
 
 # Adicionar Pessoa - Início
-async def add_pessoa_start_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def add_pessoa_start_callback(update: Update, context: ContextoPaytrack) -> int:
     query = update.callback_query
     await query.answer()
     await query.edit_message_text(text="✏️ Digite o nome completo da pessoa que deseja adicionar:")
     return TYPING_PESSOA_NOME
 
 # Adicionar Pessoa - Receber Nome
-async def add_pessoa_receive_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def add_pessoa_receive_name(update: Update, context: ContextoPaytrack) -> int:
     nome_pessoa = update.message.text.strip()
     if not nome_pessoa or len(nome_pessoa) < 3:
         await update.message.reply_text("Nome muito curto ou inválido. Por favor, digite um nome com pelo menos 3 caracteres.")
         return TYPING_PESSOA_NOME
 
-    db = next(get_db())
+    db = context.db
     pessoa_existente = db.query(Pessoa).filter(Pessoa.nome == nome_pessoa).first()
     if pessoa_existente:
         await update.message.reply_text(f"⚠️ A pessoa '{nome_pessoa}' já está cadastrada. Tente outro nome ou edite a existente.")
-        db.close()
         # Voltar ao menu de pessoas ou pedir novo nome
         await pessoas_menu_command(update, context) # Reexibe o menu de pessoas
         return ConversationHandler.END
     
     nova_pessoa = db_add_pessoa(db, nome_pessoa)
-    db.close()
 
     if nova_pessoa:
         await update.message.reply_text(f"✅ Pessoa '{nova_pessoa.nome}' adicionada com sucesso!")
@@ -153,14 +204,13 @@ async def add_pessoa_receive_name(update: Update, context: ContextTypes.DEFAULT_
     return ConversationHandler.END
 
 # Editar Pessoa - Selecionar
-async def edit_pessoa_select_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def edit_pessoa_select_callback(update: Update, context: ContextoPaytrack) -> int:
     query = update.callback_query
     await query.answer()
-    db = next(get_db())
-    reply_markup = get_pessoas_keyboard(callback_prefix="edit_p_id", db_session=db)
-    db.close()
+    pessoas = db_get_all_pessoas(context.db)
+    reply_markup = get_pessoas_keyboard(callback_prefix="edit_p_id", pessoas=pessoas)
 
-    if not reply_markup or not db_get_all_pessoas(next(get_db())): # Verifica se há pessoas
+    if not pessoas: # Verifica se há pessoas
         await query.edit_message_text("🚫 Nenhuma pessoa cadastrada para editar.\nAdicione uma pessoa primeiro usando /pessoas.",
                                       reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Voltar ao Menu Pessoas", callback_data="pessoas_menu_refresh")]]))
         return ConversationHandler.END
@@ -169,14 +219,13 @@ async def edit_pessoa_select_callback(update: Update, context: ContextTypes.DEFA
     return SELECT_PESSOA_TO_EDIT
 
 # Editar Pessoa - Guardar ID e pedir novo nome
-async def edit_pessoa_ask_new_name_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def edit_pessoa_ask_new_name_callback(update: Update, context: ContextoPaytrack) -> int:
     query = update.callback_query
     await query.answer()
     pessoa_id = int(query.data.split("_")[-1])
     context.user_data["pessoa_id_to_edit"] = pessoa_id
-    db = next(get_db())
+    db = context.db
     pessoa = db_get_pessoa_by_id(db, pessoa_id)
-    db.close()
 
     if not pessoa:
         await query.edit_message_text("⚠️ Pessoa não encontrada. Pode ter sido removida.",
@@ -187,7 +236,7 @@ async def edit_pessoa_ask_new_name_callback(update: Update, context: ContextType
     return CONFIRM_PESSOA_EDIT_NOME
 
 # Editar Pessoa - Receber e Salvar Novo Nome
-async def edit_pessoa_receive_new_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def edit_pessoa_receive_new_name(update: Update, context: ContextoPaytrack) -> int:
     novo_nome = update.message.text.strip()
     pessoa_id = context.user_data.get("pessoa_id_to_edit")
 
@@ -199,7 +248,7 @@ async def edit_pessoa_receive_new_name(update: Update, context: ContextTypes.DEF
         await pessoas_menu_command(update, context)
         return ConversationHandler.END
 
-    db = next(get_db())
+    db = context.db
     pessoa_editada = db_edit_pessoa(db, pessoa_id, novo_nome)
     
     if pessoa_editada:
@@ -211,20 +260,18 @@ async def edit_pessoa_receive_new_name(update: Update, context: ContextTypes.DEF
             await update.message.reply_text(f"⚠️ Não foi possível atualizar. O nome '{novo_nome}' já está em uso por outra pessoa.")
         else:
             await update.message.reply_text("⚠️ Não foi possível atualizar. A pessoa pode não ter sido encontrada.")
-    db.close()
     del context.user_data["pessoa_id_to_edit"]
     await pessoas_menu_command(update, context)
     return ConversationHandler.END
 
 # Remover Pessoa - Selecionar
-async def remove_pessoa_select_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def remove_pessoa_select_callback(update: Update, context: ContextoPaytrack) -> int:
     query = update.callback_query
     await query.answer()
-    db = next(get_db())
-    reply_markup = get_pessoas_keyboard(callback_prefix="remove_p_id", db_session=db)
-    db.close()
+    pessoas = db_get_all_pessoas(context.db)
+    reply_markup = get_pessoas_keyboard(callback_prefix="remove_p_id", pessoas=pessoas)
 
-    if not reply_markup or not db_get_all_pessoas(next(get_db())):
+    if not pessoas: # Verifica se há pessoas
         await query.edit_message_text("🚫 Nenhuma pessoa cadastrada para remover.",
                                       reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Voltar ao Menu Pessoas", callback_data="pessoas_menu_refresh")]]))
         return ConversationHandler.END
@@ -233,14 +280,13 @@ async def remove_pessoa_select_callback(update: Update, context: ContextTypes.DE
     return SELECT_PESSOA_TO_REMOVE
 
 # Remover Pessoa - Confirmar
-async def remove_pessoa_confirm_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def remove_pessoa_confirm_callback(update: Update, context: ContextoPaytrack) -> int:
     query = update.callback_query
     await query.answer()
     pessoa_id = int(query.data.split("_")[-1])
     context.user_data["pessoa_id_to_remove"] = pessoa_id
-    db = next(get_db())
+    db = context.db
     pessoa = db_get_pessoa_by_id(db, pessoa_id)
-    db.close()
 
     if not pessoa:
         await query.edit_message_text("⚠️ Pessoa não encontrada. Pode ter sido removida.",
@@ -262,7 +308,7 @@ async def remove_pessoa_confirm_callback(update: Update, context: ContextTypes.D
     return CONFIRM_PESSOA_REMOVE
 
 # Remover Pessoa - Executar Remoção
-async def remove_pessoa_execute_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def remove_pessoa_execute_callback(update: Update, context: ContextoPaytrack) -> int:
     query = update.callback_query
     await query.answer()
     pessoa_id = int(query.data.split("_")[-1]) # confirm_remove_ID
@@ -274,12 +320,11 @@ async def remove_pessoa_execute_callback(update: Update, context: ContextTypes.D
         if "pessoa_id_to_remove" in context.user_data: del context.user_data["pessoa_id_to_remove"]
         return ConversationHandler.END
 
-    db = next(get_db())
+    db = context.db
     pessoa_removida = db_get_pessoa_by_id(db, pessoa_id) # Pega o nome antes de remover
     nome_removido = pessoa_removida.nome if pessoa_removida else "Pessoa desconhecida"
     
     sucesso = db_remove_pessoa(db, pessoa_id)
-    db.close()
 
     if sucesso:
         await query.edit_message_text(f"🗑️ Pessoa '{nome_removido}' e todos os seus dados foram removidos com sucesso.")
@@ -292,17 +337,16 @@ async def remove_pessoa_execute_callback(update: Update, context: ContextTypes.D
 
 
 # --- Transações (Empréstimos e Pagamentos) ---
-async def transaction_start(update: Update, context: ContextTypes.DEFAULT_TYPE, transaction_type: str) -> int:
+async def transaction_start(update: Update, context: ContextoPaytrack, transaction_type: str) -> int:
     """Inicia o fluxo de empréstimo ou pagamento."""
     context.user_data["transaction_type"] = transaction_type
-    db = next(get_db())
-    reply_markup = get_pessoas_keyboard(callback_prefix=f"trans_sel_p", db_session=db) # trans_sel_p_ID
-    db.close()
+    pessoas = db_get_all_pessoas(context.db)
+    reply_markup = get_pessoas_keyboard(callback_prefix="trans_sel_p", pessoas=pessoas) # trans_sel_p_ID
 
     action_verb = "um empréstimo" if transaction_type == "emprestimo" else "um pagamento"
     icon = "💸" if transaction_type == "emprestimo" else "💰"
 
-    if not reply_markup or not db_get_all_pessoas(next(get_db())):
+    if not pessoas:
         message_text = f"🚫 Nenhuma pessoa cadastrada para registrar {action_verb}.\nAdicione uma pessoa primeiro usando /pessoas."
         if update.callback_query:
             await update.callback_query.answer()
@@ -319,22 +363,21 @@ async def transaction_start(update: Update, context: ContextTypes.DEFAULT_TYPE,
         await update.message.reply_text(message_text, reply_markup=reply_markup)
     return SELECT_PESSOA_TRANSACAO
 
-async def emprestimos_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def emprestimos_command(update: Update, context: ContextoPaytrack) -> int:
     return await transaction_start(update, context, "emprestimo")
 
-async def pagamentos_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def pagamentos_command(update: Update, context: ContextoPaytrack) -> int:
     return await transaction_start(update, context, "pagamento")
 
 # Transação - Pessoa Selecionada
-async def transaction_person_selected_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def transaction_person_selected_callback(update: Update, context: ContextoPaytrack) -> int:
     query = update.callback_query
     await query.answer()
     pessoa_id = int(query.data.split("_")[-1]) # trans_sel_p_ID
     context.user_data["selected_person_id"] = pessoa_id
     
-    db = next(get_db())
+    db = context.db
     pessoa = db_get_pessoa_by_id(db, pessoa_id)
-    db.close()
 
     if not pessoa:
         await query.edit_message_text("⚠️ Pessoa não encontrada. Tente novamente.")
@@ -353,12 +396,12 @@ async def transaction_person_selected_callback(update: Update, context: ContextT
     return TYPING_TRANSACAO_DETALHES
 
 # Transação - Detalhes Recebidos (Linguagem Natural)
-async def transaction_details_received(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def transaction_details_received(update: Update, context: ContextoPaytrack) -> int:
     user_text = update.message.text
     transaction_type = context.user_data["transaction_type"]
     
     await update.message.reply_chat_action(ChatAction.TYPING) # Informa que está processando
-    extracted_data = extract_transaction_data(user_text, transaction_type)
+    extracted_data = await asyncio.to_thread(extract_transaction_data, user_text, transaction_type) # Gemini é síncrono: fora do event loop
 
     if extracted_data.get("error"):
         await update.message.reply_text(
@@ -372,20 +415,37 @@ async def transaction_details_received(update: Update, context: ContextTypes.DEF
     context.user_data["extracted_transaction_data"] = extracted_data
     
     # Preparar resumo para confirmação
-    db = next(get_db())
+    db = context.db
     pessoa = db_get_pessoa_by_id(db, context.user_data["selected_person_id"])
-    db.close()
-
+    return await _enviar_confirmacao_transacao(update, transaction_type, pessoa, extracted_data)
+
+def _descrever_cronograma(cronograma: list[tuple[DateObject, float]]) -> str:
+    """Ex: "3x de R$ 33.33 (1ª de R$ 33.34), de 28/02/2025 a 30/04/2025"."""
+    (primeiro_vencimento, primeiro_valor), (ultimo_vencimento, ultimo_valor) = cronograma[0], cronograma[-1]
+    texto = f"{len(cronograma)}x de R$ {ultimo_valor:.2f}"
+    if primeiro_valor != ultimo_valor: # Centavos que sobraram da divisão
+        texto += f" (1ª de R$ {primeiro_valor:.2f})"
+    return texto + f", de {primeiro_vencimento.strftime('%d/%m/%Y')} a {ultimo_vencimento.strftime('%d/%m/%Y')}"
+
+async def _enviar_confirmacao_transacao(update: Update, transaction_type: str, pessoa: Pessoa, extracted_data: dict) -> int:
+    """Mostra o resumo extraído com os botões Salvar/Editar/Cancelar."""
     try:
         data_obj = datetime.strptime(extracted_data['data'], "%Y-%m-%d").date()
         data_formatada = data_obj.strftime("%d/%m/%Y")
     except ValueError:
+        data_obj = None
         data_formatada = extracted_data['data'] # Mantém como string se não puder formatar
 
+    linha_parcelas = ""
+    if extracted_data.get("parcelas") and data_obj:
+        cronograma = gerar_cronograma(float(extracted_data['valor']), extracted_data["parcelas"], data_obj)
+        linha_parcelas = f"📅 *Parcelas:* {_descrever_cronograma(cronograma)}\n"
+
     resumo_msg = (
         f"📝 *Confirme os Dados do {transaction_type.capitalize()}*\n\n"
         f"👤 *Pessoa:* {pessoa.nome}\n"
         f"💰 *Valor:* R$ {float(extracted_data['valor']):.2f}\n"
+        f"{linha_parcelas}"
         f"🗓️ *Data:* {data_formatada}\n"
         f"🧾 *Descrição:* {extracted_data.get('descricao', 'N/A')}\n\n"
         "Salvar esta transação?"
@@ -399,16 +459,98 @@ async def transaction_details_received(update: Update, context: ContextTypes.DEF
     await update.message.reply_text(resumo_msg, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
     return CONFIRM_TRANSACAO
 
+# Transação - Mensagem livre (ex: "emprestei 50 pro joao ontem")
+_PADRAO_PAGAMENTO = re.compile(r"\b(pagou|pagaram|pagamento|recebi|devolveu|devolveram|quitou|acertou)\b")
+_PADRAO_EMPRESTIMO = re.compile(r"\b(emprest\w*|dei|passei|transferi|adiantei|paguei|emprestado)\b")
+_PADRAO_DIVISAO = re.compile(r"\b(racha\w*|divid[ie]\w*)\b") # "dividir", "divide"; não "dívida"
+_PADRAO_PARCELAS = re.compile(r"\b(parcela\w*|vezes|\d+ ?x)\b") # "dividido em 3 vezes" é parcelamento
+
+def detectar_tipo_transacao(texto: str) -> str | None:
+    """'pagamento', 'divisao', 'emprestimo' ou None, pelas palavras usadas na mensagem."""
+    texto_normalizado = normalizar(texto)
+    if _PADRAO_PAGAMENTO.search(texto_normalizado):
+        return "pagamento"
+    if _PADRAO_DIVISAO.search(texto_normalizado) and not _PADRAO_PARCELAS.search(texto_normalizado):
+        return "divisao"
+    if _PADRAO_EMPRESTIMO.search(texto_normalizado):
+        return "emprestimo"
+    return None
+
+async def free_text_transaction_entry(update: Update, context: ContextoPaytrack) -> int:
+    """Detecta pessoa e tipo numa mensagem livre e vai direto para a confirmação."""
+    user_text = update.message.text
+    transaction_type = detectar_tipo_transacao(user_text)
+    if transaction_type == "divisao": # Várias pessoas na mesma mensagem: vão pré-marcadas para conferência
+        encontradas = [pid for pid, _ in indice_pessoas.encontrar(user_text)]
+        return await _iniciar_divisao(update, context, texto=user_text, preselecionadas=encontradas)
+    pessoa_id, candidatas = indice_pessoas.melhor_pessoa(user_text)
+
+    if len(candidatas) > 1:
+        nomes = ", ".join(indice_pessoas.nome(pid) for pid in candidatas)
+        await update.message.reply_text(f"🤔 Encontrei mais de uma pessoa possível ({nomes}). Escreva o nome completo ou use /emprestimos ou /pagamentos.")
+        return ConversationHandler.END
+    if pessoa_id is None or transaction_type is None:
+        await update.message.reply_text(
+            "🤖 Não entendi. Escreva algo como \"emprestei 50 pro João ontem\" ou \"Maria pagou 20 hoje\", "
+            "ou use /start para ver os comandos."
+        )
+        return ConversationHandler.END
+
+    await update.message.reply_chat_action(ChatAction.TYPING)
+    extracted_data = await asyncio.to_thread(extract_transaction_data, user_text, transaction_type) # Gemini é síncrono: fora do event loop
+    if extracted_data.get("error"):
+        await update.message.reply_text(
+            f"⚠️ Erro ao processar sua mensagem com a IA:\n`{extracted_data['error']}`\n\n"
+            f"Tente novamente ou use /{'emprestimos' if transaction_type == 'emprestimo' else 'pagamentos'}.",
+            parse_mode=ParseMode.MARKDOWN
+        )
+        return ConversationHandler.END
+
+    db = context.db
+    pessoa = db_get_pessoa_by_id(db, pessoa_id)
+    if not pessoa: # Removida entre a montagem do índice e agora
+        indice_pessoas.invalidar()
+        await update.message.reply_text("⚠️ Pessoa não encontrada. Tente novamente.")
+        return ConversationHandler.END
+
+    context.user_data["transaction_type"] = transaction_type
+    context.user_data["selected_person_id"] = pessoa_id
+    context.user_data["extracted_transaction_data"] = extracted_data
+    return await _enviar_confirmacao_transacao(update, transaction_type, pessoa, extracted_data)
+
+def _chave_idempotencia(query) -> str:
+    """
+    A mensagem de confirmação identifica a transação: toques repetidos em "Salvar"
+    e reentregas do mesmo update geram a mesma chave.
+    """
+    if query.message:
+        return f"tg:{query.message.chat_id}:{query.message.message_id}"
+    return f"tg:inline:{query.inline_message_id}"
+
+def _mensagem_transacao_salva(transacao: Emprestimo | Pagamento | EmprestimoArquivado | PagamentoArquivado) -> str:
+    if isinstance(transacao, (Emprestimo, EmprestimoArquivado)):
+        icon, transaction_type = "💸", "emprestimo"
+    else:
+        icon, transaction_type = "💰", "pagamento"
+    return f"{icon} {transaction_type.capitalize()} para *{transacao.pessoa.nome}* salvo com sucesso!"
+
 # Transação - Confirmação para Salvar
-async def transaction_confirm_save_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def transaction_confirm_save_callback(update: Update, context: ContextoPaytrack) -> int:
     query = update.callback_query
     await query.answer()
     
     extracted_data = context.user_data.get("extracted_transaction_data")
     pessoa_id = context.user_data.get("selected_person_id")
     transaction_type = context.user_data.get("transaction_type")
+    chave = _chave_idempotencia(query)
 
     if not all([extracted_data, pessoa_id is not None, transaction_type]):
+        # Conversa já encerrada: se essa confirmação já foi salva, é um toque repetido
+        # ou uma reentrega do update, e a resposta é a mesma da primeira vez
+        original = db_get_transacao_por_chave(context.db, chave)
+        if original:
+            await query.edit_message_text(_mensagem_transacao_salva(original), parse_mode=ParseMode.MARKDOWN)
+            return ConversationHandler.END
         await query.edit_message_text("⚠️ Erro: Dados da transação perdidos. Tente novamente.")
         # Limpar dados da conversa mesmo em caso de erro antes de sair
         keys_to_clear = ['transaction_type', 'selected_person_id', 'extracted_transaction_data']
@@ -417,17 +559,15 @@ async def transaction_confirm_save_callback(update: Update, context: ContextType
                 del context.user_data[key]
         return ConversationHandler.END
 
-    db = next(get_db())
+    db = context.db
     try:
         if transaction_type == "emprestimo":
-            db_add_emprestimo(db, pessoa_id, float(extracted_data['valor']), extracted_data['data'], extracted_data.get('descricao'))
-            icon = "💸"
+            transacao = db_add_emprestimo(db, pessoa_id, float(extracted_data['valor']), extracted_data['data'], extracted_data.get('descricao'), chave,
+                                          parcelas=extracted_data.get('parcelas', 1))
         elif transaction_type == "pagamento":
-            db_add_pagamento(db, pessoa_id, float(extracted_data['valor']), extracted_data['data'], extracted_data.get('descricao'))
-            icon = "💰"
+            transacao = db_add_pagamento(db, pessoa_id, float(extracted_data['valor']), extracted_data['data'], extracted_data.get('descricao'), chave)
         else:
             await query.edit_message_text("⚠️ Tipo de transação desconhecido.")
-            db.close()
             # Limpar dados da conversa
             keys_to_clear = ['transaction_type', 'selected_person_id', 'extracted_transaction_data']
             for key in keys_to_clear:
@@ -435,8 +575,7 @@ async def transaction_confirm_save_callback(update: Update, context: ContextType
                     del context.user_data[key]
             return ConversationHandler.END
         
-        pessoa = db_get_pessoa_by_id(db, pessoa_id) # Para pegar o nome
-        await query.edit_message_text(f"{icon} {transaction_type.capitalize()} para *{pessoa.nome}* salvo com sucesso!", parse_mode=ParseMode.MARKDOWN)
+        await query.edit_message_text(_mensagem_transacao_salva(transacao), parse_mode=ParseMode.MARKDOWN)
         
         # Limpar dados da conversa ANTES de chamar o main_menu
         keys_to_clear = ['transaction_type', 'selected_person_id', 'extracted_transaction_data']
@@ -470,8 +609,6 @@ async def transaction_confirm_save_callback(update: Update, context: ContextType
             if key in context.user_data:
                 del context.user_data[key]
         return ConversationHandler.END # Encerra a conversa aqui em caso de erro genérico
-    finally:
-        db.close()
 
     # Se o fluxo chegar aqui por algum motivo inesperado (não deveria com o return await main_menu_callback),
     # certifique-se de limpar e encerrar.
@@ -482,14 +619,13 @@ async def transaction_confirm_save_callback(update: Update, context: ContextType
     # return ConversationHandler.END
 
 # Transação - Editar Novamente
-async def transaction_edit_again_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def transaction_edit_again_callback(update: Update, context: ContextoPaytrack) -> int:
     query = update.callback_query
     await query.answer()
     
     transaction_type = context.user_data["transaction_type"]
-    db = next(get_db())
+    db = context.db
     pessoa = db_get_pessoa_by_id(db, context.user_data["selected_person_id"])
-    db.close()
 
     action_verb = "empréstimo" if transaction_type == "emprestimo" else "pagamento"
     icon = "💸" if transaction_type == "emprestimo" else "💰"
@@ -505,13 +641,200 @@ async def transaction_edit_again_callback(update: Update, context: ContextTypes.
     return TYPING_TRANSACAO_DETALHES
 
 
+# --- Despesa Dividida (/dividir) ---
+async def dividir_command(update: Update, context: ContextoPaytrack) -> int:
+    return await _iniciar_divisao(update, context)
+
+async def _iniciar_divisao(update: Update, context: ContextoPaytrack, texto: str | None = None,
+                           preselecionadas: list[int] = ()) -> int:
+    """
+    Mostra o teclado de seleção múltipla. Vindo de uma mensagem livre, o texto fica
+    guardado e as pessoas citadas nele já aparecem marcadas.
+    """
+    pessoas = db_get_all_pessoas(context.db)
+    if not pessoas:
+        message_text = "🚫 Nenhuma pessoa cadastrada. Adicione pessoas primeiro usando /pessoas."
+        if update.callback_query:
+            await update.callback_query.answer()
+            await update.callback_query.edit_message_text(message_text)
+        else:
+            await update.message.reply_text(message_text)
+        return ConversationHandler.END
+
+    ids = {p.id for p in pessoas}
+    selecionadas = [pid for pid in preselecionadas if pid in ids]
+    context.user_data["divisao_pessoa_ids"] = selecionadas
+    context.user_data.pop("divisao_dados", None)
+    if texto:
+        context.user_data["divisao_texto"] = texto
+    else:
+        context.user_data.pop("divisao_texto", None)
+
+    message_text = ("🧮 Confira as pessoas encontradas na mensagem e ajuste se precisar:" if selecionadas
+                    else "🧮 Selecione quem vai dividir a despesa (toque para marcar ou desmarcar):")
+    reply_markup = get_pessoas_multiselect_keyboard(pessoas, set(selecionadas))
+    if update.callback_query:
+        await update.callback_query.answer()
+        await update.callback_query.edit_message_text(message_text, reply_markup=reply_markup)
+    else:
+        await update.message.reply_text(message_text, reply_markup=reply_markup)
+    return SELECT_PESSOAS_DIVISAO
+
+async def divisao_toggle_pessoa_callback(update: Update, context: ContextoPaytrack) -> int:
+    query = update.callback_query
+    await query.answer()
+    pessoa_id = int(query.data.split("_")[-1]) # div_tog_p_ID
+    selecionadas = context.user_data.setdefault("divisao_pessoa_ids", [])
+    if pessoa_id in selecionadas:
+        selecionadas.remove(pessoa_id)
+    else:
+        selecionadas.append(pessoa_id)
+    await query.edit_message_reply_markup(get_pessoas_multiselect_keyboard(db_get_all_pessoas(context.db), set(selecionadas)))
+    return SELECT_PESSOAS_DIVISAO
+
+async def divisao_alterar_pessoas_callback(update: Update, context: ContextoPaytrack) -> int:
+    """Volta da confirmação para o teclado, mantendo as pessoas e o texto da despesa."""
+    query = update.callback_query
+    await query.answer()
+    context.user_data.pop("divisao_dados", None)
+    selecionadas = set(context.user_data.get("divisao_pessoa_ids", []))
+    await query.edit_message_text("🧮 Ajuste quem vai dividir a despesa:",
+                                  reply_markup=get_pessoas_multiselect_keyboard(db_get_all_pessoas(context.db), selecionadas))
+    return SELECT_PESSOAS_DIVISAO
+
+def _pessoas_selecionadas(context: ContextoPaytrack) -> list[tuple[int, str]]:
+    """(id, nome) das pessoas marcadas, na ordem em que foram marcadas."""
+    nomes = {p.id: p.nome for p in db_get_all_pessoas(context.db)}
+    return [(pid, nomes[pid]) for pid in context.user_data.get("divisao_pessoa_ids", []) if pid in nomes]
+
+async def divisao_continuar_callback(update: Update, context: ContextoPaytrack) -> int:
+    query = update.callback_query
+    pessoas = _pessoas_selecionadas(context)
+    if not pessoas:
+        await query.answer("Selecione ao menos uma pessoa.", show_alert=True)
+        return SELECT_PESSOAS_DIVISAO
+    await query.answer()
+
+    texto = context.user_data.get("divisao_texto")
+    if texto: # Veio de uma mensagem livre: a despesa já está descrita
+        await query.edit_message_text(f"🧮 Dividindo entre {', '.join(nome for _, nome in pessoas)}...")
+        return await _processar_divisao(update, context, texto)
+
+    await query.edit_message_text(
+        f"🧮 Dividindo entre *{', '.join(nome for _, nome in pessoas)}*.\n\n"
+        "Descreva a despesa em linguagem natural. Exemplos:\n"
+        "`racha 240 do churrasco`\n"
+        "`pizza de 90 ontem dividida comigo`\n"
+        "`jantar 200, João fica com 80 e o resto divide igual`",
+        parse_mode=ParseMode.MARKDOWN
+    )
+    return TYPING_DIVISAO_DETALHES
+
+async def divisao_details_received(update: Update, context: ContextoPaytrack) -> int:
+    context.user_data["divisao_texto"] = update.message.text
+    return await _processar_divisao(update, context, update.message.text)
+
+async def _processar_divisao(update: Update, context: ContextoPaytrack, texto: str) -> int:
+    """Uma chamada à IA para a despesa inteira, cálculo das partes e a tela de confirmação única."""
+    mensagem = update.effective_message
+    pessoas = _pessoas_selecionadas(context)
+    if not pessoas:
+        await mensagem.reply_text("⚠️ Nenhuma das pessoas selecionadas existe mais. Use /dividir novamente.")
+        _limpar_dados_conversa(context.user_data)
+        return ConversationHandler.END
+
+    await mensagem.reply_chat_action(ChatAction.TYPING)
+    dados = await asyncio.to_thread(extract_split_data, texto, [nome for _, nome in pessoas])
+    try:
+        if dados.get("error"):
+            raise ValueError(f"Erro ao processar sua mensagem com a IA: {dados['error']}")
+        divisao = calcular_partes(dados["valor_total"], pessoas, dados["partes"], dados["inclui_usuario"])
+    except ValueError as e:
+        context.user_data.pop("divisao_texto", None)
+        await mensagem.reply_text(f"⚠️ {e}\n\nDescreva a despesa novamente, por exemplo: \"racha 240 do churrasco\".")
+        return TYPING_DIVISAO_DETALHES
+
+    context.user_data["divisao_dados"] = {
+        "partes": divisao.partes, "parte_usuario": divisao.parte_usuario, "total": divisao.total,
+        "data": dados["data"], "descricao": dados["descricao"],
+    }
+    nomes = dict(pessoas)
+    data_formatada = datetime.strptime(dados["data"], "%Y-%m-%d").strftime("%d/%m/%Y")
+    resumo_msg = (
+        "🧮 *Confirme a Divisão*\n\n"
+        f"🧾 *Descrição:* {dados['descricao']}\n"
+        f"🗓️ *Data:* {data_formatada}\n"
+        f"💰 *Total:* R$ {divisao.total:.2f}\n\n"
+    )
+    resumo_msg += "".join(f"👤 {nomes[pid]}: R$ {valor:.2f}\n" for pid, valor in divisao.partes)
+    if divisao.parte_usuario:
+        resumo_msg += f"🙋 Sua parte: R$ {divisao.parte_usuario:.2f}\n"
+    resumo_msg += f"\nSalvar {len(divisao.partes)} empréstimo(s)?"
+    keyboard = [
+        [InlineKeyboardButton("✅ Salvar", callback_data="div_salvar")],
+        [InlineKeyboardButton("✏️ Editar Novamente", callback_data="div_editar")],
+        [InlineKeyboardButton("👥 Alterar Pessoas", callback_data="div_pessoas")],
+        [InlineKeyboardButton("❌ Cancelar", callback_data="cancel_operation")]
+    ]
+    await mensagem.reply_text(resumo_msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
+    return CONFIRM_DIVISAO
+
+async def divisao_edit_again_callback(update: Update, context: ContextoPaytrack) -> int:
+    query = update.callback_query
+    await query.answer()
+    context.user_data.pop("divisao_dados", None)
+    context.user_data.pop("divisao_texto", None)
+    await query.edit_message_text("🧮 Descreva a despesa novamente em linguagem natural:")
+    return TYPING_DIVISAO_DETALHES
+
+def _mensagem_divisao_salva(db, emprestimos: list[Emprestimo]) -> str:
+    nomes = {p.id: p.nome for p in db_get_all_pessoas(db)} # Uma consulta em vez de uma por empréstimo
+    total = sum(e.valor for e in emprestimos)
+    linhas = "".join(f"\n- *{nomes.get(e.pessoa_id, '?')}*: R$ {e.valor:.2f}" for e in emprestimos)
+    return f"🧮 Divisão salva: {len(emprestimos)} empréstimo(s), total R$ {total:.2f}.{linhas}"
+
+async def divisao_confirm_save_callback(update: Update, context: ContextoPaytrack) -> int:
+    query = update.callback_query
+    await query.answer()
+    dados = context.user_data.get("divisao_dados")
+    chave = _chave_idempotencia(query)
+    db = context.db
+
+    if not dados:
+        # Como em transaction_confirm_save_callback: toque repetido depois de salvar responde igual
+        originais = db_get_divisao_por_chave(db, chave)
+        if originais:
+            await query.edit_message_text(_mensagem_divisao_salva(db, originais), parse_mode=ParseMode.MARKDOWN)
+        else:
+            await query.edit_message_text("⚠️ Erro: Dados da divisão perdidos. Use /dividir novamente.")
+        _limpar_dados_conversa(context.user_data)
+        return ConversationHandler.END
+
+    try:
+        emprestimos = db_add_emprestimos_divididos(db, [tuple(parte) for parte in dados["partes"]], dados["data"], dados["descricao"], chave)
+    except ValueError as ve:
+        logger.error(f"Erro ao salvar divisão no DB (ValueError): {ve}")
+        await query.edit_message_text(f"⚠️ Erro ao salvar: {str(ve)}. Verifique os dados e tente novamente.")
+        _limpar_dados_conversa(context.user_data)
+        return ConversationHandler.END
+    except Exception as e:
+        logger.error(f"Erro genérico ao salvar divisão no DB: {e}")
+        await query.edit_message_text("⚠️ Ocorreu um erro inesperado ao salvar a divisão. Nada foi gravado; tente novamente mais tarde.")
+        _limpar_dados_conversa(context.user_data)
+        return ConversationHandler.END
+
+    await query.edit_message_text(_mensagem_divisao_salva(db, emprestimos), parse_mode=ParseMode.MARKDOWN)
+    _limpar_dados_conversa(context.user_data)
+    await asyncio.sleep(2) # Pausa curta para o usuário ler, como nas transações individuais
+    return await main_menu_callback(update, context)
+
+
 # --- Comando /status ---
-async def status_command_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    db = next(get_db())
-    reply_markup = get_pessoas_keyboard(callback_prefix="status_sel_p", db_session=db)
-    db.close()
+async def status_command_start(update: Update, context: ContextoPaytrack) -> int:
+    pessoas = db_get_all_pessoas(context.db)
+    reply_markup = get_pessoas_keyboard(callback_prefix="status_sel_p", pessoas=pessoas)
 
-    if not reply_markup or not db_get_all_pessoas(next(get_db())) :
+    if not pessoas:
         message_text = "🚫 Nenhuma pessoa cadastrada para ver o status.\nAdicione uma pessoa primeiro usando /pessoas."
         if update.callback_query: # Se vindo de um menu de refresh
             await update.callback_query.answer()
@@ -528,33 +851,47 @@ async def status_command_start(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text(message_text, reply_markup=reply_markup)
     return SELECT_PESSOA_STATUS
 
-async def status_person_selected_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def status_person_selected_callback(update: Update, context: ContextoPaytrack) -> int:
     query = update.callback_query
     await query.answer()
-    pessoa_id = int(query.data.split("_")[-1]) # status_sel_p_ID
+    pessoa_id = int(query.data.split("_")[-1]) # status_sel_p_ID, ou status_arq_p_ID com os arquivados
+    incluir_arquivados = query.data.startswith("status_arq_p_")
 
-    db = next(get_db())
+    db = context.db
     pessoa = db_get_pessoa_by_id(db, pessoa_id)
     if not pessoa:
         await query.edit_message_text("⚠️ Pessoa não encontrada.",
                                       reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Tentar Novamente", callback_data="status_refresh")]]))
-        db.close()
         return SELECT_PESSOA_STATUS # Volta para seleção
 
 
-    emprestimos, pagamentos = db_get_transacoes_pessoa(db, pessoa_id)
-    db.close()
+    emprestimos, pagamentos = db_get_transacoes_pessoa(db, pessoa_id, incluir_arquivados=incluir_arquivados)
+    arquivadas, total_arquivado, fim_arquivado = db_get_resumo_arquivado(db, pessoa_id)
+    resumo_parcelas = db_get_resumo_parcelas(db, [e.id for e in emprestimos if isinstance(e, Emprestimo)])
 
     message_text = f"📊 *Status Financeiro de {pessoa.nome}*\n\n"
     total_emprestimos = sum(e.valor for e in emprestimos)
     total_pagamentos = sum(p.valor for p in pagamentos)
+    if arquivadas and not incluir_arquivados: # Os totais contam os períodos arquivados mesmo sem listá-los
+        total_emprestimos += total_arquivado
+        total_pagamentos += total_arquivado
+        message_text += (f"📦 _{arquivadas} transações quitadas até {fim_arquivado.strftime('%d/%m/%Y')} "
+                         f"estão arquivadas (R$ {total_arquivado:.2f} emprestados e pagos)._\n\n")
     saldo_devedor = total_emprestimos - total_pagamentos
 
     message_text += "💸 *EMPRÉSTIMOS CONCEDIDOS:*\n"
     if emprestimos:
         for e in sorted(emprestimos, key=lambda x: x.data): # Ordenar por data
             data_fmt = e.data.strftime('%d/%m/%Y') if isinstance(e.data, DateObject) else e.data
-            message_text += f"- R$ {e.valor:.2f} em {data_fmt} ({e.descricao or 'Sem descrição'})\n"
+            message_text += f"- R$ {e.valor:.2f} em {data_fmt} ({e.descricao or 'Sem descrição'})"
+            if e.valor_em_aberto:
+                message_text += f" — em aberto: R$ {e.valor_em_aberto:.2f}"
+            if isinstance(e, Emprestimo) and e.id in resumo_parcelas:
+                pagas, total, proximo = resumo_parcelas[e.id]
+                message_text += f" — parcelas: {pagas}/{total} pagas"
+                if proximo:
+                    message_text += f", próxima em {proximo.strftime('%d/%m/%Y')}"
+            message_text += "\n"
     else:
         message_text += "_Nenhum empréstimo registrado._\n"
     message_text += f"*Total Emprestado:* R$ {total_emprestimos:.2f}\n\n"
@@ -580,6 +917,8 @@ async def status_person_selected_callback(update: Update, context: ContextTypes.
 
     keyboard = [[InlineKeyboardButton("↩️ Ver status de outra pessoa", callback_data="status_refresh")],
                 [InlineKeyboardButton("🏠 Voltar ao Menu Principal", callback_data="main_menu")]]
+    if arquivadas and not incluir_arquivados:
+        keyboard.insert(0, [InlineKeyboardButton("📦 Incluir arquivados", callback_data=f"status_arq_p_{pessoa_id}")])
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     # Verifica se a mensagem é muito longa para o Telegram
@@ -595,19 +934,414 @@ async def status_person_selected_callback(update: Update, context: ContextTypes.
     return SELECT_PESSOA_STATUS # Permite selecionar outra pessoa ou voltar ao menu
 
 
+# --- Backups ---
+BANCO_SQLITE = caminho_banco_sqlite(DATABASE_URL) # None fora do SQLite: sem backups online
+LIMITE_DOCUMENTO_BYTES = 50 * 1024 * 1024 # Limite de upload da Bot API
+
+async def backup_job(context: ContextoPaytrack) -> None:
+    """Snapshot periódico; a cópia em passos roda numa thread, sem travar o bot nem as escritas."""
+    try:
+        await asyncio.to_thread(criar_snapshot, BANCO_SQLITE)
+    except Exception as e:
+        logger.error(f"Falha no backup agendado: {e}")
+
+async def backup_command(update: Update, context: ContextoPaytrack) -> None:
+    """Gera um snapshot (se o banco mudou) e envia o mais recente ao administrador."""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("🚫 Comando disponível apenas para administradores.")
+        return
+    if BANCO_SQLITE is None:
+        await update.message.reply_text("ℹ️ Backups online só estão disponíveis com SQLite.")
+        return
+
+    await update.message.reply_chat_action(ChatAction.UPLOAD_DOCUMENT)
+    try:
+        caminho, novo = await asyncio.to_thread(criar_snapshot, BANCO_SQLITE)
+    except Exception as e:
+        logger.error(f"Falha no backup pelo /backup: {e}")
+        await update.message.reply_text("⚠️ Não foi possível gerar o backup. Veja os logs.")
+        return
+
+    nome = os.path.basename(caminho)
+    if os.path.getsize(caminho) > LIMITE_DOCUMENTO_BYTES:
+        await update.message.reply_text(f"📦 Backup {nome} gerado, mas é grande demais para o Telegram. Está em {caminho}.")
+        return
+    legenda = "📦 Backup novo." if novo else "📦 Sem alterações desde o último backup."
+    with open(caminho, "rb") as arquivo:
+        await update.message.reply_document(arquivo, filename=nome, caption=legenda)
+
+
+# --- Arquivamento ---
+def _arquivar_periodos_quitados() -> dict[int, int]:
+    with SessionLocal() as db: # Sessão própria: roda fora da thread do event loop
+        return db_arquivar_periodos_quitados(db)
+
+async def arquivamento_job(context: ContextoPaytrack) -> None:
+    """Move os períodos quitados para o arquivo, mantendo as tabelas quentes pequenas."""
+    try:
+        arquivadas = await asyncio.to_thread(_arquivar_periodos_quitados)
+    except Exception as e:
+        logger.error(f"Falha no arquivamento: {e}")
+        return
+    if arquivadas:
+        logger.info(f"Arquivamento: {sum(arquivadas.values())} transações de {len(arquivadas)} pessoa(s).")
+
+
+# --- Lembretes de parcelas ---
+PAYTRACK_TIMEZONE = ZoneInfo(os.getenv("PAYTRACK_TIMEZONE", "America/Sao_Paulo"))
+INSTALLMENT_REMINDER_HOUR = int(os.getenv("INSTALLMENT_REMINDER_HOUR", "9"))
+LEMBRETES_POR_MENSAGEM = 30
+
+def _parcelas_a_lembrar(hoje: DateObject) -> list[tuple[int, str]]:
+    """(id da parcela, linha da mensagem) das parcelas vencidas e ainda sem lembrete."""
+    with SessionLocal() as db: # Sessão própria: roda fora da thread do event loop
+        return [
+            (parcela.id, f"- {nome}: parcela {parcela.numero} ({descricao or 'Sem descrição'}), "
+                         f"R$ {parcela.valor - parcela.valor_pago:.2f}, venc. {parcela.vencimento.strftime('%d/%m/%Y')}")
+            for parcela, descricao, nome in db_get_parcelas_a_lembrar(db, hoje)
+        ]
+
+def _marcar_lembretes_enviados(parcela_ids: list[int], hoje: DateObject) -> None:
+    with SessionLocal() as db:
+        db_marcar_lembretes_enviados(db, parcela_ids, hoje)
+
+async def parcelas_job(context: ContextoPaytrack) -> None:
+    """
+    Avisa os administradores das parcelas que venceram até hoje e continuam em
+    aberto. Cada parcela gera um lembrete só; as que ficaram para trás (bot fora
+    do ar, sem administradores) entram no próximo.
+    """
+    hoje = datetime.now(PAYTRACK_TIMEZONE).date()
+    try:
+        pendentes = await asyncio.to_thread(_parcelas_a_lembrar, hoje)
+    except Exception as e:
+        logger.error(f"Falha ao buscar parcelas vencidas: {e}")
+        return
+    if not pendentes:
+        return
+    if not ADMIN_USER_IDS:
+        logger.warning(f"{len(pendentes)} parcela(s) vencida(s), mas ADMIN_USER_IDS não está definido para receber o lembrete.")
+        return
+
+    linhas = [linha for _, linha in pendentes]
+    for inicio in range(0, len(linhas), LEMBRETES_POR_MENSAGEM):
+        texto = "📅 Parcelas vencidas:\n" + "\n".join(linhas[inicio:inicio + LEMBRETES_POR_MENSAGEM])
+        for admin_id in ADMIN_USER_IDS:
+            await context.bot.send_message(admin_id, texto, rate_limit_args={"prioridade": PRIORIDADE_SEGUNDO_PLANO})
+    await asyncio.to_thread(_marcar_lembretes_enviados, [parcela_id for parcela_id, _ in pendentes], hoje)
+    logger.info(f"Lembretes: {len(pendentes)} parcela(s) vencida(s) avisada(s).")
+
+
+# --- Comando /envelhecimento ---
+async def envelhecimento_command(update: Update, context: ContextoPaytrack) -> None:
+    """Relatório de idade da dívida em aberto (0-30, 31-90, 91-180, 180+ dias)."""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("🚫 Comando disponível apenas para administradores.")
+        return
+    db = context.db
+    colunas = db_get_colunas_envelhecimento(db)
+    nomes = {p.id: p.nome for p in db_get_all_pessoas(db)}
+
+    relatorio = calcular_envelhecimento(*colunas)
+
+    if relatorio.pessoa_ids.size == 0:
+        await update.message.reply_text("⏳ Nenhuma dívida em aberto. Tudo quitado!")
+        return
+
+    cabecalho = f"{'Pessoa':<12}" + "".join(f"{f:>10}" for f in FAIXAS_ENVELHECIMENTO)
+    linhas = [cabecalho, "-" * len(cabecalho)]
+    for pessoa_id, faixas in zip(relatorio.pessoa_ids.tolist(), relatorio.por_pessoa.tolist()):
+        nome = nomes.get(pessoa_id, f"#{pessoa_id}")[:12]
+        linhas.append(f"{nome:<12}" + "".join(f"{v:>10.2f}" for v in faixas))
+    linhas.append("-" * len(cabecalho))
+    linhas.append(f"{'TOTAL':<12}" + "".join(f"{v:>10.2f}" for v in relatorio.total.tolist()))
+
+    message_text = "⏳ *Envelhecimento da Dívida (dias)*\n\n```\n" + "\n".join(linhas) + "\n```"
+    if len(message_text) > 4096:
+        message_text = ("⏳ *Envelhecimento da Dívida (dias)*\n\n```\n" + "\n".join([cabecalho, linhas[-1]]) + "\n```\n"
+                        "_Muitas pessoas para listar; mostrando só o total._")
+    await update.message.reply_text(message_text, parse_mode=ParseMode.MARKDOWN)
+
+
+# --- Comando /extrato ---
+def parse_periodo(texto: str) -> tuple[DateObject, DateObject] | None:
+    """
+    Interpreta um período: '01/01/2025 a 31/03/2025', '01/05/2025 até hoje',
+    '05/2025' (mês inteiro) ou uma data só (daquela data até hoje).
+    """
+    texto = texto.strip().lower()
+    mes = re.fullmatch(r"(\d{1,2})[/-](\d{4})", texto)
+    if mes:
+        numero_mes, ano = int(mes.group(1)), int(mes.group(2))
+        if not 1 <= numero_mes <= 12:
+            return None
+        ultimo_dia = calendar.monthrange(ano, numero_mes)[1]
+        return DateObject(ano, numero_mes, 1), DateObject(ano, numero_mes, ultimo_dia)
+
+    partes = re.split(r"\s+(?:a|até|ate)\s+|\s+-\s+", texto)
+    if len(partes) == 1:
+        partes.append("hoje")
+    if len(partes) != 2:
+        return None
+    datas = [normalize_date_string(parte.strip()) for parte in partes]
+    if not all(datas):
+        return None
+    inicio, fim = (datetime.strptime(d, "%Y-%m-%d").date() for d in datas)
+    return (inicio, fim) if inicio <= fim else (fim, inicio)
+
+async def extrato_command_start(update: Update, context: ContextoPaytrack) -> int:
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("🚫 Comando disponível apenas para administradores.")
+        return ConversationHandler.END
+    pessoas = db_get_all_pessoas(context.db)
+    reply_markup = get_pessoas_keyboard(callback_prefix="extrato_sel_p", pessoas=pessoas)
+
+    if not pessoas:
+        await update.message.reply_text("🚫 Nenhuma pessoa cadastrada para gerar extrato.\nAdicione uma pessoa primeiro usando /pessoas.")
+        return ConversationHandler.END
+
+    await update.message.reply_text("🧾 Selecione a pessoa para o extrato:", reply_markup=reply_markup)
+    return SELECT_PESSOA_EXTRATO
+
+async def extrato_person_selected_callback(update: Update, context: ContextoPaytrack) -> int:
+    query = update.callback_query
+    if update.effective_user.id not in ADMIN_USER_IDS: # callback_data pode vir de qualquer cliente, não só do teclado enviado
+        await query.answer("🚫 Disponível apenas para administradores.", show_alert=True)
+        return ConversationHandler.END
+    await query.answer()
+    pessoa_id = int(query.data.split("_")[-1]) # extrato_sel_p_ID
+    db = context.db
+    pessoa = db_get_pessoa_by_id(db, pessoa_id)
+
+    if not pessoa:
+        await query.edit_message_text("⚠️ Pessoa não encontrada. Use /extrato novamente.")
+        return ConversationHandler.END
+
+    context.user_data["extrato_pessoa_id"] = pessoa_id
+    await query.edit_message_text(
+        f"🧾 Extrato de *{pessoa.nome}*.\n\n"
+        "Digite o período. Exemplos:\n"
+        "`01/01/2025 a 31/03/2025`\n`05/2025`\n`01/05/2025 até hoje`",
+        parse_mode=ParseMode.MARKDOWN
+    )
+    return TYPING_EXTRATO_PERIODO
+
+async def extrato_period_received(update: Update, context: ContextoPaytrack) -> int:
+    periodo = parse_periodo(update.message.text)
+    if not periodo:
+        await update.message.reply_text("⚠️ Período inválido. Tente algo como `01/01/2025 a 31/03/2025`.", parse_mode=ParseMode.MARKDOWN)
+        return TYPING_EXTRATO_PERIODO
+    inicio, fim = periodo
+    pessoa_id = context.user_data.pop("extrato_pessoa_id", None)
+
+    db = context.db
+    pessoa = db_get_pessoa_by_id(db, pessoa_id) if pessoa_id else None
+    if not pessoa:
+        await update.message.reply_text("⚠️ Pessoa não encontrada. Use /extrato novamente.")
+        return ConversationHandler.END
+    saldo_inicial, emprestimos, pagamentos = db_get_extrato_pessoa(db, pessoa_id, inicio, fim)
+
+    # Movimentos em ordem cronológica: (data, id, sinal, transação)
+    movimentos = sorted(
+        [(e.data, 0, e.id, e) for e in emprestimos] + [(p_obj.data, 1, p_obj.id, p_obj) for p_obj in pagamentos],
+        key=lambda m: m[:3]
+    )
+    saldo = saldo_inicial
+    message_text = (
+        f"🧾 *Extrato de {pessoa.nome}*\n"
+        f"_{inicio.strftime('%d/%m/%Y')} a {fim.strftime('%d/%m/%Y')}_\n\n"
+        f"*Saldo inicial:* R$ {saldo_inicial:.2f}\n\n"
+    )
+    if not movimentos:
+        message_text += "_Nenhuma movimentação no período._\n"
+    for data_mov, tipo, _, t in movimentos:
+        if tipo == 0:
+            saldo += t.valor
+            message_text += f"💸 {data_mov.strftime('%d/%m/%Y')} +R$ {t.valor:.2f} ({t.descricao or 'Sem descrição'})\n"
+        else:
+            saldo -= t.valor
+            message_text += f"💰 {data_mov.strftime('%d/%m/%Y')} -R$ {t.valor:.2f} ({t.descricao or 'Sem descrição'})\n"
+    message_text += f"\n*Emprestado no período:* R$ {sum(e.valor for e in emprestimos):.2f}\n"
+    message_text += f"*Pago no período:* R$ {sum(p_obj.valor for p_obj in pagamentos):.2f}\n"
+    message_text += f"*Saldo final:* R$ {saldo:.2f}"
+
+    if len(message_text) > 4096:
+        message_text = (f"🧾 Extrato de {pessoa.nome} ({inicio.strftime('%d/%m/%Y')} a {fim.strftime('%d/%m/%Y')})\n"
+                        f"Período com {len(movimentos)} movimentações; mostrando um resumo:\n"
+                        f"Saldo inicial: R$ {saldo_inicial:.2f}\n"
+                        f"Emprestado no período: R$ {sum(e.valor for e in emprestimos):.2f}\n"
+                        f"Pago no período: R$ {sum(p_obj.valor for p_obj in pagamentos):.2f}\n"
+                        f"Saldo final: R$ {saldo:.2f}")
+        await update.message.reply_text(message_text)
+    else:
+        await update.message.reply_text(message_text, parse_mode=ParseMode.MARKDOWN)
+    return ConversationHandler.END
+
+
+# --- Comando /grafico ---
+async def grafico_command(update: Update, context: ContextoPaytrack) -> None:
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("🚫 Comando disponível apenas para administradores.")
+        return
+    db = context.db
+    pessoas = db_get_all_pessoas(db)
+    keyboard = [[InlineKeyboardButton("🌐 Saldo geral", callback_data="grafico_sel_geral")]]
+    keyboard += [[InlineKeyboardButton(p.nome, callback_data=f"grafico_sel_p_{p.id}")] for p in pessoas]
+    await update.message.reply_text("📈 De quem você quer ver a evolução do saldo?", reply_markup=InlineKeyboardMarkup(keyboard))
+
+async def grafico_selected_callback(update: Update, context: ContextoPaytrack) -> None:
+    query = update.callback_query
+    if update.effective_user.id not in ADMIN_USER_IDS: # callback_data pode vir de qualquer cliente, não só do teclado enviado
+        await query.answer("🚫 Disponível apenas para administradores.", show_alert=True)
+        return
+    await query.answer()
+    pessoa_id = None if query.data == "grafico_sel_geral" else int(query.data.split("_")[-1]) # grafico_sel_p_ID
+
+    db = context.db
+    if pessoa_id is None:
+        titulo = "Saldo geral a receber"
+    else:
+        pessoa = db_get_pessoa_by_id(db, pessoa_id)
+        if not pessoa:
+            await query.edit_message_text("⚠️ Pessoa não encontrada.")
+            return
+        titulo = f"Saldo de {pessoa.nome}"
+    serie = db_get_serie_saldo(db, pessoa_id)
+
+    if not serie:
+        await query.edit_message_text("📈 Ainda não há movimentações para desenhar o gráfico.")
+        return
+
+    await query.edit_message_text(f"📈 Gerando gráfico: {titulo}...")
+    await query.message.reply_chat_action(ChatAction.UPLOAD_PHOTO)
+    png = await gerar_grafico_saldo(pessoa_id or "geral", titulo, serie)
+    await query.message.reply_photo(photo=png, caption=f"📈 {titulo} (R$ {serie[-1][1]:.2f} no último mês com movimento)")
+
+
+# --- Comando /buscar ---
+RESULTADOS_POR_PAGINA_BUSCA = 10
+
+async def _enviar_pagina_busca(update: Update, context: ContextoPaytrack, pagina: int) -> None:
+    consulta = context.user_data.get("busca_consulta")
+    db = context.db
+    resultados, total = db_buscar_transacoes(db, consulta, limite=RESULTADOS_POR_PAGINA_BUSCA,
+                                             deslocamento=pagina * RESULTADOS_POR_PAGINA_BUSCA)
+    # Consulta e descrições são texto livre: '_' ou '*' quebrariam o Markdown da mensagem
+    message_text = f"🔎 *Busca:* {escape_markdown(consulta)}\n\n"
+    if not resultados:
+        message_text += "_Nenhuma transação encontrada._"
+    else:
+        for t in resultados:
+            icon = "💸" if isinstance(t, (Emprestimo, EmprestimoArquivado)) else "💰"
+            descricao = escape_markdown(t.descricao) if t.descricao else "Sem descrição"
+            message_text += f"{icon} {t.data.strftime('%d/%m/%Y')} - {escape_markdown(t.pessoa.nome)}: R$ {t.valor:.2f} ({descricao})"
+            if isinstance(t, (EmprestimoArquivado, PagamentoArquivado)):
+                message_text += " 📦"
+            message_text += "\n"
+        total_paginas = (total + RESULTADOS_POR_PAGINA_BUSCA - 1) // RESULTADOS_POR_PAGINA_BUSCA
+        message_text += f"\n_Página {pagina + 1} de {total_paginas} ({total} resultado(s))_"
+
+    navegacao = []
+    if pagina > 0:
+        navegacao.append(InlineKeyboardButton("⬅️ Anterior", callback_data=f"buscar_pag_{pagina - 1}"))
+    if (pagina + 1) * RESULTADOS_POR_PAGINA_BUSCA < total:
+        navegacao.append(InlineKeyboardButton("Próxima ➡️", callback_data=f"buscar_pag_{pagina + 1}"))
+    reply_markup = InlineKeyboardMarkup([navegacao]) if navegacao else None
+
+    if update.callback_query:
+        await update.callback_query.edit_message_text(message_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+    else:
+        await update.message.reply_text(message_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+
+async def buscar_command(update: Update, context: ContextoPaytrack) -> None:
+    """Busca transações de todas as pessoas pela descrição. Ex: /buscar conserto do carro"""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("🚫 Comando disponível apenas para administradores.")
+        return
+    consulta = " ".join(context.args).strip() if context.args else ""
+    if not consulta:
+        await update.message.reply_text("🔎 Informe o que procurar. Exemplo:\n/buscar conserto do carro")
+        return
+    context.user_data["busca_consulta"] = consulta
+    await _enviar_pagina_busca(update, context, pagina=0)
+
+async def buscar_pagina_callback(update: Update, context: ContextoPaytrack) -> None:
+    query = update.callback_query
+    if update.effective_user.id not in ADMIN_USER_IDS: # callback_data pode vir de qualquer cliente, não só do teclado enviado
+        await query.answer("🚫 Disponível apenas para administradores.", show_alert=True)
+        return
+    await query.answer()
+    if not context.user_data.get("busca_consulta"):
+        await query.edit_message_text("⚠️ A busca expirou. Use /buscar novamente.")
+        return
+    pagina = int(query.data.split("_")[-1]) # buscar_pag_N
+    await _enviar_pagina_busca(update, context, pagina)
+
+
+# --- Comando /reconciliar ---
+async def reconciliar_command(update: Update, context: ContextoPaytrack) -> None:
+    """Confere as alocações FIFO de pagamentos; com 'corrigir', reconstrói tudo a partir do histórico."""
+    corrigir = bool(context.args) and context.args[0].lower() == "corrigir"
+    if corrigir and update.effective_user.id not in ADMIN_USER_IDS: # Reescreve as alocações de todo mundo
+        await update.message.reply_text("🚫 /reconciliar corrigir está disponível apenas para administradores.")
+        return
+    db = context.db
+    if corrigir:
+        await update.message.reply_chat_action(ChatAction.TYPING)
+        total_pessoas = db_reconstruir_alocacoes(db)
+        db_reconstruir_saldos_mensais(db) # Os rollups dos gráficos só acompanham inserções
+        problemas = db_verificar_alocacoes(db)
+        message_text = f"🔧 Alocações reconstruídas para {total_pessoas} pessoa(s)."
+        if problemas:
+            message_text += f"\n⚠️ Ainda há {len(problemas)} inconsistência(s)."
+    else:
+        problemas = db_verificar_alocacoes(db)
+        if not problemas:
+            message_text = "✅ Alocações de pagamentos consistentes com o histórico."
+        else:
+            message_text = f"⚠️ {len(problemas)} inconsistência(s) encontrada(s):\n"
+            message_text += "\n".join(f"- {p}" for p in problemas[:20])
+            if len(problemas) > 20:
+                message_text += f"\n... e mais {len(problemas) - 20}."
+            message_text += "\n\nUse /reconciliar corrigir para reconstruir."
+    await update.message.reply_text(message_text)
+
+
 # --- Funções de Cancelamento e Retorno ---
-async def cancel_operation_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+CONVERSATION_TIMEOUT = int(os.getenv("CONVERSATION_TIMEOUT", "900")) # Segundos sem resposta até a conversa expirar
+USER_DATA_SWEEP_INTERVAL = 600 # Segundos entre as varreduras de user_data/chat_data ociosos
+# Chaves de user_data que só valem durante uma conversa
+_CHAVES_CONVERSA = (
+    "pessoa_id_to_edit", "pessoa_id_to_remove",
+    "transaction_type", "selected_person_id", "extracted_transaction_data",
+    "extrato_pessoa_id",
+    "divisao_pessoa_ids", "divisao_texto", "divisao_dados",
+)
+
+def _limpar_dados_conversa(user_data: dict) -> None:
+    for key in _CHAVES_CONVERSA:
+        user_data.pop(key, None)
+
+async def conversation_timeout_callback(update: Update, context: ContextoPaytrack) -> None:
+    """Conversa sem resposta por CONVERSATION_TIMEOUT segundos: limpa os dados dela e avisa."""
+    _limpar_dados_conversa(context.user_data)
+    if update.effective_chat:
+        await context.bot.send_message(
+            update.effective_chat.id, "⌛ Operação cancelada por inatividade. Use /start para recomeçar.",
+            rate_limit_args={"prioridade": PRIORIDADE_SEGUNDO_PLANO})
+
+async def descarte_dados_job(context: ContextoPaytrack) -> None:
+    """Descarta user_data/chat_data ociosos (TTL/LRU) deste processo."""
+    descartados = context.application.descartar_dados_ociosos()
+    if descartados:
+        logger.info(f"Memória: {descartados} entradas de user_data/chat_data ociosas descartadas.")
+
+async def cancel_operation_callback(update: Update, context: ContextoPaytrack) -> int:
     query = update.callback_query
     message_text = "❌ Operação cancelada."
     
     # Limpar user_data relevantes para evitar contaminação de fluxos
-    keys_to_clear = [
-        "pessoa_id_to_edit", "pessoa_id_to_remove",
-        "transaction_type", "selected_person_id", "extracted_transaction_data"
-    ]
-    for key in keys_to_clear:
-        if key in context.user_data:
-            del context.user_data[key]
+    _limpar_dados_conversa(context.user_data)
 
     if query:
         await query.answer()
@@ -625,19 +1359,13 @@ async def cancel_operation_callback(update: Update, context: ContextTypes.DEFAUL
     # Por agora, apenas encerra a conversa. O usuário pode usar /start novamente.
     return ConversationHandler.END
 
-async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def main_menu_callback(update: Update, context: ContextoPaytrack) -> int:
     """Retorna ao menu principal (simulando /start com botões)."""
     query = update.callback_query
     if query: await query.answer()
     
     # Limpa qualquer estado de conversa pendente
-    keys_to_clear = [
-        "pessoa_id_to_edit", "pessoa_id_to_remove",
-        "transaction_type", "selected_person_id", "extracted_transaction_data"
-    ]
-    for key in keys_to_clear:
-        if key in context.user_data:
-            del context.user_data[key]
+    _limpar_dados_conversa(context.user_data)
 
     user = update.effective_user
     message_text = (
@@ -647,6 +1375,7 @@ async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         "\n/pessoas - 🧍 Gerenciar pessoas"
         "\n/emprestimos - 💸 Registrar empréstimo"
         "\n/pagamentos - 💰 Registrar pagamento"
+        "\n/dividir - 🧮 Dividir despesa"
         "\n/status - 📊 Ver status"
     )
     # Reutilizar o menu de /pessoas para uma navegação mais fluida via botões
@@ -654,6 +1383,7 @@ async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         [InlineKeyboardButton("🧍 Gerenciar Pessoas", callback_data="pessoas_menu_refresh")],
         [InlineKeyboardButton("💸 Registrar Empréstimo", callback_data="start_emprestimo")], # Precisa de um entry point
         [InlineKeyboardButton("💰 Registrar Pagamento", callback_data="start_pagamento")],   # Precisa de um entry point
+        [InlineKeyboardButton("🧮 Dividir Despesa", callback_data="start_divisao")],
         [InlineKeyboardButton("📊 Ver Status", callback_data="status_refresh")],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -673,15 +1403,88 @@ async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     return ConversationHandler.END # Encerra qualquer conversa ativa
 
 
+# --- Modo inline (@bot nome) ---
+# Cache do lado do Telegram curto: o nosso é invalidado a cada escrita, o deles não
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "5"))
+
+def _descrever_saldo(nome: str, saldo: float) -> str:
+    if saldo > 0:
+        return f"{nome} deve R$ {saldo:.2f}"
+    elif saldo < 0:
+        return f"Você tem um crédito de R$ {abs(saldo):.2f} com {nome}"
+    return f"Não há saldo pendente para {nome}. Quite!"
+
+async def inline_query_handler(update: Update, context: ContextoPaytrack) -> None:
+    """Responde a cada tecla com nomes do índice de prefixos e saldos em cache, sem varrer o banco."""
+    inline_query = update.inline_query
+    if inline_query.from_user.id not in ADMIN_USER_IDS: # Qualquer usuário pode chamar o bot inline em qualquer chat
+        await inline_query.answer([], cache_time=INLINE_CACHE_TIME, is_personal=True)
+        return
+    pessoa_ids = indice_pessoas.buscar_prefixo(inline_query.query, limite=20)
+    saldos = cache_saldos.obter(pessoa_ids)
+
+    resultados = []
+    for pessoa_id in pessoa_ids:
+        nome = indice_pessoas.nome(pessoa_id)
+        if nome is None:
+            continue
+        descricao = _descrever_saldo(nome, saldos[pessoa_id])
+        resultados.append(InlineQueryResultArticle(
+            id=str(pessoa_id),
+            title=nome,
+            description=descricao,
+            input_message_content=InputTextMessageContent(f"📊 {descricao}"),
+        ))
+    await inline_query.answer(resultados, cache_time=INLINE_CACHE_TIME, is_personal=True)
+
+
+# --- Comando /metricas ---
+async def metricas_command(update: Update, context: ContextoPaytrack) -> None:
+    """Mostra os gauges do processo (ex: profundidade da fila de envio) ao administrador."""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("🚫 Comando disponível apenas para administradores.")
+        return
+    metricas = coletar_metricas()
+    if not metricas:
+        await update.message.reply_text("Nenhuma métrica registrada.")
+        return
+    linhas = [f"`{nome}`: {valor:g}" for nome, valor in metricas.items()]
+    await update.message.reply_text("📈 *Métricas*\n\n" + "\n".join(linhas), parse_mode=ParseMode.MARKDOWN)
+
+
 # --- Configuração dos Handlers ---
-def main() -> None:
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+async def _post_shutdown(application: Application) -> None:
+    encerrar_pool() # Processos que renderizam os gráficos
+
+def construir_aplicacao(workers: int = 1, indice_worker: int = 0) -> Application:
+    """
+    Monta a Application com todos os handlers. Com mais de um worker (modo dispatcher),
+    quem busca os updates é o processo de ingresso, então não há Updater, e o limite
+    global de envios é dividido entre os processos. Tarefas agendadas globais
+    (ex: backup, arquivamento) rodam só no worker 0.
+    """
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .application_class(PaytrackApplication) # Uma sessão de banco por update
+        .context_types(ContextTypes(context=ContextoPaytrack))
+        .rate_limiter(LimitadorEnvios(taxa_global=30 / workers)) # Limites global/por chat e retry de flood control
+        .post_shutdown(_post_shutdown)
+    )
+    if TELEGRAM_API_BASE_URL: # Ex: Bot API local ou a API falsa de testes (fake_bot_api.py)
+        builder = builder.base_url(TELEGRAM_API_BASE_URL)
+    if workers > 1:
+        builder = builder.updater(None)
+    application = builder.build()
 
     # Comando /start
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CallbackQueryHandler(main_menu_callback, pattern="^main_menu$"))
 
 
+    # Conversas abandonadas expiram: o handler limpa os dados delas e avisa o usuário
+    estado_timeout = [TypeHandler(Update, conversation_timeout_callback)]
+
     # ConversationHandler para Pessoas
     pessoas_conv_handler = ConversationHandler(
         entry_points=[
@@ -692,12 +1495,14 @@ def main() -> None:
             CallbackQueryHandler(remove_pessoa_select_callback, pattern="^remove_pessoa_select$"),
         ],
         states={
+            ConversationHandler.TIMEOUT: estado_timeout,
             TYPING_PESSOA_NOME: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_pessoa_receive_name)],
             SELECT_PESSOA_TO_EDIT: [CallbackQueryHandler(edit_pessoa_ask_new_name_callback, pattern="^edit_p_id_\\d+$")],
             CONFIRM_PESSOA_EDIT_NOME: [MessageHandler(filters.TEXT & ~filters.COMMAND, edit_pessoa_receive_new_name)],
             SELECT_PESSOA_TO_REMOVE: [CallbackQueryHandler(remove_pessoa_confirm_callback, pattern="^remove_p_id_\\d+$")],
             CONFIRM_PESSOA_REMOVE: [CallbackQueryHandler(remove_pessoa_execute_callback, pattern="^confirm_remove_\\d+$")],
         },
+        conversation_timeout=CONVERSATION_TIMEOUT,
         fallbacks=[
             CallbackQueryHandler(cancel_operation_callback, pattern="^cancel_operation$"),
             CommandHandler("cancel", cancel_operation_callback), # Comando /cancel global
@@ -717,22 +1522,40 @@ def main() -> None:
             CommandHandler("pagamentos", pagamentos_command),
             CallbackQueryHandler(emprestimos_command, pattern="^start_emprestimo$"), # Para botão do menu principal
             CallbackQueryHandler(pagamentos_command, pattern="^start_pagamento$"),   # Para botão do menu principal
+            CommandHandler("dividir", dividir_command),
+            CallbackQueryHandler(dividir_command, pattern="^start_divisao$"),
+            # "Salvar" depois do fim da conversa (toque duplo, update reentregue): responde pela chave de idempotência
+            CallbackQueryHandler(transaction_confirm_save_callback, pattern="^trans_confirm_save$"),
+            CallbackQueryHandler(divisao_confirm_save_callback, pattern="^div_salvar$"),
+            # Mensagem livre fora de outras conversas: pessoa e tipo detectados no texto
+            MessageHandler(filters.TEXT & ~filters.COMMAND, free_text_transaction_entry),
         ],
         states={
+            ConversationHandler.TIMEOUT: estado_timeout,
             SELECT_PESSOA_TRANSACAO: [CallbackQueryHandler(transaction_person_selected_callback, pattern="^trans_sel_p_\\d+$")],
             TYPING_TRANSACAO_DETALHES: [MessageHandler(filters.TEXT & ~filters.COMMAND, transaction_details_received)],
             CONFIRM_TRANSACAO: [
                 CallbackQueryHandler(transaction_confirm_save_callback, pattern="^trans_confirm_save$"),
                 CallbackQueryHandler(transaction_edit_again_callback, pattern="^trans_edit_again$"),
-            ]
+            ],
+            SELECT_PESSOAS_DIVISAO: [
+                CallbackQueryHandler(divisao_toggle_pessoa_callback, pattern="^div_tog_p_\\d+$"),
+                CallbackQueryHandler(divisao_continuar_callback, pattern="^div_continuar$"),
+            ],
+            TYPING_DIVISAO_DETALHES: [MessageHandler(filters.TEXT & ~filters.COMMAND, divisao_details_received)],
+            CONFIRM_DIVISAO: [
+                CallbackQueryHandler(divisao_confirm_save_callback, pattern="^div_salvar$"),
+                CallbackQueryHandler(divisao_edit_again_callback, pattern="^div_editar$"),
+                CallbackQueryHandler(divisao_alterar_pessoas_callback, pattern="^div_pessoas$"),
+            ],
         },
+        conversation_timeout=CONVERSATION_TIMEOUT,
         fallbacks=[
             CallbackQueryHandler(cancel_operation_callback, pattern="^cancel_operation$"),
             CommandHandler("cancel", cancel_operation_callback),
             CommandHandler("start", start_command)
         ]
     )
-    application.add_handler(transaction_conv_handler)
 
     # ConversationHandler para Status
     status_conv_handler = ConversationHandler(
@@ -741,8 +1564,10 @@ def main() -> None:
             CallbackQueryHandler(status_command_start, pattern="^status_refresh$") # Para botão de "ver outra pessoa"
         ],
         states={
-            SELECT_PESSOA_STATUS: [CallbackQueryHandler(status_person_selected_callback, pattern="^status_sel_p_\\d+$")]
+            ConversationHandler.TIMEOUT: estado_timeout,
+            SELECT_PESSOA_STATUS: [CallbackQueryHandler(status_person_selected_callback, pattern="^status_(sel|arq)_p_\\d+$")]
         },
+        conversation_timeout=CONVERSATION_TIMEOUT,
         fallbacks=[
             CallbackQueryHandler(cancel_operation_callback, pattern="^cancel_operation$"), # Reutilizar cancelamento
             CallbackQueryHandler(main_menu_callback, pattern="^main_menu$"), # Botão para menu principal
@@ -752,15 +1577,71 @@ def main() -> None:
     )
     application.add_handler(status_conv_handler)
 
+    # ConversationHandler para Extrato
+    extrato_conv_handler = ConversationHandler(
+        entry_points=[CommandHandler("extrato", extrato_command_start)],
+        states={
+            ConversationHandler.TIMEOUT: estado_timeout,
+            SELECT_PESSOA_EXTRATO: [CallbackQueryHandler(extrato_person_selected_callback, pattern="^extrato_sel_p_\\d+$")],
+            TYPING_EXTRATO_PERIODO: [MessageHandler(filters.TEXT & ~filters.COMMAND, extrato_period_received)],
+        },
+        conversation_timeout=CONVERSATION_TIMEOUT,
+        fallbacks=[
+            CallbackQueryHandler(cancel_operation_callback, pattern="^cancel_operation$"),
+            CommandHandler("cancel", cancel_operation_callback),
+            CommandHandler("start", start_command)
+        ]
+    )
+    application.add_handler(extrato_conv_handler)
+
+    # Transações por último: a entrada por mensagem livre não pode capturar
+    # textos que pertencem a outras conversas (ex: o período do /extrato)
+    application.add_handler(transaction_conv_handler)
+
     # Handler para callbacks não tratados (ex: no_pessoas_found)
-    async def unhandled_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def unhandled_callback(update: Update, context: ContextoPaytrack):
         query = update.callback_query
         if query:
             await query.answer("Esta opção não leva a lugar nenhum ou é apenas informativa.")
 
     application.add_handler(CallbackQueryHandler(unhandled_callback, pattern="^no_pessoas_found$"))
+    application.add_handler(CommandHandler("metricas", metricas_command))
+    application.add_handler(InlineQueryHandler(inline_query_handler))
+    application.add_handler(CommandHandler("envelhecimento", envelhecimento_command))
+    application.add_handler(CommandHandler("reconciliar", reconciliar_command))
+    application.add_handler(CommandHandler("buscar", buscar_command))
+    application.add_handler(CommandHandler("grafico", grafico_command))
+    application.add_handler(CallbackQueryHandler(grafico_selected_callback, pattern="^grafico_sel_(geral|p_\\d+)$"))
+    application.add_handler(CallbackQueryHandler(buscar_pagina_callback, pattern="^buscar_pag_\\d+$"))
+    application.add_handler(CommandHandler("backup", backup_command))
+
+    # Memória: user_data/chat_data são por processo, então cada worker varre os seus
+    application.job_queue.run_repeating(descarte_dados_job, interval=USER_DATA_SWEEP_INTERVAL, first=USER_DATA_SWEEP_INTERVAL, name="descarte_dados")
+    registrar_gauge("memoria_rss_mb", memoria_residente_mb)
+    registrar_gauge("user_data_entradas", lambda: len(application.user_data))
+    registrar_gauge("chat_data_entradas", lambda: len(application.chat_data))
+    registrar_gauge("dados_ociosos_descartados", lambda: application.dados_descartados)
+    registrar_gauge("jobs_agendados", lambda: len(application.job_queue.jobs())) # Inclui os timeouts de conversas ativas
+
+    # Tarefas agendadas
+    if indice_worker == 0 and BANCO_SQLITE:
+        application.job_queue.run_repeating(backup_job, interval=BACKUP_INTERVAL_HOURS * 3600, first=60, name="backup")
+    if indice_worker == 0:
+        application.job_queue.run_repeating(arquivamento_job, interval=24 * 3600, first=300, name="arquivamento")
+        application.job_queue.run_daily(parcelas_job, TimeObject(INSTALLMENT_REMINDER_HOUR, tzinfo=PAYTRACK_TIMEZONE), name="parcelas")
+
+
+    return application
 
-
+def main() -> None:
+    inicializar_banco() # Só aqui: os workers do dispatcher não refazem migrações nem backfills
+    workers = int(os.getenv("PAYTRACK_WORKERS", "1"))
+    if workers > 1:
+        from dispatcher import executar_dispatcher
+        executar_dispatcher(construir_aplicacao, workers)
+        return
+
+    application = construir_aplicacao()
     logger.info("Bot em execução...")
     application.run_polling()
 
@@ -0,0 +1,82 @@
+import asyncio
+import io
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date as DateObject
+
+import matplotlib
+matplotlib.use("Agg") # Renderização sem interface gráfica
+import matplotlib.pyplot as plt
+from matplotlib.dates import DateFormatter
+
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", "2"))
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", "32")) # PNGs guardados por processo (LRU)
+
+_pool: ProcessPoolExecutor | None = None
+# chave (pessoa_id ou "geral") -> (série usada, PNG), do menos para o mais recente
+_cache_graficos: OrderedDict[object, tuple[tuple, bytes]] = OrderedDict()
+
+
+def renderizar_grafico_saldo(titulo: str, meses: list[DateObject], saldos: list[float]) -> bytes:
+    """Desenha a evolução do saldo mês a mês e devolve o PNG. Roda num processo do pool."""
+    fig, ax = plt.subplots(figsize=(8, 4), dpi=100)
+    try:
+        ax.step(meses, saldos, where="post", color="#2e7d32", linewidth=2)
+        ax.fill_between(meses, saldos, step="post", alpha=0.15, color="#2e7d32")
+        ax.axhline(0, color="#9e9e9e", linewidth=0.8)
+        ax.set_title(titulo)
+        ax.set_ylabel("Saldo (R$)")
+        ax.xaxis.set_major_formatter(DateFormatter("%m/%Y"))
+        ax.grid(alpha=0.3)
+        fig.autofmt_xdate()
+        fig.tight_layout()
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format="png")
+        return buffer.getvalue()
+    finally:
+        plt.close(fig)
+
+
+def _obter_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn: não herda o event loop nem as threads do processo do bot
+        _pool = ProcessPoolExecutor(max_workers=CHART_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def encerrar_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def gerar_grafico_saldo(chave: object, titulo: str, serie: list[tuple[DateObject, float]]) -> bytes:
+    """
+    PNG do gráfico de saldo, renderizado fora do event loop.
+    Fica em cache enquanto a série (meses e saldos do rollup) não mudar, até
+    CHART_CACHE_SIZE gráficos; os usados há mais tempo saem primeiro.
+    """
+    assinatura = (titulo, tuple(serie))
+    em_cache = _cache_graficos.get(chave)
+    if em_cache and em_cache[0] == assinatura:
+        _cache_graficos.move_to_end(chave)
+        return em_cache[1]
+
+    meses = [mes for mes, _ in serie]
+    saldos = [saldo for _, saldo in serie]
+    if len(meses) == 1: # Um ponto só não forma degrau: repete no mês seguinte
+        mes = meses[0]
+        meses.append(mes.replace(year=mes.year + (mes.month // 12), month=mes.month % 12 + 1))
+        saldos.append(saldos[0])
+
+    loop = asyncio.get_running_loop()
+    png = await loop.run_in_executor(_obter_pool(), renderizar_grafico_saldo, titulo, meses, saldos)
+    _cache_graficos[chave] = (assinatura, png)
+    _cache_graficos.move_to_end(chave)
+    while len(_cache_graficos) > CHART_CACHE_SIZE:
+        _cache_graficos.popitem(last=False)
+    return png
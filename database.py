@@ -1,23 +1,62 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, Date, ForeignKey, DateTime, event
-from sqlalchemy.orm import sessionmaker, relationship, declarative_base
-from sqlalchemy.engine import Engine
-from datetime import datetime
+from sqlalchemy import create_engine, Column, Integer, String, Float, Date, ForeignKey, DateTime, Index, event, select, insert, case, func, inspect, text, or_, union_all, literal
+from sqlalchemy.orm import Session, sessionmaker, relationship, declarative_base, joinedload
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError, OperationalError
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta, date as DateObject
+from itertools import chain
+import logging
 import os
+import re
+
+import numpy as np
 from dotenv import load_dotenv
 
 load_dotenv()
+logger = logging.getLogger(__name__)
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./debt_manager.db")
+# Períodos quitados só vão para o arquivo depois de terem essa idade
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))
+
+# Pool de conexões dos bancos com servidor (PostgreSQL); o SQLite usa o padrão do SQLAlchemy.
+# No modo multiprocesso cada worker tem seu próprio pool: o total é workers * (size + overflow)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "5"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10")) # Espera por uma conexão livre, em segundos
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800")) # Renova conexões antes de proxies/firewalls as derrubarem
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "30000"))
+# Linhas por lote nas leituras grandes (cursor no servidor no PostgreSQL)
+DB_STREAM_BATCH = int(os.getenv("DB_STREAM_BATCH", "5000"))
+
+def _opcoes_engine(url: str) -> dict:
+    if make_url(url).get_backend_name() == "sqlite":
+        return {}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+        "insertmanyvalues_page_size": 1000, # executemany vira INSERT ... VALUES com várias linhas
+        **({"connect_args": {"application_name": "paytrack"}} if make_url(url).get_backend_name() == "postgresql" else {}),
+    }
 
-# Habilitar FK para SQLite, se estiver usando
-@event.listens_for(Engine, "connect")
-def set_sqlite_pragma(dbapi_connection, connection_record):
-    if DATABASE_URL.startswith("sqlite"):
-        cursor = dbapi_connection.cursor()
+engine = create_engine(DATABASE_URL, **_opcoes_engine(DATABASE_URL))
+
+@event.listens_for(engine, "connect")
+def _configurar_conexao(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    if engine.dialect.name == "sqlite":
         cursor.execute("PRAGMA foreign_keys=ON")
-        cursor.close()
+    elif engine.dialect.name == "postgresql":
+        # Consulta travada não segura uma conexão do pool para sempre
+        cursor.execute(f"SET statement_timeout = {DB_STATEMENT_TIMEOUT_MS}")
+        dbapi_connection.commit()
+    cursor.close()
 
-engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -29,6 +68,10 @@ class Pessoa(Base):
     # Relações com cascade para deleção
     emprestimos = relationship("Emprestimo", back_populates="pessoa", cascade="all, delete-orphan")
     pagamentos = relationship("Pagamento", back_populates="pessoa", cascade="all, delete-orphan")
+    saldos_mensais = relationship("SaldoMensal", cascade="all, delete-orphan")
+    emprestimos_arquivados = relationship("EmprestimoArquivado", back_populates="pessoa", cascade="all, delete-orphan")
+    pagamentos_arquivados = relationship("PagamentoArquivado", back_populates="pessoa", cascade="all, delete-orphan")
+    periodos_arquivados = relationship("PeriodoArquivado", cascade="all, delete-orphan")
 
     def __repr__(self):
         return f"<Pessoa(id={self.id}, nome='{self.nome}')>"
@@ -41,8 +84,23 @@ class Emprestimo(Base):
     descricao = Column(String, nullable=True)
     data_criacao = Column(DateTime, default=datetime.utcnow)
     pessoa_id = Column(Integer, ForeignKey("pessoas.id", ondelete="CASCADE"), nullable=False)
+    valor_em_aberto = Column(Float, nullable=True) # Mantido pelas alocações FIFO de pagamentos
+    chave_idempotencia = Column(String, nullable=True) # Origem da escrita (ex: mensagem de confirmação)
 
     pessoa = relationship("Pessoa", back_populates="emprestimos")
+    alocacoes = relationship("Alocacao", back_populates="emprestimo", cascade="all, delete-orphan")
+    parcelas = relationship("Parcela", back_populates="emprestimo", cascade="all, delete-orphan", order_by="Parcela.numero")
+
+    __table_args__ = (
+        # Extratos e status por pessoa: filtro por pessoa_id e intervalo/ordem por data
+        Index("ix_emprestimos_pessoa_data", "pessoa_id", "data", "id"),
+        # Só empréstimos ainda não quitados entram no índice; com valor_em_aberto
+        # nele, o /envelhecimento é lido só do índice (covering), sem tocar a tabela
+        Index("ix_emprestimos_em_aberto_valor", "pessoa_id", "data", "id", "valor_em_aberto",
+              sqlite_where=text("valor_em_aberto > 0"), postgresql_where=text("valor_em_aberto > 0")),
+        # Uma transação por chave; NULL (escritas sem chave) não conflita
+        Index("ux_emprestimos_chave_idempotencia", "chave_idempotencia", unique=True),
+    )
 
     def __repr__(self):
         return f"<Emprestimo(id={self.id}, valor={self.valor}, pessoa_id={self.pessoa_id})>"
@@ -55,13 +113,275 @@ class Pagamento(Base):
     descricao = Column(String, nullable=True)
     data_criacao = Column(DateTime, default=datetime.utcnow)
     pessoa_id = Column(Integer, ForeignKey("pessoas.id", ondelete="CASCADE"), nullable=False)
+    valor_nao_alocado = Column(Float, nullable=True) # Crédito ainda não casado com empréstimos
+    chave_idempotencia = Column(String, nullable=True)
 
     pessoa = relationship("Pessoa", back_populates="pagamentos")
+    alocacoes = relationship("Alocacao", back_populates="pagamento", cascade="all, delete-orphan")
+
+    __table_args__ = (
+        Index("ix_pagamentos_pessoa_data", "pessoa_id", "data", "id"),
+        Index("ix_pagamentos_nao_alocados", "pessoa_id", "data", "id",
+              sqlite_where=text("valor_nao_alocado > 0"), postgresql_where=text("valor_nao_alocado > 0")),
+        Index("ux_pagamentos_chave_idempotencia", "chave_idempotencia", unique=True),
+    )
 
     def __repr__(self):
         return f"<Pagamento(id={self.id}, valor={self.valor}, pessoa_id={self.pessoa_id})>"
 
-Base.metadata.create_all(bind=engine)
+class Alocacao(Base):
+    """Quanto de um pagamento foi usado para quitar um empréstimo (FIFO por data)."""
+    __tablename__ = "alocacoes"
+    id = Column(Integer, primary_key=True, index=True)
+    pagamento_id = Column(Integer, ForeignKey("pagamentos.id", ondelete="CASCADE"), nullable=False, index=True)
+    emprestimo_id = Column(Integer, ForeignKey("emprestimos.id", ondelete="CASCADE"), nullable=False, index=True)
+    valor = Column(Float, nullable=False)
+
+    pagamento = relationship("Pagamento", back_populates="alocacoes")
+    emprestimo = relationship("Emprestimo", back_populates="alocacoes")
+
+    def __repr__(self):
+        return f"<Alocacao(pagamento_id={self.pagamento_id}, emprestimo_id={self.emprestimo_id}, valor={self.valor})>"
+
+class Parcela(Base):
+    """Parcela de um empréstimo parcelado; o que foi pago do empréstimo quita as parcelas em ordem."""
+    __tablename__ = "parcelas"
+    id = Column(Integer, primary_key=True)
+    emprestimo_id = Column(Integer, ForeignKey("emprestimos.id", ondelete="CASCADE"), nullable=False)
+    numero = Column(Integer, nullable=False) # 1 a N
+    valor = Column(Float, nullable=False)
+    vencimento = Column(Date, nullable=False)
+    valor_pago = Column(Float, nullable=False, default=0.0) # Mantido por _sincronizar_parcelas
+    lembrete_enviado_em = Column(Date, nullable=True)
+
+    emprestimo = relationship("Emprestimo", back_populates="parcelas")
+
+    __table_args__ = (
+        Index("ux_parcelas_emprestimo_numero", "emprestimo_id", "numero", unique=True),
+        # Só parcelas em aberto e sem lembrete: o job diário faz um range scan por vencimento
+        Index("ix_parcelas_lembretes_pendentes", "vencimento",
+              sqlite_where=text("valor_pago < valor AND lembrete_enviado_em IS NULL"),
+              postgresql_where=text("valor_pago < valor AND lembrete_enviado_em IS NULL")),
+    )
+
+    def __repr__(self):
+        return f"<Parcela(emprestimo_id={self.emprestimo_id}, numero={self.numero}, valor={self.valor}, vencimento={self.vencimento})>"
+
+class SaldoMensal(Base):
+    """Rollup mensal por pessoa, mantido a cada inserção (gráficos de saldo)."""
+    __tablename__ = "saldos_mensais"
+    pessoa_id = Column(Integer, ForeignKey("pessoas.id", ondelete="CASCADE"), primary_key=True)
+    mes = Column(Date, primary_key=True, index=True) # Primeiro dia do mês
+    emprestado = Column(Float, nullable=False, default=0.0)
+    pago = Column(Float, nullable=False, default=0.0)
+    saldo_final = Column(Float, nullable=False, default=0.0) # Saldo acumulado no fim do mês
+
+    def __repr__(self):
+        return f"<SaldoMensal(pessoa_id={self.pessoa_id}, mes={self.mes}, saldo_final={self.saldo_final})>"
+
+class EmprestimoArquivado(Base):
+    """Empréstimo de um período já quitado, fora da tabela quente (ver db_arquivar_periodos_quitados)."""
+    __tablename__ = "emprestimos_arquivados"
+    id = Column(Integer, primary_key=True)
+    id_original = Column(Integer, nullable=False) # id que tinha em emprestimos
+    valor = Column(Float, nullable=False)
+    data = Column(Date, nullable=False)
+    descricao = Column(String, nullable=True)
+    data_criacao = Column(DateTime)
+    pessoa_id = Column(Integer, ForeignKey("pessoas.id", ondelete="CASCADE"), nullable=False)
+    chave_idempotencia = Column(String, nullable=True)
+    arquivado_em = Column(DateTime, default=datetime.utcnow)
+
+    valor_em_aberto = 0.0 # Quitado por definição
+
+    pessoa = relationship("Pessoa", back_populates="emprestimos_arquivados")
+    parcelas = relationship("ParcelaArquivada", cascade="all, delete-orphan", order_by="ParcelaArquivada.numero")
+
+    __table_args__ = (
+        Index("ix_emprestimos_arquivados_pessoa_data", "pessoa_id", "data", "id"),
+        Index("ix_emprestimos_arquivados_chave_idempotencia", "chave_idempotencia"),
+    )
+
+    def __repr__(self):
+        return f"<EmprestimoArquivado(id_original={self.id_original}, valor={self.valor}, pessoa_id={self.pessoa_id})>"
+
+class ParcelaArquivada(Base):
+    """Parcela de um empréstimo arquivado; volta para `parcelas` se o período for reaberto."""
+    __tablename__ = "parcelas_arquivadas"
+    id = Column(Integer, primary_key=True)
+    emprestimo_arquivado_id = Column(Integer, ForeignKey("emprestimos_arquivados.id", ondelete="CASCADE"), nullable=False, index=True)
+    numero = Column(Integer, nullable=False)
+    valor = Column(Float, nullable=False)
+    vencimento = Column(Date, nullable=False)
+    valor_pago = Column(Float, nullable=False)
+    lembrete_enviado_em = Column(Date, nullable=True)
+
+    def __repr__(self):
+        return f"<ParcelaArquivada(emprestimo_arquivado_id={self.emprestimo_arquivado_id}, numero={self.numero}, valor={self.valor})>"
+
+class PagamentoArquivado(Base):
+    __tablename__ = "pagamentos_arquivados"
+    id = Column(Integer, primary_key=True)
+    id_original = Column(Integer, nullable=False)
+    valor = Column(Float, nullable=False)
+    data = Column(Date, nullable=False)
+    descricao = Column(String, nullable=True)
+    data_criacao = Column(DateTime)
+    pessoa_id = Column(Integer, ForeignKey("pessoas.id", ondelete="CASCADE"), nullable=False)
+    chave_idempotencia = Column(String, nullable=True)
+    arquivado_em = Column(DateTime, default=datetime.utcnow)
+
+    valor_nao_alocado = 0.0
+
+    pessoa = relationship("Pessoa", back_populates="pagamentos_arquivados")
+
+    __table_args__ = (
+        Index("ix_pagamentos_arquivados_pessoa_data", "pessoa_id", "data", "id"),
+        Index("ix_pagamentos_arquivados_chave_idempotencia", "chave_idempotencia"),
+    )
+
+    def __repr__(self):
+        return f"<PagamentoArquivado(id_original={self.id_original}, valor={self.valor}, pessoa_id={self.pessoa_id})>"
+
+class PeriodoArquivado(Base):
+    """Resumo de um período arquivado: nele, o total emprestado é igual ao total pago."""
+    __tablename__ = "periodos_arquivados"
+    id = Column(Integer, primary_key=True)
+    pessoa_id = Column(Integer, ForeignKey("pessoas.id", ondelete="CASCADE"), nullable=False)
+    inicio = Column(Date, nullable=False)
+    fim = Column(Date, nullable=False)
+    emprestimos = Column(Integer, nullable=False)
+    pagamentos = Column(Integer, nullable=False)
+    total = Column(Float, nullable=False)
+    arquivado_em = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (Index("ix_periodos_arquivados_pessoa_fim", "pessoa_id", "fim"),)
+
+    def __repr__(self):
+        return f"<PeriodoArquivado(pessoa_id={self.pessoa_id}, inicio={self.inicio}, fim={self.fim}, total={self.total})>"
+
+# Índices de versões anteriores que ganharam um substituto com outro nome
+_INDICES_SUBSTITUIDOS = ("ix_emprestimos_em_aberto",)
+
+def _migrar_schema() -> set[tuple[str, str]]:
+    """
+    create_all não altera tabelas que já existem: adiciona colunas e índices
+    novos em bancos criados por versões anteriores. Retorna as colunas adicionadas.
+    """
+    adicionadas = set()
+    inspetor = inspect(engine)
+    with engine.begin() as conn:
+        for tabela in Base.metadata.sorted_tables:
+            existentes = {c["name"] for c in inspetor.get_columns(tabela.name)}
+            for coluna in tabela.columns:
+                if coluna.name not in existentes:
+                    tipo = coluna.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f"ALTER TABLE {tabela.name} ADD COLUMN {coluna.name} {tipo}"))
+                    adicionadas.add((tabela.name, coluna.name))
+            for indice in tabela.indexes:
+                indice.create(bind=conn, checkfirst=True)
+        for indice in _INDICES_SUBSTITUIDOS:
+            conn.execute(text(f"DROP INDEX IF EXISTS {indice}"))
+    return adicionadas
+
+# --- Busca textual (SQLite FTS5) ---
+# O rowid codifica a origem: id*2 para empréstimos e id*2+1 para pagamentos,
+# assim os triggers apagam/atualizam pelo rowid sem varrer a tabela de busca.
+# Os arquivados têm a própria tabela de busca, com a mesma codificação: o
+# arquivamento tira a linha de uma e os triggers a colocam na outra.
+_TABELAS_BUSCA = (
+    # (tabela FTS5, empréstimos, pagamentos)
+    ("transacoes_fts", "emprestimos", "pagamentos"),
+    ("arquivo_fts", "emprestimos_arquivados", "pagamentos_arquivados"),
+)
+
+def _ddl_busca_textual(fts: str, emprestimos: str, pagamentos: str) -> list[str]:
+    ddl = []
+    for tabela, rowid in ((emprestimos, "id * 2"), (pagamentos, "id * 2 + 1")):
+        ddl += [
+            f"""CREATE TRIGGER IF NOT EXISTS {tabela}_fts_ai AFTER INSERT ON {tabela} BEGIN
+        INSERT INTO {fts}(rowid, descricao) VALUES (new.{rowid}, coalesce(new.descricao, ''));
+    END""",
+            f"""CREATE TRIGGER IF NOT EXISTS {tabela}_fts_ad AFTER DELETE ON {tabela} BEGIN
+        DELETE FROM {fts} WHERE rowid = old.{rowid};
+    END""",
+            f"""CREATE TRIGGER IF NOT EXISTS {tabela}_fts_au AFTER UPDATE OF descricao ON {tabela} BEGIN
+        UPDATE {fts} SET descricao = coalesce(new.descricao, '') WHERE rowid = new.{rowid};
+    END""",
+        ]
+    return ddl
+
+def _configurar_busca_textual() -> bool:
+    """Cria as tabelas FTS5 e os triggers de sincronização. Retorna False se o banco não suportar."""
+    if engine.dialect.name != "sqlite":
+        return False
+    try:
+        with engine.begin() as conn:
+            for fts, emprestimos, pagamentos in _TABELAS_BUSCA:
+                existe = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = :nome"), {"nome": fts}).first()
+                if not existe:
+                    conn.execute(text(
+                        f"CREATE VIRTUAL TABLE {fts} USING fts5(descricao, tokenize = 'unicode61 remove_diacritics 2')"
+                    ))
+                    # Indexa o histórico que já existia antes da busca
+                    conn.execute(text(f"INSERT INTO {fts}(rowid, descricao) SELECT id * 2, coalesce(descricao, '') FROM {emprestimos}"))
+                    conn.execute(text(f"INSERT INTO {fts}(rowid, descricao) SELECT id * 2 + 1, coalesce(descricao, '') FROM {pagamentos}"))
+                for ddl in _ddl_busca_textual(fts, emprestimos, pagamentos):
+                    conn.execute(text(ddl))
+        return True
+    except OperationalError as e: # SQLite compilado sem FTS5
+        logger.warning(f"FTS5 indisponível, a busca usará LIKE: {e}")
+        return False
+
+_busca_textual: bool | None = None # Descoberto na primeira busca de cada processo
+
+def busca_textual_disponivel() -> bool:
+    """Se as tabelas FTS5 existem (inicializar_banco as cria quando o SQLite suporta)."""
+    global _busca_textual
+    if _busca_textual is None:
+        _busca_textual = engine.dialect.name == "sqlite" and inspect(engine).has_table("transacoes_fts")
+    return _busca_textual
+
+# --- Notificação de alterações (para caches em memória) ---
+# Ouvintes recebem (pessoas_alteradas, pessoa_ids_com_transacoes_alteradas) após cada commit.
+_ouvintes_alteracoes = []
+
+def registrar_ouvinte_alteracoes(funcao):
+    _ouvintes_alteracoes.append(funcao)
+    return funcao
+
+@event.listens_for(SessionLocal, "after_flush")
+def _coletar_alteracoes(session, flush_context):
+    # Em after_flush, new/dirty/deleted ainda mostram o estado anterior ao flush
+    alteracoes = session.info.setdefault("alteracoes", {"pessoas": False, "pessoa_ids": set()})
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Pessoa):
+            alteracoes["pessoas"] = True
+            if obj.id is not None:
+                alteracoes["pessoa_ids"].add(obj.id)
+        elif isinstance(obj, (Emprestimo, Pagamento)):
+            alteracoes["pessoa_ids"].add(obj.pessoa_id)
+
+def notificar_alteracoes(pessoas_alteradas: bool, pessoa_ids: set[int], exceto=None) -> None:
+    """Chama os ouvintes; também usada para repassar alterações feitas em outro processo."""
+    for funcao in _ouvintes_alteracoes:
+        if funcao is exceto:
+            continue
+        try:
+            funcao(pessoas_alteradas, pessoa_ids)
+        except Exception as e:
+            logger.error(f"Erro no ouvinte de alterações {funcao.__name__}: {e}")
+
+@event.listens_for(SessionLocal, "after_commit")
+def _notificar_alteracoes(session):
+    alteracoes = session.info.pop("alteracoes", None)
+    if not alteracoes:
+        return
+    notificar_alteracoes(alteracoes["pessoas"], alteracoes["pessoa_ids"])
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _descartar_alteracoes(session):
+    session.info.pop("alteracoes", None)
 
 # Funções CRUD e de consulta (exemplos)
 def get_db():
@@ -71,6 +391,61 @@ def get_db():
     finally:
         db.close()
 
+# --- Sessão por escopo (uma por update do Telegram) ---
+class OrcamentoConsultasExcedido(RuntimeError):
+    pass
+
+class EscopoSessao:
+    """
+    Sessão aberta só quando alguém a usa, mais o total de consultas feitas no escopo.
+    Com `orcamento`, a consulta que passar do limite falha antes de ser executada:
+    o handler é interrompido e a sessão fecha sem commit.
+    """
+
+    def __init__(self, orcamento: int | None = None):
+        self._sessao: Session | None = None
+        self.consultas = 0
+        self.orcamento = orcamento
+
+    @property
+    def sessao(self) -> Session:
+        if self._sessao is None:
+            self._sessao = SessionLocal()
+        return self._sessao
+
+    def fechar(self) -> None:
+        if self._sessao is not None:
+            self._sessao.close()
+            self._sessao = None
+
+_escopo_atual: ContextVar[EscopoSessao | None] = ContextVar("escopo_sessao", default=None)
+
+@contextmanager
+def escopo_sessao(orcamento: int | None = None):
+    """Abre um escopo: sessao_atual() devolve a mesma sessão até o fim do bloco, que a fecha."""
+    escopo = EscopoSessao(orcamento)
+    token = _escopo_atual.set(escopo)
+    try:
+        yield escopo
+    finally:
+        _escopo_atual.reset(token)
+        escopo.fechar()
+
+def sessao_atual() -> Session:
+    escopo = _escopo_atual.get()
+    if escopo is None:
+        raise RuntimeError("Nenhum escopo de sessão ativo. Use 'with escopo_sessao():'.")
+    return escopo.sessao
+
+@event.listens_for(engine, "before_cursor_execute")
+def _contar_consulta(conn, cursor, statement, parameters, context, executemany):
+    escopo = _escopo_atual.get()
+    if escopo is not None:
+        escopo.consultas += 1
+        if escopo.orcamento is not None and escopo.consultas > escopo.orcamento:
+            raise OrcamentoConsultasExcedido(f"Consulta nº {escopo.consultas} passa do orçamento de {escopo.orcamento}: "
+                                             f"{' '.join(statement.split())[:120]}")
+
 # --- Funções CRUD de Pessoas ---
 def db_add_pessoa(db: SessionLocal, nome: str) -> Pessoa | None:
     if db.query(Pessoa).filter(Pessoa.nome == nome).first():
@@ -107,30 +482,714 @@ def db_remove_pessoa(db: SessionLocal, pessoa_id: int) -> bool:
     return False
 
 # --- Funções de Empréstimos e Pagamentos ---
-def db_add_emprestimo(db: SessionLocal, pessoa_id: int, valor: float, data_str: str, descricao: str | None) -> Emprestimo:
+# --- Idempotência ---
+def _buscar_por_chave(db: SessionLocal, modelo, chave_idempotencia: str | None):
+    if not chave_idempotencia:
+        return None
+    return db.query(modelo).filter(modelo.chave_idempotencia == chave_idempotencia).first()
+
+def db_get_transacao_por_chave(db: SessionLocal, chave_idempotencia: str) -> Emprestimo | Pagamento | EmprestimoArquivado | PagamentoArquivado | None:
+    """Transação já gravada com essa chave, seja empréstimo ou pagamento, nas tabelas quentes ou no arquivo."""
+    for modelo in (Emprestimo, Pagamento, EmprestimoArquivado, PagamentoArquivado):
+        transacao = _buscar_por_chave(db, modelo, chave_idempotencia)
+        if transacao:
+            return transacao
+    return None
+
+def _gravar_idempotente(db: SessionLocal, buscar, gravar):
+    """
+    Executa `gravar()` (que insere e faz commit) a menos que `buscar()` já encontre
+    a escrita pela chave. Se outra entrega da mesma escrita ganhar a corrida, o
+    índice único rejeita a segunda e a original é devolvida no lugar do erro.
+    """
+    existente = buscar()
+    if existente:
+        return existente
+    try:
+        return gravar()
+    except IntegrityError:
+        db.rollback()
+        existente = buscar()
+        if not existente:
+            raise
+        return existente
+
+def db_add_emprestimo(db: SessionLocal, pessoa_id: int, valor: float, data_str: str, descricao: str | None,
+                      chave_idempotencia: str | None = None, parcelas: int = 1) -> Emprestimo:
     try:
         data_obj = datetime.strptime(data_str, "%Y-%m-%d").date()
     except ValueError:
         # Tratar erro de data ou lançar exceção
         raise ValueError(f"Formato de data inválido: {data_str}. Use YYYY-MM-DD.")
-    emprestimo = Emprestimo(pessoa_id=pessoa_id, valor=valor, data=data_obj, descricao=descricao)
-    db.add(emprestimo)
-    db.commit()
-    db.refresh(emprestimo)
-    return emprestimo
+    if parcelas < 1 or round(valor * 100) < parcelas:
+        raise ValueError(f"Não é possível dividir R$ {valor:.2f} em {parcelas} parcelas.")
+
+    def gravar():
+        emprestimo, = _inserir_emprestimos(db, [(pessoa_id, valor, chave_idempotencia)], data_obj, descricao, parcelas)
+        db.commit()
+        db.refresh(emprestimo)
+        return emprestimo
+
+    return _gravar_idempotente(db, lambda: _buscar_por_chave(db, Emprestimo, chave_idempotencia), gravar)
+
+def _inserir_emprestimos(db: SessionLocal, linhas: list[tuple[int, float, str | None]], data_obj: DateObject,
+                         descricao: str | None, parcelas: int = 1) -> list[Emprestimo]:
+    """
+    Insere empréstimos de mesma data, um por pessoa em `linhas` [(pessoa_id, valor, chave)],
+    e atualiza alocações, parcelas e rollups, sem commit. As verificações são feitas
+    em lote, então o número de consultas quase não cresce com o número de pessoas.
+    """
+    pessoa_ids = [pessoa_id for pessoa_id, _, _ in linhas]
+    desarquivadas = _desarquivar_a_partir(db, pessoa_ids, data_obj)
+    emprestimos = [Emprestimo(pessoa_id=pessoa_id, valor=valor, data=data_obj, descricao=descricao,
+                              valor_em_aberto=valor, chave_idempotencia=chave)
+                   for pessoa_id, valor, chave in linhas]
+    db.add_all(emprestimos)
+    db.flush()
+    if parcelas > 1: # Cronogramas inteiros num executemany só
+        db.execute(insert(Parcela), [
+            {"emprestimo_id": emprestimo.id, "numero": numero, "valor": valor_parcela, "vencimento": vencimento, "valor_pago": 0.0}
+            for emprestimo in emprestimos
+            for numero, (vencimento, valor_parcela) in enumerate(gerar_cronograma(emprestimo.valor, parcelas, data_obj), start=1)
+        ])
+    # Empréstimo com data anterior a outro que já recebeu pagamento muda a ordem FIFO
+    fora_de_ordem = {pessoa_id for (pessoa_id,) in db.query(Emprestimo.pessoa_id).filter(
+        Emprestimo.pessoa_id.in_(pessoa_ids), Emprestimo.data > data_obj,
+        Emprestimo.valor_em_aberto < Emprestimo.valor
+    ).distinct()}
+    com_credito = {pessoa_id for (pessoa_id,) in db.query(Pagamento.pessoa_id).filter(
+        Pagamento.pessoa_id.in_(pessoa_ids), Pagamento.valor_nao_alocado > 0
+    ).distinct()}
+    for pessoa_id in pessoa_ids:
+        if pessoa_id in fora_de_ordem or pessoa_id in desarquivadas:
+            _reconstruir_alocacoes_pessoa(db, pessoa_id)
+        elif pessoa_id in com_credito:
+            _alocar_creditos_pendentes(db, pessoa_id)
+        else:
+            continue # Nada foi alocado: parcelas continuam como estavam
+        _sincronizar_parcelas(db, pessoa_id)
+    _ajustar_saldos_mensais(db, data_obj, {pessoa_id: (valor, 0.0) for pessoa_id, valor, _ in linhas})
+    return emprestimos
+
+def db_get_divisao_por_chave(db: SessionLocal, chave_idempotencia: str | None) -> list[Emprestimo]:
+    """Empréstimos de uma despesa dividida já gravada (chaves "<chave>:<pessoa_id>"), num range scan do índice único."""
+    if not chave_idempotencia:
+        return []
+    return db.query(Emprestimo).filter(
+        Emprestimo.chave_idempotencia >= f"{chave_idempotencia}:", Emprestimo.chave_idempotencia < f"{chave_idempotencia};"
+    ).order_by(Emprestimo.id).all()
 
-def db_add_pagamento(db: SessionLocal, pessoa_id: int, valor: float, data_str: str, descricao: str | None) -> Pagamento:
+def db_add_emprestimos_divididos(db: SessionLocal, partes: list[tuple[int, float]], data_str: str, descricao: str | None,
+                                 chave_idempotencia: str | None = None) -> list[Emprestimo]:
+    """
+    Despesa dividida: um empréstimo por pessoa de `partes` [(pessoa_id, valor)],
+    todos numa transação só. Ou entram todos, ou nenhum.
+    """
     try:
         data_obj = datetime.strptime(data_str, "%Y-%m-%d").date()
     except ValueError:
         raise ValueError(f"Formato de data inválido: {data_str}. Use YYYY-MM-DD.")
-    pagamento = Pagamento(pessoa_id=pessoa_id, valor=valor, data=data_obj, descricao=descricao)
-    db.add(pagamento)
+    if len({pessoa_id for pessoa_id, _ in partes}) != len(partes):
+        raise ValueError("Cada pessoa pode aparecer uma vez só na divisão.")
+
+    def gravar():
+        emprestimos = _inserir_emprestimos(db, [
+            (pessoa_id, valor, f"{chave_idempotencia}:{pessoa_id}" if chave_idempotencia else None)
+            for pessoa_id, valor in partes
+        ], data_obj, descricao)
+        ids = [emprestimo.id for emprestimo in emprestimos]
+        db.commit()
+        db.query(Emprestimo).filter(Emprestimo.id.in_(ids)).all() # Recarrega todos numa consulta
+        return emprestimos
+
+    return _gravar_idempotente(db, lambda: db_get_divisao_por_chave(db, chave_idempotencia), gravar)
+
+def db_add_pagamento(db: SessionLocal, pessoa_id: int, valor: float, data_str: str, descricao: str | None,
+                     chave_idempotencia: str | None = None) -> Pagamento:
+    try:
+        data_obj = datetime.strptime(data_str, "%Y-%m-%d").date()
+    except ValueError:
+        raise ValueError(f"Formato de data inválido: {data_str}. Use YYYY-MM-DD.")
+
+    def gravar():
+        desarquivou = bool(_desarquivar_a_partir(db, [pessoa_id], data_obj))
+        pagamento = Pagamento(pessoa_id=pessoa_id, valor=valor, data=data_obj, descricao=descricao,
+                              valor_nao_alocado=valor, chave_idempotencia=chave_idempotencia)
+        db.add(pagamento)
+        db.flush()
+        fora_de_ordem = db.query(Pagamento.id).filter(
+            Pagamento.pessoa_id == pessoa_id, Pagamento.data > data_obj,
+            Pagamento.valor_nao_alocado < Pagamento.valor
+        ).first()
+        if fora_de_ordem or desarquivou:
+            _reconstruir_alocacoes_pessoa(db, pessoa_id)
+        else:
+            _alocar_creditos_pendentes(db, pessoa_id)
+        _sincronizar_parcelas(db, pessoa_id)
+        _ajustar_saldo_mensal(db, pessoa_id, data_obj, pago=valor)
+        db.commit()
+        db.refresh(pagamento)
+        return pagamento
+
+    return _gravar_idempotente(db, lambda: _buscar_por_chave(db, Pagamento, chave_idempotencia), gravar)
+
+def db_get_transacoes_pessoa(db: SessionLocal, pessoa_id: int, incluir_arquivados: bool = False) -> tuple[list[Emprestimo], list[Pagamento]]:
+    """Transações da pessoa, mais recentes primeiro. Os períodos arquivados só vêm se pedidos."""
+    modelos = ((Emprestimo, EmprestimoArquivado), (Pagamento, PagamentoArquivado))
+    resultado = []
+    for modelo, arquivado in modelos:
+        linhas = db.query(modelo).filter(modelo.pessoa_id == pessoa_id).order_by(modelo.data.desc(), modelo.id.desc()).all()
+        if incluir_arquivados: # Todo arquivado é anterior às linhas quentes
+            linhas += db.query(arquivado).filter(arquivado.pessoa_id == pessoa_id).order_by(arquivado.data.desc(), arquivado.id.desc()).all()
+        resultado.append(linhas)
+    emprestimos, pagamentos = resultado
+    return emprestimos, pagamentos
+
+# --- Extrato por período ---
+def _consulta_total_anterior(modelo, pessoa_id: int, inicio: DateObject):
+    return select(func.coalesce(func.sum(modelo.valor), 0.0)).where(
+        modelo.pessoa_id == pessoa_id, modelo.data < inicio)
+
+def _consulta_movimentos(modelo, pessoa_id: int, inicio: DateObject, fim: DateObject):
+    return select(modelo).where(
+        modelo.pessoa_id == pessoa_id, modelo.data >= inicio, modelo.data <= fim
+    ).order_by(modelo.data, modelo.id)
+
+def db_get_extrato_pessoa(db: SessionLocal, pessoa_id: int, inicio: DateObject, fim: DateObject) -> tuple[float, list[Emprestimo], list[Pagamento]]:
+    """
+    Extrato de um período: (saldo inicial, empréstimos do período, pagamentos do período).
+    Todas as consultas são range scans nos índices (pessoa_id, data, id).
+    """
+    emprestado_antes = db.execute(_consulta_total_anterior(Emprestimo, pessoa_id, inicio)).scalar()
+    pago_antes = db.execute(_consulta_total_anterior(Pagamento, pessoa_id, inicio)).scalar()
+    emprestimos = db.execute(_consulta_movimentos(Emprestimo, pessoa_id, inicio, fim)).scalars().all()
+    pagamentos = db.execute(_consulta_movimentos(Pagamento, pessoa_id, inicio, fim)).scalars().all()
+
+    # Depois do último período arquivado o arquivo soma zero e pode ser ignorado;
+    # um extrato que começa dentro dele precisa das linhas arquivadas
+    fim_arquivado = db_get_fim_arquivado(db, pessoa_id)
+    if fim_arquivado and inicio <= fim_arquivado:
+        emprestado_antes += db.execute(_consulta_total_anterior(EmprestimoArquivado, pessoa_id, inicio)).scalar()
+        pago_antes += db.execute(_consulta_total_anterior(PagamentoArquivado, pessoa_id, inicio)).scalar()
+        emprestimos = db.execute(_consulta_movimentos(EmprestimoArquivado, pessoa_id, inicio, fim)).scalars().all() + emprestimos
+        pagamentos = db.execute(_consulta_movimentos(PagamentoArquivado, pessoa_id, inicio, fim)).scalars().all() + pagamentos
+    return round(emprestado_antes - pago_antes, 2), emprestimos, pagamentos
+
+def db_explicar_consulta(db: SessionLocal, consulta) -> list[str]:
+    """Plano de execução (EXPLAIN QUERY PLAN) de uma consulta no SQLite."""
+    compilada = consulta.compile(dialect=engine.dialect)
+    parametros = tuple(
+        v.isoformat() if isinstance(v, DateObject) else v
+        for v in (compilada.params[nome] for nome in compilada.positiontup)
+    )
+    linhas = db.connection().exec_driver_sql("EXPLAIN QUERY PLAN " + str(compilada), parametros).all()
+    return [linha[-1] for linha in linhas]
+
+# --- Alocação FIFO de pagamentos a empréstimos ---
+def _alocar_creditos_pendentes(db: SessionLocal, pessoa_id: int) -> None:
+    """Casa pagamentos com crédito livre e empréstimos em aberto, ambos do mais antigo para o mais novo."""
+    pagamentos = db.query(Pagamento).filter(
+        Pagamento.pessoa_id == pessoa_id, Pagamento.valor_nao_alocado > 0
+    ).order_by(Pagamento.data, Pagamento.id).all()
+    if not pagamentos:
+        return
+    emprestimos = db.query(Emprestimo).filter(
+        Emprestimo.pessoa_id == pessoa_id, Emprestimo.valor_em_aberto > 0
+    ).order_by(Emprestimo.data, Emprestimo.id).all()
+
+    i = j = 0
+    while i < len(pagamentos) and j < len(emprestimos):
+        pagamento, emprestimo = pagamentos[i], emprestimos[j]
+        valor = round(min(pagamento.valor_nao_alocado, emprestimo.valor_em_aberto), 2)
+        db.add(Alocacao(pagamento=pagamento, emprestimo=emprestimo, valor=valor))
+        pagamento.valor_nao_alocado = round(pagamento.valor_nao_alocado - valor, 2)
+        emprestimo.valor_em_aberto = round(emprestimo.valor_em_aberto - valor, 2)
+        if pagamento.valor_nao_alocado <= 0:
+            i += 1
+        if emprestimo.valor_em_aberto <= 0:
+            j += 1
+    db.flush()
+
+def _reconstruir_alocacoes_pessoa(db: SessionLocal, pessoa_id: int) -> None:
+    """Refaz do zero as alocações de uma pessoa (usado quando a ordem FIFO muda)."""
+    db.flush()
+    ids_pagamentos = select(Pagamento.id).where(Pagamento.pessoa_id == pessoa_id)
+    db.query(Alocacao).filter(Alocacao.pagamento_id.in_(ids_pagamentos)).delete(synchronize_session=False)
+    db.query(Emprestimo).filter(Emprestimo.pessoa_id == pessoa_id).update(
+        {Emprestimo.valor_em_aberto: Emprestimo.valor}, synchronize_session=False)
+    db.query(Pagamento).filter(Pagamento.pessoa_id == pessoa_id).update(
+        {Pagamento.valor_nao_alocado: Pagamento.valor}, synchronize_session=False)
+    db.expire_all() # Os updates em massa não atualizam os objetos já carregados
+    _alocar_creditos_pendentes(db, pessoa_id)
+
+def db_reconstruir_alocacoes(db: SessionLocal, pessoa_id: int | None = None) -> int:
+    """Reconstrói as alocações de uma pessoa ou de todas. Retorna quantas pessoas foram processadas."""
+    if pessoa_id is not None:
+        pessoa_ids = [pessoa_id]
+    else:
+        pessoa_ids = [pid for (pid,) in db.query(Pessoa.id).all()]
+    for pid in pessoa_ids:
+        _reconstruir_alocacoes_pessoa(db, pid)
+        _sincronizar_parcelas(db, pid)
+    db.commit()
+    return len(pessoa_ids)
+
+def db_verificar_alocacoes(db: SessionLocal) -> list[str]:
+    """
+    Confere se as alocações persistidas batem com um replay FIFO do histórico.
+    Retorna uma lista de inconsistências (vazia se estiver tudo certo).
+    """
+    problemas = []
+    alocado_por_emprestimo = dict(db.query(Alocacao.emprestimo_id, func.sum(Alocacao.valor)).group_by(Alocacao.emprestimo_id).all())
+    alocado_por_pagamento = dict(db.query(Alocacao.pagamento_id, func.sum(Alocacao.valor)).group_by(Alocacao.pagamento_id).all())
+    pago_por_pessoa = dict(db.query(Pagamento.pessoa_id, func.sum(Pagamento.valor)).group_by(Pagamento.pessoa_id).all())
+
+    for pagamento_id, valor, nao_alocado in db.query(Pagamento.id, Pagamento.valor, Pagamento.valor_nao_alocado).yield_per(DB_STREAM_BATCH):
+        esperado = round(valor - alocado_por_pagamento.get(pagamento_id, 0.0), 2)
+        if nao_alocado is None or abs(esperado - nao_alocado) > 0.005:
+            problemas.append(f"Pagamento {pagamento_id}: não alocado {nao_alocado}, esperado {esperado:.2f}")
+
+    acumulado_por_pessoa: dict[int, float] = {}
+    emprestimos = db.query(Emprestimo.id, Emprestimo.pessoa_id, Emprestimo.valor, Emprestimo.valor_em_aberto).order_by(
+        Emprestimo.pessoa_id, Emprestimo.data, Emprestimo.id).yield_per(DB_STREAM_BATCH)
+    for emprestimo_id, pessoa_id, valor, em_aberto in emprestimos:
+        acumulado = acumulado_por_pessoa.get(pessoa_id, 0.0) + valor
+        acumulado_por_pessoa[pessoa_id] = acumulado
+        esperado_fifo = round(min(max(acumulado - pago_por_pessoa.get(pessoa_id, 0.0), 0.0), valor), 2)
+        esperado_alocacoes = round(valor - alocado_por_emprestimo.get(emprestimo_id, 0.0), 2)
+        if em_aberto is None or abs(esperado_alocacoes - em_aberto) > 0.005:
+            problemas.append(f"Empréstimo {emprestimo_id}: em aberto {em_aberto}, alocações indicam {esperado_alocacoes:.2f}")
+        elif abs(esperado_fifo - em_aberto) > 0.005:
+            problemas.append(f"Empréstimo {emprestimo_id}: em aberto {em_aberto}, FIFO indica {esperado_fifo:.2f}")
+    return problemas
+
+# --- Parcelas ---
+def _somar_meses(data: DateObject, meses: int) -> DateObject:
+    """Mesmo dia `meses` depois, limitado ao fim do mês (31/01 + 1 mês = 28/02 ou 29/02)."""
+    indice = data.month - 1 + meses
+    primeiro = DateObject(data.year + indice // 12, indice % 12 + 1, 1)
+    return primeiro.replace(day=min(data.day, _ultimo_dia_do_mes(primeiro).day))
+
+def gerar_cronograma(valor: float, quantidade: int, data: DateObject) -> list[tuple[DateObject, float]]:
+    """
+    (vencimento, valor) de cada parcela: mensais a partir de um mês depois do
+    empréstimo. A divisão é feita em centavos e os que sobram vão nas primeiras.
+    """
+    base, resto = divmod(round(valor * 100), quantidade)
+    return [(_somar_meses(data, numero), (base + (numero <= resto)) / 100) for numero in range(1, quantidade + 1)]
+
+def _sincronizar_parcelas(db: SessionLocal, pessoa_id: int) -> None:
+    """
+    Distribui o que já foi pago de cada empréstimo parcelado (valor - valor_em_aberto,
+    mantido pelas alocações FIFO) entre as parcelas, da primeira para a última.
+    """
+    linhas = db.query(Parcela, Emprestimo.valor - Emprestimo.valor_em_aberto).join(Parcela.emprestimo).filter(
+        Emprestimo.pessoa_id == pessoa_id).order_by(Parcela.emprestimo_id, Parcela.numero).all()
+    restante: dict[int, float] = {}
+    for parcela, pago in linhas:
+        disponivel = restante.get(parcela.emprestimo_id, round(pago or 0.0, 2))
+        valor_pago = round(min(parcela.valor, max(disponivel, 0.0)), 2)
+        if parcela.valor_pago != valor_pago:
+            parcela.valor_pago = valor_pago
+        restante[parcela.emprestimo_id] = round(disponivel - valor_pago, 2)
+    db.flush()
+
+def _consulta_lembretes_pendentes(hoje: DateObject):
+    return select(Parcela, Emprestimo.descricao, Pessoa.nome).join(Parcela.emprestimo).join(Emprestimo.pessoa).where(
+        Parcela.vencimento <= hoje, Parcela.valor_pago < Parcela.valor, Parcela.lembrete_enviado_em.is_(None)
+    ).order_by(Parcela.vencimento, Parcela.id)
+
+def db_get_parcelas_a_lembrar(db: SessionLocal, hoje: DateObject) -> list[tuple[Parcela, str | None, str]]:
+    """
+    Parcelas vencidas até `hoje`, ainda em aberto e sem lembrete, como (parcela,
+    descrição do empréstimo, nome da pessoa). Um range scan no índice parcial de
+    vencimento, que só contém os lembretes pendentes.
+    """
+    return [tuple(linha) for linha in db.execute(_consulta_lembretes_pendentes(hoje))]
+
+def db_marcar_lembretes_enviados(db: SessionLocal, parcela_ids: list[int], hoje: DateObject) -> None:
+    db.query(Parcela).filter(Parcela.id.in_(parcela_ids)).update(
+        {Parcela.lembrete_enviado_em: hoje}, synchronize_session=False)
     db.commit()
-    db.refresh(pagamento)
-    return pagamento
 
-def db_get_transacoes_pessoa(db: SessionLocal, pessoa_id: int) -> tuple[list[Emprestimo], list[Pagamento]]:
-    emprestimos = db.query(Emprestimo).filter(Emprestimo.pessoa_id == pessoa_id).order_by(Emprestimo.data.desc(), Emprestimo.id.desc()).all()
-    pagamentos = db.query(Pagamento).filter(Pagamento.pessoa_id == pessoa_id).order_by(Pagamento.data.desc(), Pagamento.id.desc()).all()
-    return emprestimos, pagamentos
\ No newline at end of file
+def db_get_resumo_parcelas(db: SessionLocal, emprestimo_ids: list[int]) -> dict[int, tuple[int, int, DateObject | None]]:
+    """{emprestimo_id: (parcelas pagas, total de parcelas, próximo vencimento em aberto)}, numa consulta só."""
+    em_aberto = Parcela.valor_pago < Parcela.valor
+    linhas = db.query(
+        Parcela.emprestimo_id,
+        func.sum(case((em_aberto, 0), else_=1)),
+        func.count(Parcela.id),
+        func.min(case((em_aberto, Parcela.vencimento))),
+    ).filter(Parcela.emprestimo_id.in_(emprestimo_ids)).group_by(Parcela.emprestimo_id)
+    return {emprestimo_id: (pagas, total, proximo) for emprestimo_id, pagas, total, proximo in linhas}
+
+def db_get_emprestimos_em_aberto(db: SessionLocal, pessoa_id: int) -> list[Emprestimo]:
+    """Empréstimos ainda não quitados, do mais antigo para o mais novo (usa o índice parcial)."""
+    return db.query(Emprestimo).filter(
+        Emprestimo.pessoa_id == pessoa_id, Emprestimo.valor_em_aberto > 0
+    ).order_by(Emprestimo.data, Emprestimo.id).all()
+
+# --- Busca por descrição ---
+_PALAVRAS_IGNORADAS_BUSCA = {"o", "a", "os", "as", "de", "do", "da", "dos", "das", "em", "no", "na",
+                             "para", "pra", "pro", "e", "um", "uma", "com"}
+
+def _termos_busca(consulta: str) -> list[str]:
+    termos = re.findall(r"\w+", consulta.lower())
+    relevantes = [t for t in termos if t not in _PALAVRAS_IGNORADAS_BUSCA]
+    return relevantes or termos
+
+def db_buscar_transacoes(db: SessionLocal, consulta: str, limite: int = 10, deslocamento: int = 0
+                         ) -> tuple[list[Emprestimo | Pagamento | EmprestimoArquivado | PagamentoArquivado], int]:
+    """
+    Busca empréstimos e pagamentos pela descrição, inclusive os arquivados. Retorna
+    (página de resultados, total). Com FTS5 os resultados vêm ordenados por
+    relevância (bm25); sem FTS5, por data (LIKE).
+    """
+    termos = _termos_busca(consulta)
+    if not termos:
+        return [], 0
+
+    if busca_textual_disponivel():
+        # Cada termo vira um prefixo entre aspas: "cine"* casa com "cinema"
+        expressao = " ".join(f'"{t}"*' for t in termos)
+        total = db.execute(text(
+            "SELECT (SELECT count(*) FROM transacoes_fts WHERE transacoes_fts MATCH :q)"
+            " + (SELECT count(*) FROM arquivo_fts WHERE arquivo_fts MATCH :q)"
+        ), {"q": expressao}).scalar()
+        encontrados = db.execute(text(
+            "SELECT rowid, 0 AS arquivado, rank FROM transacoes_fts WHERE transacoes_fts MATCH :q"
+            " UNION ALL SELECT rowid, 1, rank FROM arquivo_fts WHERE arquivo_fts MATCH :q"
+            " ORDER BY rank LIMIT :limite OFFSET :deslocamento"
+        ), {"q": expressao, "limite": limite, "deslocamento": deslocamento}).all()
+        # (arquivado, paridade do rowid) -> modelo
+        modelos = {(0, 0): Emprestimo, (0, 1): Pagamento, (1, 0): EmprestimoArquivado, (1, 1): PagamentoArquivado}
+        por_chave = {}
+        for (arquivado, paridade), modelo in modelos.items():
+            ids = [rowid // 2 for rowid, arq, _ in encontrados if arq == arquivado and rowid % 2 == paridade]
+            if ids:
+                for t in db.query(modelo).options(joinedload(modelo.pessoa)).filter(modelo.id.in_(ids)):
+                    por_chave[(arquivado, t.id * 2 + paridade)] = t
+        return [por_chave[(arq, rowid)] for rowid, arq, _ in encontrados if (arq, rowid) in por_chave], total
+
+    # Fallback (ex: PostgreSQL): LIKE em cada termo, mais recentes primeiro. As quatro
+    # tabelas viram um UNION ALL só, então ordenação e página ficam no banco
+    modelos = (Emprestimo, Pagamento, EmprestimoArquivado, PagamentoArquivado)
+    encontrados = union_all(*[
+        select(literal(origem).label("origem"), modelo.id.label("id"), modelo.data.label("data")).where(
+            *[modelo.descricao.ilike(f"%{t}%") for t in termos])
+        for origem, modelo in enumerate(modelos)
+    ]).subquery()
+    total = db.execute(select(func.count()).select_from(encontrados)).scalar()
+    pagina = db.execute(select(encontrados.c.origem, encontrados.c.id).order_by(
+        encontrados.c.data.desc(), encontrados.c.id.desc(), encontrados.c.origem
+    ).limit(limite).offset(deslocamento)).all()
+    por_chave = {}
+    for origem, modelo in enumerate(modelos):
+        ids = [id_ for o, id_ in pagina if o == origem]
+        if ids:
+            for t in db.query(modelo).options(joinedload(modelo.pessoa)).filter(modelo.id.in_(ids)):
+                por_chave[(origem, t.id)] = t
+    return [por_chave[chave] for chave in map(tuple, pagina) if chave in por_chave], total
+
+# --- Rollups mensais de saldo ---
+def _ajustar_saldo_mensal(db: SessionLocal, pessoa_id: int, data: DateObject, emprestado: float = 0.0, pago: float = 0.0) -> None:
+    """
+    Soma um movimento ao rollup do mês e propaga a diferença para o saldo final
+    daquele mês e dos seguintes. Valores negativos desfazem um movimento.
+    """
+    _ajustar_saldos_mensais(db, data, {pessoa_id: (emprestado, pago)})
+
+def _ajustar_saldos_mensais(db: SessionLocal, data: DateObject, movimentos: dict[int, tuple[float, float]]) -> None:
+    """_ajustar_saldo_mensal para várias pessoas no mesmo mês ({pessoa_id: (emprestado, pago)}), com consultas em lote."""
+    mes = data.replace(day=1)
+    pessoa_ids = list(movimentos)
+    linhas = {linha.pessoa_id: linha for linha in db.query(SaldoMensal).filter(
+        SaldoMensal.pessoa_id.in_(pessoa_ids), SaldoMensal.mes == mes)}
+    faltando = [pessoa_id for pessoa_id in pessoa_ids if pessoa_id not in linhas]
+    if faltando: # Mês novo começa com o saldo final do último mês com movimento
+        ultimo_mes = select(SaldoMensal.pessoa_id, func.max(SaldoMensal.mes).label("mes")).where(
+            SaldoMensal.pessoa_id.in_(faltando), SaldoMensal.mes < mes).group_by(SaldoMensal.pessoa_id).subquery()
+        saldos_anteriores = dict(db.query(SaldoMensal.pessoa_id, SaldoMensal.saldo_final).join(
+            ultimo_mes, (SaldoMensal.pessoa_id == ultimo_mes.c.pessoa_id) & (SaldoMensal.mes == ultimo_mes.c.mes)).all())
+        for pessoa_id in faltando:
+            linhas[pessoa_id] = SaldoMensal(pessoa_id=pessoa_id, mes=mes, emprestado=0.0, pago=0.0,
+                                            saldo_final=saldos_anteriores.get(pessoa_id, 0.0))
+            db.add(linhas[pessoa_id])
+    for pessoa_id, (emprestado, pago) in movimentos.items():
+        linha = linhas[pessoa_id]
+        linha.emprestado = round(linha.emprestado + emprestado, 2)
+        linha.pago = round(linha.pago + pago, 2)
+    db.flush()
+    variacao = case({pessoa_id: emprestado - pago for pessoa_id, (emprestado, pago) in movimentos.items()}, value=SaldoMensal.pessoa_id)
+    db.query(SaldoMensal).filter(SaldoMensal.pessoa_id.in_(pessoa_ids), SaldoMensal.mes >= mes).update(
+        {SaldoMensal.saldo_final: SaldoMensal.saldo_final + variacao},
+        synchronize_session=False)
+    for linha in linhas.values():
+        db.expire(linha)
+
+def db_reconstruir_saldos_mensais(db: SessionLocal) -> None:
+    """Recalcula todos os rollups mensais a partir de empréstimos e pagamentos."""
+    db.query(SaldoMensal).delete(synchronize_session=False)
+    movimentos: dict[tuple[int, DateObject], list[float]] = {}
+    for modelo, posicao in ((Emprestimo, 0), (EmprestimoArquivado, 0), (Pagamento, 1), (PagamentoArquivado, 1)):
+        for pessoa_id, data, total in db.query(modelo.pessoa_id, modelo.data, func.sum(modelo.valor)).group_by(modelo.pessoa_id, modelo.data):
+            chave = (pessoa_id, data.replace(day=1))
+            movimentos.setdefault(chave, [0.0, 0.0])[posicao] += total
+    saldo_por_pessoa: dict[int, float] = {}
+    linhas = []
+    for (pessoa_id, mes), (emprestado, pago) in sorted(movimentos.items()):
+        saldo = round(saldo_por_pessoa.get(pessoa_id, 0.0) + emprestado - pago, 2)
+        saldo_por_pessoa[pessoa_id] = saldo
+        linhas.append({"pessoa_id": pessoa_id, "mes": mes, "emprestado": round(emprestado, 2), "pago": round(pago, 2), "saldo_final": saldo})
+    if linhas: # Um executemany só (INSERT com várias linhas por comando no PostgreSQL)
+        db.execute(insert(SaldoMensal), linhas)
+    db.commit()
+
+def db_get_serie_saldo(db: SessionLocal, pessoa_id: int | None = None) -> list[tuple[DateObject, float]]:
+    """Saldo ao fim de cada mês com movimento, de uma pessoa ou geral (pessoa_id=None)."""
+    if pessoa_id is not None:
+        return [(mes, saldo) for mes, saldo in db.query(SaldoMensal.mes, SaldoMensal.saldo_final).filter(
+            SaldoMensal.pessoa_id == pessoa_id).order_by(SaldoMensal.mes)]
+    serie, saldo = [], 0.0
+    for mes, variacao in db.query(SaldoMensal.mes, func.sum(SaldoMensal.emprestado - SaldoMensal.pago)).group_by(
+            SaldoMensal.mes).order_by(SaldoMensal.mes):
+        saldo = round(saldo + variacao, 2)
+        serie.append((mes, saldo))
+    return serie
+
+def db_get_saldos(db: SessionLocal, pessoa_ids: list[int]) -> dict[int, float]:
+    """Saldo atual de várias pessoas numa consulta só (soma dos rollups mensais)."""
+    linhas = db.query(SaldoMensal.pessoa_id, func.sum(SaldoMensal.emprestado - SaldoMensal.pago)).filter(
+        SaldoMensal.pessoa_id.in_(pessoa_ids)).group_by(SaldoMensal.pessoa_id)
+    return {pessoa_id: round(saldo, 2) for pessoa_id, saldo in linhas}
+
+# --- Arquivamento de períodos quitados ---
+# Quando o saldo de uma pessoa zera, tudo até ali já foi casado entre si (FIFO):
+# esses empréstimos e pagamentos somam o mesmo valor e não afetam nada depois.
+# Eles saem das tabelas quentes, mas saldos_mensais continua com o histórico
+# todo, então saldos, gráficos e envelhecimento não mudam. As parcelas de um
+# empréstimo arquivado vão junto para parcelas_arquivadas: se o período for
+# reaberto, o FIFO refeito pode deixá-las em aberto de novo.
+_COLUNAS_ARQUIVADAS = ("valor", "data", "descricao", "data_criacao", "pessoa_id", "chave_idempotencia")
+_COLUNAS_PARCELAS = ("numero", "valor", "vencimento", "valor_pago", "lembrete_enviado_em")
+
+def _ultimo_dia_do_mes(mes: DateObject) -> DateObject:
+    return (mes.replace(day=1) + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+
+def db_get_fim_arquivado(db: SessionLocal, pessoa_id: int) -> DateObject | None:
+    """Última data arquivada da pessoa: tudo até ela está nas tabelas de arquivo."""
+    return db.query(func.max(PeriodoArquivado.fim)).filter(PeriodoArquivado.pessoa_id == pessoa_id).scalar()
+
+def db_get_resumo_arquivado(db: SessionLocal, pessoa_id: int) -> tuple[int, float, DateObject | None]:
+    """(transações arquivadas, total emprestado nelas, que é igual ao pago, última data arquivada)."""
+    quantidade, total, fim = db.query(
+        func.coalesce(func.sum(PeriodoArquivado.emprestimos + PeriodoArquivado.pagamentos), 0),
+        func.coalesce(func.sum(PeriodoArquivado.total), 0.0),
+        func.max(PeriodoArquivado.fim),
+    ).filter(PeriodoArquivado.pessoa_id == pessoa_id).one()
+    return quantidade, round(total, 2), fim
+
+def _arquivar_ate(db: SessionLocal, pessoa_id: int, fim: DateObject) -> PeriodoArquivado | None:
+    """Move as transações quentes da pessoa até `fim` para o arquivo, se estiverem todas quitadas."""
+    filtro_emprestimos = (Emprestimo.pessoa_id == pessoa_id, Emprestimo.data <= fim)
+    filtro_pagamentos = (Pagamento.pessoa_id == pessoa_id, Pagamento.data <= fim)
+    emprestado, n_emprestimos, inicio_emprestimos, em_aberto = db.query(
+        func.coalesce(func.sum(Emprestimo.valor), 0.0), func.count(Emprestimo.id), func.min(Emprestimo.data),
+        func.coalesce(func.sum(Emprestimo.valor_em_aberto), 0.0)).filter(*filtro_emprestimos).one()
+    pago, n_pagamentos, inicio_pagamentos, nao_alocado = db.query(
+        func.coalesce(func.sum(Pagamento.valor), 0.0), func.count(Pagamento.id), func.min(Pagamento.data),
+        func.coalesce(func.sum(Pagamento.valor_nao_alocado), 0.0)).filter(*filtro_pagamentos).one()
+    if n_emprestimos + n_pagamentos == 0:
+        return None
+    if abs(emprestado - pago) > 0.005 or em_aberto > 0.005 or nao_alocado > 0.005:
+        # Rollup ou alocações fora de sincronia com as transações: não arquiva às cegas
+        logger.warning(f"Arquivamento: pessoa {pessoa_id} não está quitada até {fim} nas transações; use /reconciliar.")
+        return None
+
+    ids_emprestimos = select(Emprestimo.id).where(*filtro_emprestimos)
+    ids_pagamentos = select(Pagamento.id).where(*filtro_pagamentos)
+    db.query(Alocacao).filter(or_(Alocacao.emprestimo_id.in_(ids_emprestimos), Alocacao.pagamento_id.in_(ids_pagamentos))).delete(synchronize_session=False)
+    # Linhas de arquivo acima deste id são as criadas agora: liga cada parcela ao seu empréstimo arquivado
+    ultimo_arquivado = db.query(func.coalesce(func.max(EmprestimoArquivado.id), 0)).scalar()
+    for modelo, arquivo, filtro in ((Emprestimo, EmprestimoArquivado, filtro_emprestimos), (Pagamento, PagamentoArquivado, filtro_pagamentos)):
+        colunas = [getattr(modelo, nome) for nome in _COLUNAS_ARQUIVADAS]
+        db.execute(insert(arquivo).from_select(["id_original", *_COLUNAS_ARQUIVADAS], select(modelo.id, *colunas).where(*filtro)))
+        if modelo is Emprestimo: # Antes do delete, que apaga as parcelas em cascata
+            db.execute(insert(ParcelaArquivada).from_select(
+                ["emprestimo_arquivado_id", *_COLUNAS_PARCELAS],
+                select(EmprestimoArquivado.id, *[getattr(Parcela, nome) for nome in _COLUNAS_PARCELAS]).join(
+                    EmprestimoArquivado, EmprestimoArquivado.id_original == Parcela.emprestimo_id
+                ).where(EmprestimoArquivado.pessoa_id == pessoa_id, EmprestimoArquivado.id > ultimo_arquivado)))
+        db.query(modelo).filter(*filtro).delete(synchronize_session=False)
+
+    periodo = PeriodoArquivado(
+        pessoa_id=pessoa_id, inicio=min(d for d in (inicio_emprestimos, inicio_pagamentos) if d is not None), fim=fim,
+        emprestimos=n_emprestimos, pagamentos=n_pagamentos, total=round(emprestado, 2))
+    db.add(periodo)
+    db.flush()
+    return periodo
+
+def db_arquivar_periodos_quitados(db: SessionLocal, idade_minima_dias: int = ARCHIVE_AFTER_DAYS,
+                                  hoje: DateObject | None = None) -> dict[int, int]:
+    """
+    Arquiva, por pessoa, tudo até o último fim de mês com saldo zero que tenha pelo
+    menos `idade_minima_dias`. Um commit por pessoa, para não segurar o banco numa
+    transação longa. Retorna {pessoa_id: transações arquivadas}.
+    """
+    limite = (hoje or datetime.now().date()) - timedelta(days=idade_minima_dias)
+    corte = (limite + timedelta(days=1)).replace(day=1) # Meses anteriores a este terminam até o limite
+    candidatos = db.query(SaldoMensal.pessoa_id, func.max(SaldoMensal.mes)).filter(
+        func.abs(SaldoMensal.saldo_final) < 0.005, SaldoMensal.mes < corte
+    ).group_by(SaldoMensal.pessoa_id).all()
+
+    arquivadas = {}
+    for pessoa_id, mes in candidatos:
+        fim = _ultimo_dia_do_mes(mes)
+        fim_arquivado = db_get_fim_arquivado(db, pessoa_id)
+        if fim_arquivado and fim_arquivado >= fim:
+            continue
+        periodo = _arquivar_ate(db, pessoa_id, fim)
+        if periodo is None:
+            db.rollback()
+            continue
+        arquivadas[pessoa_id] = periodo.emprestimos + periodo.pagamentos
+        db.commit()
+    return arquivadas
+
+def _desarquivar_a_partir(db: SessionLocal, pessoa_ids: list[int], data: DateObject) -> set[int]:
+    """
+    Uma transação nova com data dentro de um período arquivado muda o FIFO dele:
+    os períodos que terminam em `data` ou depois voltam para as tabelas quentes
+    (com ids novos), com os cronogramas de parcelas. Retorna as pessoas que
+    tiveram algo de volta; o chamador refaz as alocações e parcelas delas.
+    """
+    periodos = db.query(PeriodoArquivado).filter(
+        PeriodoArquivado.pessoa_id.in_(pessoa_ids), PeriodoArquivado.fim >= data).all()
+    if not periodos:
+        return set()
+    desde_por_pessoa: dict[int, DateObject] = {}
+    for periodo in periodos:
+        desde_por_pessoa[periodo.pessoa_id] = min(periodo.inicio, desde_por_pessoa.get(periodo.pessoa_id, periodo.inicio))
+    for pessoa_id, desde in desde_por_pessoa.items():
+        _restaurar_emprestimos_arquivados(db, pessoa_id, desde)
+        filtro = (PagamentoArquivado.pessoa_id == pessoa_id, PagamentoArquivado.data >= desde)
+        colunas = [getattr(PagamentoArquivado, nome) for nome in _COLUNAS_ARQUIVADAS]
+        db.execute(insert(Pagamento).from_select(
+            [*_COLUNAS_ARQUIVADAS, "valor_nao_alocado"],
+            select(*colunas, PagamentoArquivado.valor.label("valor_nao_alocado")).where(*filtro).order_by(PagamentoArquivado.id)))
+        db.query(PagamentoArquivado).filter(*filtro).delete(synchronize_session=False)
+    for periodo in periodos:
+        db.delete(periodo)
+    db.flush()
+    for pessoa_id in desde_por_pessoa:
+        reabertos = sum(periodo.pessoa_id == pessoa_id for periodo in periodos)
+        logger.info(f"Pessoa {pessoa_id}: transação em {data} reabriu {reabertos} período(s) arquivado(s).")
+    return set(desde_por_pessoa)
+
+# Data como dias desde 1970-01-01, o inteiro por trás do datetime64[D] do NumPy
+_SQL_DIAS_DESDE_1970 = {
+    "postgresql": "data - DATE '1970-01-01'",
+    "sqlite": "CAST(julianday(data) - 2440587.5 AS INTEGER)",
+}
+
+def _restaurar_emprestimos_arquivados(db: SessionLocal, pessoa_id: int, desde: DateObject) -> None:
+    """
+    Devolve os empréstimos arquivados da pessoa a partir de `desde` e as parcelas
+    deles. O INSERT ... RETURNING em lote devolve os ids novos na ordem das
+    linhas, e é isso que liga cada parcela ao seu empréstimo restaurado.
+    """
+    filtro = (EmprestimoArquivado.pessoa_id == pessoa_id, EmprestimoArquivado.data >= desde)
+    arquivados = db.execute(select(EmprestimoArquivado.id, *[getattr(EmprestimoArquivado, nome) for nome in _COLUNAS_ARQUIVADAS]).where(
+        *filtro).order_by(EmprestimoArquivado.id)).all()
+    if not arquivados:
+        return
+    novos_ids = db.execute(insert(Emprestimo).returning(Emprestimo.id, sort_by_parameter_order=True), [
+        {**dict(zip(_COLUNAS_ARQUIVADAS, colunas)), "valor_em_aberto": colunas[0]} for _, *colunas in arquivados
+    ]).scalars().all()
+    id_restaurado = {arquivado.id: novo_id for arquivado, novo_id in zip(arquivados, novos_ids)}
+
+    ids_arquivados = select(EmprestimoArquivado.id).where(*filtro)
+    parcelas = db.execute(select(ParcelaArquivada.emprestimo_arquivado_id, *[getattr(ParcelaArquivada, nome) for nome in _COLUNAS_PARCELAS]).where(
+        ParcelaArquivada.emprestimo_arquivado_id.in_(ids_arquivados))).all()
+    if parcelas:
+        db.execute(insert(Parcela), [
+            {"emprestimo_id": id_restaurado[emprestimo_arquivado_id], **dict(zip(_COLUNAS_PARCELAS, colunas))}
+            for emprestimo_arquivado_id, *colunas in parcelas
+        ])
+        db.query(ParcelaArquivada).filter(ParcelaArquivada.emprestimo_arquivado_id.in_(ids_arquivados)).delete(synchronize_session=False)
+    db.query(EmprestimoArquivado).filter(*filtro).delete(synchronize_session=False)
+
+def db_get_colunas_envelhecimento(db: SessionLocal) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Retorna as colunas para o relatório de envelhecimento como arrays NumPy:
+    (pessoa_ids, datas datetime64[D], valores em aberto) dos empréstimos ainda
+    não quitados. O valor_em_aberto já é o resultado das alocações FIFO, então
+    os pagamentos não precisam ser lidos, e os empréstimos quitados (a maior
+    parte do histórico) ficam fora do índice parcial que serve a consulta.
+    """
+    dias = _SQL_DIAS_DESDE_1970.get(engine.dialect.name, _SQL_DIAS_DESDE_1970["sqlite"])
+    emprestimos = _ler_array(db, f"SELECT pessoa_id, {dias}, valor_em_aberto FROM emprestimos WHERE valor_em_aberto > 0",
+                             [("pessoa_id", "i8"), ("dias", "i8"), ("em_aberto", "f8")])
+    return emprestimos["pessoa_id"], emprestimos["dias"].astype("datetime64[D]"), emprestimos["em_aberto"]
+
+def _ler_array(db: SessionLocal, sql: str, campos: list[tuple[str, str]]) -> np.ndarray:
+    """
+    Lê uma consulta grande direto do cursor do driver para um array estruturado,
+    sem criar um Row do SQLAlchemy por linha (que custava ~10x o tempo do driver).
+    No PostgreSQL o cursor é nomeado (no servidor) e lido em lotes de
+    DB_STREAM_BATCH linhas, então nem o driver guarda todas as linhas de uma vez.
+    """
+    conexao = db.connection().connection # Conexão DBAPI da transação da sessão
+    if engine.dialect.name == "postgresql":
+        cursor = conexao.cursor(name="paytrack_leitura_grande")
+        cursor.itersize = DB_STREAM_BATCH
+    else:
+        cursor = conexao.cursor()
+    try:
+        cursor.execute(sql)
+        return np.fromiter(cursor, dtype=np.dtype(campos))
+    finally:
+        cursor.close()
+
+# --- Inicialização do banco ---
+def inicializar_banco() -> None:
+    """
+    Cria e migra o schema, a busca textual e os dados derivados que bancos de
+    versões anteriores não têm. Importar este módulo não toca no banco: isto roda
+    uma vez, no processo principal, antes de subir os workers do dispatcher.
+    """
+    global _busca_textual
+    tabelas_existentes = set(inspect(engine).get_table_names())
+    Base.metadata.create_all(bind=engine)
+    colunas_migradas = _migrar_schema()
+    _busca_textual = _configurar_busca_textual()
+
+    # Bancos antigos ganharam as colunas de alocação agora: preenche a partir do histórico
+    if ("emprestimos", "valor_em_aberto") in colunas_migradas or ("pagamentos", "valor_nao_alocado") in colunas_migradas:
+        with SessionLocal() as db:
+            db_reconstruir_alocacoes(db)
+
+    # Idem para os rollups mensais, criados depois do histórico existir
+    if "emprestimos" in tabelas_existentes and "saldos_mensais" not in tabelas_existentes:
+        with SessionLocal() as db:
+            db_reconstruir_saldos_mensais(db)
+
+# Verificação local dos planos de consulta do extrato: python database.py
+if __name__ == "__main__":
+    if engine.dialect.name != "sqlite":
+        raise SystemExit("A verificação de planos usa EXPLAIN QUERY PLAN do SQLite.")
+    inicializar_banco()
+    hoje = datetime.now().date()
+    with SessionLocal() as db:
+        for modelo, indice in ((Emprestimo, "ix_emprestimos_pessoa_data"), (Pagamento, "ix_pagamentos_pessoa_data")):
+            for consulta in (_consulta_total_anterior(modelo, 1, hoje), _consulta_movimentos(modelo, 1, hoje, hoje)):
+                plano = db_explicar_consulta(db, consulta)
+                print(f"{modelo.__tablename__}: {plano}")
+                assert any(indice in passo and "SEARCH" in passo for passo in plano), f"Índice {indice} não usado: {plano}"
+                assert not any("TEMP B-TREE" in passo for passo in plano), f"Ordenação fora do índice: {plano}"
+    print("✅ Extrato servido por range scans nos índices (pessoa_id, data, id).")
+    with SessionLocal() as db:
+        plano = db_explicar_consulta(db, _consulta_lembretes_pendentes(hoje))
+        print(f"parcelas: {plano}")
+        assert any("ix_parcelas_lembretes_pendentes" in passo and "SEARCH" in passo for passo in plano), f"Índice de vencimento não usado: {plano}"
+    print("✅ Lembretes de parcelas servidos por range scan no índice parcial de vencimento.")
@@ -0,0 +1,440 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+from urllib.parse import urlparse
+
+from telegram import Bot, Update
+from telegram.error import NetworkError, TelegramError
+from telegram.ext import Application
+from telegram.request import HTTPXRequest
+
+from database import notificar_alteracoes, registrar_ouvinte_alteracoes
+
+logger = logging.getLogger(__name__)
+
+# Sem resposta do event loop de um worker por mais que isso, ele é reiniciado
+WORKER_HEARTBEAT_TIMEOUT = float(os.getenv("PAYTRACK_WORKER_HEARTBEAT_TIMEOUT", "30"))
+# Tempo para os workers terminarem os updates pendentes no encerramento
+WORKER_SHUTDOWN_TIMEOUT = float(os.getenv("PAYTRACK_WORKER_SHUTDOWN_TIMEOUT", "15"))
+POLL_TIMEOUT = 10 # Long polling do getUpdates, em segundos
+
+# Mensagens nas filas dos workers: (_UPDATE, dados) | (_ALTERACOES, pessoas_alteradas, pessoa_ids) | None (encerrar)
+# Na fila de controle (worker -> supervisor): (indice, _ALTERACOES, pessoas_alteradas, pessoa_ids) | (indice, _CONCLUIDO, update_id)
+_UPDATE = "update"
+_ALTERACOES = "alteracoes"
+_CONCLUIDO = "concluido"
+
+# fabrica(total_de_workers, indice_do_worker) -> Application
+FabricaAplicacao = Callable[[int, int], Application]
+
+
+def chave_particao(dados: dict) -> int:
+    """
+    Usuário (ou chat) de um update cru da Bot API. Todos os updates de um usuário vão
+    para o mesmo worker, preservando a ordem das conversas e o user_data.
+    """
+    for campo, valor in dados.items():
+        if campo == "update_id" or not isinstance(valor, dict):
+            continue
+        remetente = valor.get("from") or valor.get("user")
+        if remetente:
+            return remetente["id"]
+        chat = valor.get("chat") or (valor.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+    return dados.get("update_id", 0)
+
+
+# --- Worker ---
+def _executar_worker(fabrica: FabricaAplicacao, indice: int, total: int, leitor, fila_controle, batimentos) -> None:
+    # Quem encerra o worker é o supervisor (sentinela no pipe), não o sinal do terminal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_laco_worker(fabrica, indice, total, leitor, fila_controle, batimentos))
+
+
+async def _bater_coracao(batimentos, indice: int) -> None:
+    while True:
+        batimentos[indice] = time.time()
+        await asyncio.sleep(1)
+
+
+def _receber_do_pipe(leitor):
+    try:
+        if not leitor.poll(1.0):
+            return False, None
+        return True, leitor.recv()
+    except EOFError: # Supervisor morreu: encerra
+        return True, None
+
+
+def _receber_da_fila(fila):
+    try:
+        return True, fila.get(timeout=1.0)
+    except queue.Empty:
+        return False, None
+
+
+async def _laco_worker(fabrica: FabricaAplicacao, indice: int, total: int, leitor, fila_controle, batimentos) -> None:
+    application = fabrica(total, indice)
+
+    # Caches em memória (índice de nomes, saldos) são por processo: as alterações
+    # feitas aqui são repassadas aos outros workers pelo supervisor
+    def _propagar_alteracoes(pessoas_alteradas: bool, pessoa_ids: set[int]) -> None:
+        fila_controle.put((indice, _ALTERACOES, pessoas_alteradas, sorted(pessoa_ids)))
+    registrar_ouvinte_alteracoes(_propagar_alteracoes)
+
+    # Confirma cada update ao supervisor só depois de processado (com ou sem erro):
+    # até lá ele o guarda para reenviar se este worker morrer
+    processar_update = application.process_update
+    async def _processar_e_confirmar(update: object) -> None:
+        try:
+            await processar_update(update)
+        finally:
+            if isinstance(update, Update):
+                fila_controle.put((indice, _CONCLUIDO, update.update_id))
+    application.process_update = _processar_e_confirmar
+
+    loop = asyncio.get_running_loop()
+    # Mesma sequência do run_polling(), sem o Updater
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    batimento = asyncio.create_task(_bater_coracao(batimentos, indice))
+    logger.info(f"Worker {indice} pronto.")
+    try:
+        while True:
+            recebida, mensagem = await loop.run_in_executor(None, _receber_do_pipe, leitor)
+            if not recebida:
+                continue
+            if mensagem is None:
+                break
+            if mensagem[0] == _UPDATE:
+                # A fila de updates da Application é processada em ordem
+                await application.update_queue.put(Update.de_json(mensagem[1], application.bot))
+            elif mensagem[0] == _ALTERACOES:
+                notificar_alteracoes(mensagem[1], set(mensagem[2]), exceto=_propagar_alteracoes)
+    finally:
+        batimento.cancel()
+        await application.stop() # Termina os updates já enfileirados
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        logger.info(f"Worker {indice} encerrado.")
+
+
+# --- Ingresso por webhook ---
+class _ReceptorWebhook(BaseHTTPRequestHandler):
+    def do_POST(self):
+        servidor = self.server
+        if self.path != servidor.caminho:
+            self.send_response(404)
+        elif servidor.segredo and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != servidor.segredo:
+            self.send_response(403)
+        else:
+            tamanho = int(self.headers.get("Content-Length", 0))
+            try:
+                servidor.rotear(json.loads(self.rfile.read(tamanho)))
+                self.send_response(200) # Na fila local: daqui em diante só o dispatcher tem o update
+            except (ValueError, KeyError) as e:
+                logger.warning(f"Update inválido recebido no webhook: {e}")
+                self.send_response(400)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+# --- Supervisor ---
+class _CanalWorker:
+    """
+    Entrega das mensagens de um worker: fila local sem limite mais uma thread que
+    escreve no pipe do processo. O pipe tem um único leitor (sem lock compartilhado),
+    então um worker morto não trava o canal.
+    Cada update escrito no pipe fica em `_em_andamento` até o worker confirmar
+    que o processou (`concluir`). Ao reiniciar o worker, esses updates voltam para
+    a frente da fila, na ordem original, antes dos que ainda não tinham sido
+    enviados. A entrega passa a ser "pelo menos uma vez": as escritas idempotentes
+    (chave da mensagem de confirmação) evitam gravar de novo um update que o
+    worker morto já tinha gravado sem confirmar.
+    """
+
+    def __init__(self, ctx, indice: int):
+        self._ctx = ctx
+        self._indice = indice
+        self._condicao = threading.Condition() # Protege _pendentes e _em_andamento
+        self._envio = threading.Lock() # Um send por vez; a troca de pipe espera o send em curso
+        self._pendentes: deque = deque()
+        self._em_andamento: dict[int, tuple] = {} # update_id -> mensagem, na ordem de envio
+        self._escritor = None
+        self._thread = threading.Thread(target=self._enviar, name=f"paytrack-canal-{indice}", daemon=True)
+
+    def novo_pipe(self):
+        leitor, escritor = self._ctx.Pipe(duplex=False)
+        with self._envio: # O worker antigo já morreu: um send em curso falha logo
+            antigo, self._escritor = self._escritor, escritor
+            with self._condicao:
+                if self._em_andamento:
+                    logger.warning(f"Worker {self._indice}: reenviando {len(self._em_andamento)} update(s) "
+                                   f"não confirmado(s): {list(self._em_andamento)}.")
+                    self._pendentes.extendleft(reversed(self._em_andamento.values()))
+                    self._em_andamento.clear()
+                    self._condicao.notify()
+        if antigo is not None:
+            antigo.close()
+        if not self._thread.is_alive():
+            self._thread.start()
+        return leitor
+
+    def put(self, mensagem) -> None:
+        with self._condicao:
+            self._pendentes.append(mensagem)
+            self._condicao.notify()
+
+    def concluir(self, update_id: int) -> None:
+        with self._condicao:
+            self._em_andamento.pop(update_id, None)
+
+    def nao_confirmados(self) -> list[int]:
+        """update_ids entregues ao worker ou ainda na fila, sem confirmação de que foram processados."""
+        with self._condicao:
+            return [*self._em_andamento, *(m[1]["update_id"] for m in self._pendentes if m and m[0] == _UPDATE)]
+
+    def __len__(self) -> int:
+        return len(self._pendentes)
+
+    def _enviar(self) -> None:
+        while True:
+            with self._condicao:
+                while not self._pendentes:
+                    self._condicao.wait()
+                mensagem = self._pendentes.popleft()
+                update_id = mensagem[1]["update_id"] if mensagem and mensagem[0] == _UPDATE else None
+                if update_id is not None:
+                    self._em_andamento[update_id] = mensagem
+            with self._envio:
+                with self._condicao:
+                    if update_id is not None and update_id not in self._em_andamento:
+                        continue # Um novo pipe já devolveu este update à fila
+                try:
+                    self._escritor.send(mensagem)
+                except (OSError, ValueError): # Worker morto: espera o próximo pipe
+                    if update_id is None: # Updates ficam em _em_andamento; o resto volta à fila
+                        with self._condicao:
+                            self._pendentes.appendleft(mensagem)
+                    time.sleep(0.1)
+                    continue
+            if mensagem is None:
+                return
+
+class Dispatcher:
+    """
+    Processo de ingresso: recebe os updates (long polling ou webhook) e os distribui
+    por filas locais para N processos worker, cada um com sua própria Application.
+    Supervisiona os workers pelo batimento e os reinicia se morrerem ou travarem;
+    os updates que o worker reiniciado ainda não tinha confirmado são reenviados.
+    Janela de perda: o Telegram considera o update entregue assim que ele entra
+    na fila local (offset do getUpdates ou HTTP 200 do webhook). Se o próprio
+    processo de ingresso morrer sem encerrar (kill -9, falta de memória), o que
+    estava nas filas se perde; num encerramento normal, o que sobrar sem
+    processar é registrado no log com os update_ids.
+    """
+
+    def __init__(
+        self,
+        fabrica: FabricaAplicacao,
+        workers: int,
+        token: str | None = None,
+        base_url: str | None = None,
+        webhook_url: str | None = None,
+    ):
+        self._fabrica = fabrica
+        self.workers = workers
+        self._token = token or os.getenv("TELEGRAM_BOT_TOKEN")
+        self._base_url = base_url or os.getenv("TELEGRAM_API_BASE_URL") or "https://api.telegram.org/bot"
+        self._webhook_url = webhook_url or os.getenv("PAYTRACK_WEBHOOK_URL")
+        self._ctx = multiprocessing.get_context("spawn")
+        self._canais = [_CanalWorker(self._ctx, indice) for indice in range(workers)]
+        self._fila_controle = self._ctx.Queue()
+        self._batimentos = self._ctx.Array("d", workers)
+        self.processos: list[multiprocessing.Process | None] = [None] * workers
+        self.reinicios = 0
+        self.updates_roteados = 0
+        self._parar: asyncio.Event | None = None
+
+    def rotear(self, dados: dict) -> None:
+        indice = chave_particao(dados) % self.workers
+        self._canais[indice].put((_UPDATE, dados))
+        self.updates_roteados += 1
+
+    def parar(self) -> None:
+        if self._parar:
+            self._parar.set()
+
+    def _iniciar_worker(self, indice: int) -> None:
+        self._batimentos[indice] = time.time() # Prazo para o primeiro batimento
+        leitor = self._canais[indice].novo_pipe()
+        processo = self._ctx.Process(
+            target=_executar_worker,
+            args=(self._fabrica, indice, self.workers, leitor, self._fila_controle, self._batimentos),
+            name=f"paytrack-worker-{indice}",
+        )
+        processo.start()
+        # Só o worker fica com o lado de leitura: se ele morrer, a escrita falha em vez de acumular
+        leitor.close()
+        self.processos[indice] = processo
+
+    def _reiniciar_worker(self, indice: int) -> None:
+        self.reinicios += 1
+        self._iniciar_worker(indice)
+
+    async def _supervisionar(self) -> None:
+        while not self._parar.is_set():
+            agora = time.time()
+            for indice, processo in enumerate(self.processos):
+                if not processo.is_alive():
+                    logger.warning(f"Worker {indice} terminou (código {processo.exitcode}); reiniciando.")
+                    self._reiniciar_worker(indice)
+                elif agora - self._batimentos[indice] > WORKER_HEARTBEAT_TIMEOUT:
+                    logger.warning(f"Worker {indice} sem batimento há {agora - self._batimentos[indice]:.0f}s; reiniciando.")
+                    processo.kill()
+                    processo.join()
+                    self._reiniciar_worker(indice)
+            try:
+                await asyncio.wait_for(self._parar.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _repassar_alteracoes(self) -> None:
+        loop = asyncio.get_running_loop()
+        while not self._parar.is_set():
+            recebida, mensagem = await loop.run_in_executor(None, _receber_da_fila, self._fila_controle)
+            if not recebida:
+                continue
+            origem, tipo, *dados = mensagem
+            if tipo == _CONCLUIDO:
+                self._canais[origem].concluir(dados[0])
+                continue
+            for indice, canal in enumerate(self._canais):
+                if indice != origem:
+                    canal.put((_ALTERACOES, *dados))
+
+    async def _ingresso_polling(self) -> None:
+        # Duas conexões para o getUpdates: a confirmação final do offset não espera
+        # a liberação da conexão do long polling cancelado
+        bot = Bot(self._token, base_url=self._base_url, get_updates_request=HTTPXRequest(connection_pool_size=2))
+        async with bot:
+            await bot.delete_webhook()
+            offset = None
+            try:
+                while True:
+                    try:
+                        updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT, allowed_updates=Update.ALL_TYPES)
+                    except NetworkError as e:
+                        logger.warning(f"Falha no getUpdates: {e}")
+                        await asyncio.sleep(1)
+                        continue
+                    for update in updates:
+                        self.rotear(update.to_dict())
+                        offset = update.update_id + 1
+            finally:
+                if offset is not None: # Confirma os updates já distribuídos
+                    try:
+                        await bot.get_updates(offset=offset, timeout=0, limit=1)
+                    except TelegramError as e:
+                        logger.warning(f"Não foi possível confirmar o offset {offset}: {e}")
+
+    async def _ingresso_webhook(self) -> None:
+        porta = int(os.getenv("PAYTRACK_WEBHOOK_PORT", "8443"))
+        segredo = os.getenv("PAYTRACK_WEBHOOK_SECRET")
+        servidor = ThreadingHTTPServer(("0.0.0.0", porta), _ReceptorWebhook)
+        servidor.caminho = urlparse(self._webhook_url).path or "/"
+        servidor.segredo = segredo
+        servidor.rotear = self.rotear
+        thread = threading.Thread(target=servidor.serve_forever, name="paytrack-webhook", daemon=True)
+        thread.start()
+        try:
+            async with Bot(self._token, base_url=self._base_url) as bot:
+                await bot.set_webhook(self._webhook_url, secret_token=segredo, allowed_updates=Update.ALL_TYPES)
+            logger.info(f"Webhook em {self._webhook_url} (porta {porta}).")
+            await asyncio.Event().wait() # Até ser cancelado
+        finally:
+            servidor.shutdown()
+            servidor.server_close()
+
+    async def _encerrar_workers(self) -> None:
+        loop = asyncio.get_running_loop()
+        for canal in self._canais:
+            canal.put(None)
+        prazo = time.time() + WORKER_SHUTDOWN_TIMEOUT
+        for indice, processo in enumerate(self.processos):
+            await loop.run_in_executor(None, processo.join, max(0.0, prazo - time.time()))
+            if processo.is_alive():
+                logger.warning(f"Worker {indice} não encerrou a tempo; finalizando à força.")
+                processo.kill()
+                processo.join()
+        # Confirmações que chegaram depois que o repasse parou
+        while True:
+            try:
+                origem, tipo, *dados = self._fila_controle.get_nowait()
+            except queue.Empty:
+                break
+            if tipo == _CONCLUIDO:
+                self._canais[origem].concluir(dados[0])
+        # Já confirmados ao Telegram (offset/HTTP 200), então não voltam na próxima execução
+        for indice, canal in enumerate(self._canais):
+            perdidos = canal.nao_confirmados()
+            if perdidos:
+                logger.error(f"Worker {indice}: {len(perdidos)} update(s) recebido(s) e não processado(s) "
+                             f"no encerramento: {perdidos}.")
+
+    def _ingresso_terminou(self, tarefa: asyncio.Task) -> None:
+        if not tarefa.cancelled() and tarefa.exception():
+            logger.error(f"Ingresso de updates falhou: {tarefa.exception()!r}")
+        self.parar() # Sem ingresso não há o que distribuir
+
+    async def executar(self) -> None:
+        self._parar = asyncio.Event()
+        for indice in range(self.workers):
+            self._iniciar_worker(indice)
+        ingresso = self._ingresso_webhook() if self._webhook_url else self._ingresso_polling()
+        tarefas = [
+            asyncio.create_task(self._supervisionar()),
+            asyncio.create_task(self._repassar_alteracoes()),
+        ]
+        tarefa_ingresso = asyncio.create_task(ingresso)
+        tarefa_ingresso.add_done_callback(self._ingresso_terminou)
+        logger.info(f"Dispatcher em execução com {self.workers} workers...")
+        try:
+            await self._parar.wait()
+        finally:
+            self._parar.set()
+            tarefa_ingresso.cancel()
+            await asyncio.gather(tarefa_ingresso, *tarefas, return_exceptions=True)
+            await self._encerrar_workers()
+            logger.info("Dispatcher encerrado.")
+
+
+def executar_dispatcher(fabrica: FabricaAplicacao, workers: int) -> None:
+    """Ponto de entrada do modo multiprocesso (PAYTRACK_WORKERS > 1)."""
+    dispatcher = Dispatcher(fabrica, workers)
+
+    async def _principal():
+        loop = asyncio.get_running_loop()
+        for sinal in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sinal, dispatcher.parar)
+        await dispatcher.executar()
+
+    asyncio.run(_principal())
@@ -0,0 +1,65 @@
+from dataclasses import dataclass
+
+from name_index import normalizar
+
+
+@dataclass
+class Divisao:
+    partes: list[tuple[int, float]]  # (pessoa_id, valor) na ordem da seleção
+    parte_usuario: float             # 0.0 se o usuário não entra na divisão
+    total: float
+
+
+def _dividir_centavos(valor: float, quantidade: int) -> list[float]:
+    """Divisão igual em centavos; os que sobram vão para os primeiros."""
+    base, resto = divmod(round(valor * 100), quantidade)
+    return [(base + (i < resto)) / 100 for i in range(quantidade)]
+
+
+def _resolver_nome(nome: str, pessoas: list[tuple[int, str]]) -> int:
+    """Pessoa selecionada com esse nome, ou com um nome que começa por ele ('joao' -> 'João Silva')."""
+    alvo = normalizar(nome).strip()
+    exatas = [pid for pid, nome_pessoa in pessoas if normalizar(nome_pessoa) == alvo]
+    if len(exatas) == 1:
+        return exatas[0]
+    por_prefixo = [pid for pid, nome_pessoa in pessoas if alvo and normalizar(nome_pessoa).startswith(alvo)]
+    if len(por_prefixo) == 1:
+        return por_prefixo[0]
+    raise ValueError(f"\"{nome}\" não corresponde a uma das pessoas selecionadas.")
+
+
+def calcular_partes(total: float, pessoas: list[tuple[int, str]], partes_explicitas: dict[str, float],
+                    inclui_usuario: bool) -> Divisao:
+    """
+    Quanto cada pessoa selecionada deve. Os valores explícitos valem como estão;
+    o resto do total é dividido igualmente entre as demais pessoas (e o usuário,
+    se ele entra na divisão). Lança ValueError se as partes não fecham com o total.
+    """
+    fixas: dict[int, float] = {}
+    for nome, valor in partes_explicitas.items():
+        pessoa_id = _resolver_nome(nome, pessoas)
+        if pessoa_id in fixas:
+            raise ValueError(f"Mais de um valor para a mesma pessoa (\"{nome}\").")
+        fixas[pessoa_id] = round(float(valor), 2)
+
+    resto = round(total - sum(fixas.values()), 2)
+    if resto < 0:
+        raise ValueError(f"As partes somam R$ {sum(fixas.values()):.2f}, mais que o total de R$ {total:.2f}.")
+    restantes = [pid for pid, _ in pessoas if pid not in fixas]
+    participantes = len(restantes) + inclui_usuario
+    if participantes == 0:
+        if resto > 0:
+            raise ValueError(f"As partes somam R$ {sum(fixas.values()):.2f}, mas o total é R$ {total:.2f}.")
+        divididos = []
+    else:
+        divididos = _dividir_centavos(resto, participantes)
+
+    valores = dict(fixas)
+    valores.update(zip(restantes, divididos)) # O usuário, se entra, fica com a última parte
+    if any(valor <= 0 for valor in valores.values()):
+        raise ValueError(f"R$ {total:.2f} não dá para dividir entre {len(pessoas) + inclui_usuario} pessoas.")
+    return Divisao(
+        partes=[(pid, valores[pid]) for pid, _ in pessoas],
+        parte_usuario=divididos[-1] if inclui_usuario else 0.0,
+        total=round(total, 2),
+    )
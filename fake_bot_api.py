@@ -0,0 +1,332 @@
+"""
+Bot API falsa, em memória, para testar o bot localmente sem falar com o Telegram.
+Aponte o bot para ela com TELEGRAM_API_BASE_URL=<api.url_base>.
+
+Teste de ponta a ponta do modo dispatcher: python fake_bot_api.py
+"""
+import itertools
+import json
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+BOT_ID = 4242
+
+
+def _decodificar_valor(valor: str):
+    # A PTB envia strings cruas e o resto (números, listas, objetos) como JSON
+    try:
+        return json.loads(valor)
+    except ValueError:
+        return valor
+
+
+class _ManipuladorApi(BaseHTTPRequestHandler):
+    def do_POST(self):
+        api = self.server.api
+        _, _, resto = self.path.partition("/bot")
+        token, _, metodo = resto.partition("/")
+        if token != api.token:
+            self._responder(401, {"ok": False, "error_code": 401, "description": "Unauthorized"})
+            return
+        corpo = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        parametros = self._ler_parametros(corpo)
+        resultado = api.tratar(metodo, parametros)
+        self._responder(200, {"ok": True, "result": resultado})
+
+    def _ler_parametros(self, corpo: bytes) -> dict:
+        tipo = self.headers.get("Content-Type", "")
+        if tipo.startswith("multipart/form-data"):
+            mensagem = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {tipo}\r\n\r\n".encode() + corpo)
+            parametros = {}
+            for parte in mensagem.iter_parts():
+                nome = parte.get_param("name", header="content-disposition")
+                if parte.get_filename():
+                    parametros[nome] = parte.get_payload(decode=True)
+                else:
+                    parametros[nome] = _decodificar_valor(parte.get_content())
+            return parametros
+        if tipo.startswith("application/json"):
+            return json.loads(corpo or b"{}")
+        return {chave: _decodificar_valor(valor) for chave, valor in parse_qsl(corpo.decode())}
+
+    def _responder(self, status: int, dados: dict) -> None:
+        corpo = json.dumps(dados).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers()
+        try:
+            self.wfile.write(corpo)
+        except (BrokenPipeError, ConnectionResetError): # Long polling cancelado pelo cliente
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ApiTelegramFalsa:
+    """
+    Servidor HTTP que imita os métodos da Bot API usados pelo bot. Updates são
+    injetados com `enviar_mensagem`/`clicar_botao` e entregues pelo getUpdates;
+    tudo que o bot envia fica registrado em `chamadas`.
+    """
+
+    def __init__(self, token: str = "123456:FALSO", host: str = "127.0.0.1", porta: int = 0):
+        self.token = token
+        self._servidor = ThreadingHTTPServer((host, porta), _ManipuladorApi)
+        self._servidor.api = self
+        self._thread: threading.Thread | None = None
+        self._condicao = threading.Condition()
+        self._updates: list[dict] = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self.chamadas: list[tuple[str, dict]] = [] # (método, parâmetros)
+
+    @property
+    def url_base(self) -> str:
+        host, porta = self._servidor.server_address[:2]
+        return f"http://{host}:{porta}/bot"
+
+    def iniciar(self) -> "ApiTelegramFalsa":
+        self._thread = threading.Thread(target=self._servidor.serve_forever, name="api-telegram-falsa", daemon=True)
+        self._thread.start()
+        return self
+
+    def parar(self) -> None:
+        self._servidor.shutdown()
+        self._servidor.server_close()
+
+    # --- Updates injetados ---
+    def _usuario(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"Usuário {user_id}"}
+
+    def _mensagem(self, user_id: int, texto: str) -> dict:
+        mensagem = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": f"Usuário {user_id}"},
+            "from": self._usuario(user_id),
+            "text": texto,
+        }
+        if texto.startswith("/"):
+            mensagem["entities"] = [{"type": "bot_command", "offset": 0, "length": len(texto.split()[0])}]
+        return mensagem
+
+    def injetar_update(self, campos: dict) -> int:
+        with self._condicao:
+            update_id = next(self._update_ids)
+            self._updates.append({"update_id": update_id, **campos})
+            self._condicao.notify_all()
+        return update_id
+
+    def enviar_mensagem(self, user_id: int, texto: str) -> int:
+        return self.injetar_update({"message": self._mensagem(user_id, texto)})
+
+    def clicar_botao(self, user_id: int, dados: str) -> int:
+        return self.injetar_update({"callback_query": {
+            "id": str(next(self._message_ids)),
+            "from": self._usuario(user_id),
+            "chat_instance": str(user_id),
+            "data": dados,
+            "message": {**self._mensagem(user_id, "menu"), "from": {"id": BOT_ID, "is_bot": True, "first_name": "PayTrack"}},
+        }})
+
+    def consulta_inline(self, user_id: int, texto: str) -> int:
+        return self.injetar_update({"inline_query": {
+            "id": str(next(self._message_ids)), "from": self._usuario(user_id), "query": texto, "offset": "",
+        }})
+
+    # --- Métodos da Bot API ---
+    def tratar(self, metodo: str, parametros: dict):
+        if metodo == "getMe":
+            return {"id": BOT_ID, "is_bot": True, "first_name": "PayTrack", "username": "paytrack_teste_bot",
+                    "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": True}
+        if metodo == "getUpdates":
+            return self._get_updates(parametros)
+
+        with self._condicao:
+            self.chamadas.append((metodo, parametros))
+            self._condicao.notify_all()
+        if metodo in ("sendMessage", "editMessageText", "sendPhoto", "sendDocument"):
+            chat_id = parametros.get("chat_id", 0)
+            return {
+                "message_id": parametros.get("message_id") or next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": parametros.get("text", ""),
+            }
+        return True # deleteWebhook, answerCallbackQuery, sendChatAction, ...
+
+    def _get_updates(self, parametros: dict) -> list[dict]:
+        offset = int(parametros.get("offset") or 0)
+        limite = int(parametros.get("limit") or 100)
+        prazo = time.time() + float(parametros.get("timeout") or 0)
+        with self._condicao:
+            self._updates = [u for u in self._updates if u["update_id"] >= offset] # Confirmados pelo offset
+            while not self._updates and time.time() < prazo:
+                self._condicao.wait(prazo - time.time())
+            return self._updates[:limite]
+
+    def aguardar_chamadas(self, metodo: str, quantidade: int, timeout: float = 30) -> list[dict]:
+        """Espera até o bot chamar `metodo` pelo menos `quantidade` vezes."""
+        prazo = time.time() + timeout
+        with self._condicao:
+            while True:
+                feitas = [p for m, p in self.chamadas if m == metodo]
+                if len(feitas) >= quantidade:
+                    return feitas
+                if time.time() >= prazo:
+                    raise TimeoutError(f"{metodo}: {len(feitas)} de {quantidade} chamadas em {timeout}s")
+                self._condicao.wait(prazo - time.time())
+
+
+# Teste de ponta a ponta: dispatcher com 3 workers contra a API falsa
+if __name__ == "__main__":
+    import asyncio
+    import os
+    import signal
+    import tempfile
+
+    N_WORKERS, N_USUARIOS = 3, 12
+    # /metricas e o modo inline são só para administradores; 200+ são os usuários do teste de caches
+    ADMINS = [*range(1, N_USUARIOS + 1), *range(200, 200 + 4 * N_WORKERS)]
+
+    api = ApiTelegramFalsa().iniciar()
+    pasta = tempfile.mkdtemp(prefix="paytrack-")
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": api.token,
+        "TELEGRAM_API_BASE_URL": api.url_base,
+        "GEMINI_API_KEY": os.getenv("GEMINI_API_KEY", "falsa"),
+        "DATABASE_URL": f"sqlite:///{pasta}/teste.db",
+        "ADMIN_USER_IDS": ",".join(map(str, ADMINS)),
+        "QUERY_BUDGET_STRICT": "1", # Handler acima de QUERY_BUDGET consultas falha (e não responde)
+    })
+    import bot
+    import database
+    from dispatcher import Dispatcher, chave_particao
+    from session_middleware import QUERY_BUDGET, OrcamentoConsultasExcedido
+    from telegram import Update
+    from telegram.ext import CommandHandler
+
+    database.inicializar_banco() # Como o main() do bot, antes de subir os workers
+    # Histórico para os handlers de leitura: N+1 por pessoa ou transação estoura o orçamento
+    with database.SessionLocal() as db:
+        for i in range(1, 2 * QUERY_BUDGET + 1):
+            pessoa_id = database.db_add_pessoa(db, f"Cliente {i:02d}").id
+            for dia in range(1, 4):
+                database.db_add_emprestimo(db, pessoa_id, 10.0 * dia, f"2025-0{dia}-10", f"compra {dia}")
+            database.db_add_pagamento(db, pessoa_id, 15.0, "2025-04-10", "pix")
+
+    async def _testar_orcamento():
+        """Um handler com N+1 falha na consulta que passa do orçamento, sem gravar nada."""
+        application = bot.construir_aplicacao()
+        erros = []
+        async def n_mais_um(update, context):
+            context.db.add(database.Pessoa(nome="Fantasma"))
+            for pessoa_id in range(1, QUERY_BUDGET + 2):
+                database.db_get_pessoa_by_id(context.db, pessoa_id)
+            context.db.commit()
+        async def registrar_erro(update, context):
+            erros.append(context.error)
+        application.add_handler(CommandHandler("n_mais_um", n_mais_um), group=-1)
+        application.add_error_handler(registrar_erro)
+        async with application:
+            api.enviar_mensagem(1, "/n_mais_um")
+            update = Update.de_json(api._get_updates({})[-1], application.bot)
+            await application.process_update(update)
+        assert len(erros) == 1 and isinstance(erros[0], OrcamentoConsultasExcedido), erros
+        with database.SessionLocal() as db:
+            assert db.query(database.Pessoa).filter_by(nome="Fantasma").count() == 0
+        api._get_updates({"offset": update.update_id + 1}) # Confirma o update do teste
+        print(f"✅ Handler com mais de {QUERY_BUDGET} consultas falhou antes do commit (QUERY_BUDGET_STRICT=1).")
+
+    async def _testar():
+        dispatcher = Dispatcher(bot.construir_aplicacao, N_WORKERS)
+        tarefa = asyncio.create_task(dispatcher.executar())
+
+        # Cada usuário manda /start e depois /metricas: as respostas devem vir nessa ordem
+        for user_id in range(1, N_USUARIOS + 1):
+            api.enviar_mensagem(user_id, "/start")
+            api.enviar_mensagem(user_id, "/metricas")
+        enviadas = await asyncio.to_thread(api.aguardar_chamadas, "sendMessage", 2 * N_USUARIOS, 60)
+        for user_id in range(1, N_USUARIOS + 1):
+            textos = [p["text"] for p in enviadas if p["chat_id"] == user_id]
+            assert len(textos) == 2 and textos[0].startswith("Olá") and "Métricas" in textos[1], textos
+        print(f"✅ {N_USUARIOS} usuários atendidos em ordem por {N_WORKERS} workers.")
+
+        # Supervisão: um worker travado com um update no pipe é morto, reiniciado
+        # e recebe de novo o update que não chegou a processar
+        vitima = 1
+        user_id = next(u for u in itertools.count(100) if chave_particao({"message": {"from": {"id": u}}}) % N_WORKERS == vitima)
+        while any(canal.nao_confirmados() for canal in dispatcher._canais):
+            await asyncio.sleep(0.1) # Confirmações dos updates anteriores (senão também seriam reenviados)
+        os.kill(dispatcher.processos[vitima].pid, signal.SIGSTOP)
+        api.enviar_mensagem(user_id, "/start")
+        while not dispatcher._canais[vitima].nao_confirmados() or len(dispatcher._canais[vitima]):
+            await asyncio.sleep(0.1) # Lido do getUpdates e escrito no pipe do worker parado
+        dispatcher.processos[vitima].kill()
+        while dispatcher.reinicios == 0:
+            await asyncio.sleep(0.1)
+        enviadas = await asyncio.to_thread(api.aguardar_chamadas, "sendMessage", 2 * N_USUARIOS + 1, 60)
+        assert dispatcher.reinicios == 1 and enviadas[-1]["chat_id"] == user_id
+        await asyncio.sleep(0.5) # Confirmação do worker novo chegando ao supervisor
+        assert dispatcher._canais[vitima].nao_confirmados() == [], dispatcher._canais[vitima].nao_confirmados()
+        print("✅ Worker morto foi reiniciado e processou o update que tinha ficado no pipe.")
+
+        # Caches por processo: pessoa cadastrada num worker aparece no inline de outro
+        usuario_a, usuario_b = next(
+            (a, b) for a in itertools.count(200) for b in range(a + 1, a + N_WORKERS)
+            if chave_particao({"message": {"from": {"id": a}}}) % N_WORKERS != chave_particao({"message": {"from": {"id": b}}}) % N_WORKERS
+        )
+        api.consulta_inline(usuario_b, "")
+        await asyncio.to_thread(api.aguardar_chamadas, "answerInlineQuery", 1, 60) # Índice carregado (vazio) em B
+        api.clicar_botao(usuario_a, "add_pessoa_start")
+        api.enviar_mensagem(usuario_a, "Maria Souza")
+        await asyncio.to_thread(api.aguardar_chamadas, "sendMessage", 2 * N_USUARIOS + 3, 60)
+        await asyncio.sleep(1) # Repasse da alteração pelo supervisor
+        api.consulta_inline(usuario_b, "mar")
+        respostas = await asyncio.to_thread(api.aguardar_chamadas, "answerInlineQuery", 2, 60)
+        assert [r["title"] for r in respostas[-1]["results"]] == ["Maria Souza"], respostas[-1]
+        print("✅ Alteração feita num worker invalidou os caches dos outros.")
+
+        api.consulta_inline(999, "mar") # Fora de ADMIN_USER_IDS
+        respostas = await asyncio.to_thread(api.aguardar_chamadas, "answerInlineQuery", 3, 60)
+        assert respostas[-1]["results"] == [], respostas[-1]
+        print("✅ Consulta inline de quem não é administrador não vê saldos.")
+
+        restritos = ["/envelhecimento", "/extrato", "/grafico", "/buscar compra"]
+        enviadas = len([p for m, p in api.chamadas if m == "sendMessage"])
+        for comando in restritos:
+            api.enviar_mensagem(999, comando)
+        enviadas = await asyncio.to_thread(api.aguardar_chamadas, "sendMessage", enviadas + len(restritos), 60)
+        assert all(p["chat_id"] == 999 and p["text"].startswith("🚫") for p in enviadas[-len(restritos):]), enviadas[-len(restritos):]
+        print(f"✅ {', '.join(c.split()[0] for c in restritos)} recusados para quem não é administrador.")
+
+        # Handlers de leitura dentro do orçamento (com QUERY_BUDGET_STRICT=1, quem passa não responde)
+        comandos = ["/status", "/pessoas", "/buscar compra", "/envelhecimento", "/reconciliar", "/grafico", "/extrato"]
+        enviadas = len([p for m, p in api.chamadas if m == "sendMessage"])
+        for comando in comandos:
+            api.enviar_mensagem(usuario_a, comando)
+        enviadas = await asyncio.to_thread(api.aguardar_chamadas, "sendMessage", enviadas + len(comandos), 60)
+        assert all(p["chat_id"] == usuario_a for p in enviadas[-len(comandos):])
+        editadas = len([p for m, p in api.chamadas if m == "editMessageText"])
+        api.clicar_botao(usuario_a, "list_pessoas")
+        api.enviar_mensagem(usuario_a, "/status")
+        api.clicar_botao(usuario_a, "status_sel_p_1")
+        await asyncio.to_thread(api.aguardar_chamadas, "editMessageText", editadas + 2, 60)
+        print(f"✅ {len(comandos) + 2} handlers de leitura com {2 * QUERY_BUDGET} pessoas ficaram dentro de {QUERY_BUDGET} consultas.")
+
+        dispatcher.parar()
+        await asyncio.wait_for(tarefa, timeout=30)
+        assert all(not p.is_alive() for p in dispatcher.processos)
+        print("✅ Encerramento gracioso de todos os workers.")
+
+    try:
+        asyncio.run(_testar_orcamento())
+        asyncio.run(_testar())
+    finally:
+        api.parar()
@@ -1,6 +1,7 @@
 import google.generativeai as genai
 import os
 import json
+import time
 from datetime import datetime, timedelta, date as DateObject
 import re
 from typing import Union, Optional # Adicione esta linha
@@ -25,31 +26,34 @@ safety_settings = [
     {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
 ]
 
+MODEL_NAME = "gemini-1.5-flash-latest" # Um modelo rápido e eficiente para essa tarefa
+MAX_INSTALLMENTS = 120 # Parcelas aceitas num empréstimo parcelado
+
 model = genai.GenerativeModel(
-    model_name="gemini-1.5-flash-latest", # Um modelo rápido e eficiente para essa tarefa
+    model_name=MODEL_NAME,
     generation_config=generation_config,
     safety_settings=safety_settings
 )
 
-def parse_relative_date(text_date: str) -> Optional[DateObject]:
+def parse_relative_date(text_date: str, hoje: DateObject | None = None) -> Optional[DateObject]:
     """Converte 'hoje', 'ontem', 'anteontem' para datas."""
-    today = datetime.now().date()
+    today = hoje or datetime.now().date()
     text_date_lower = text_date.lower()
     if "hoje" in text_date_lower:
         return today
+    elif "anteontem" in text_date_lower: # Antes de "ontem", que está contido nele
+        return today - timedelta(days=2)
     elif "ontem" in text_date_lower:
         return today - timedelta(days=1)
-    elif "anteontem" in text_date_lower:
-        return today - timedelta(days=2)
     # Adicionar mais casos se necessário (ex: "amanhã", "semana passada")
     return None
 
-def normalize_date_string(date_str: str) -> str | None:
+def normalize_date_string(date_str: str, hoje: DateObject | None = None) -> str | None:
     """
     Tenta normalizar uma string de data para YYYY-MM-DD.
     Aceita DD/MM/YYYY, DD-MM-YYYY, DD.MM.YYYY e casos relativos.
     """
-    relative_date = parse_relative_date(date_str)
+    relative_date = parse_relative_date(date_str, hoje)
     if relative_date:
         return relative_date.strftime("%Y-%m-%d")
 
@@ -82,120 +86,233 @@ def normalize_date_string(date_str: str) -> str | None:
     return None
 
 
-def extract_transaction_data(text_input: str, transaction_type: str) -> dict:
-    """
-    Usa a Gemini API para extrair valor, data e descrição.
-    Retorna um dicionário com 'valor', 'data' (YYYY-MM-DD), 'descricao', ou 'error'.
-    """
-    prompt = f"""
+def build_prompt(text_input: str, transaction_type: str, hoje: DateObject) -> str:
+    """Monta o prompt de extração. A data de referência entra no texto, então fixá-la torna o prompt reproduzível."""
+    hoje_iso = hoje.strftime('%Y-%m-%d')
+    ontem_iso = (hoje - timedelta(days=1)).strftime('%Y-%m-%d')
+    return f"""
     Você é um assistente inteligente especializado em extrair informações financeiras de texto em linguagem natural para um sistema de controle de dívidas.
     Analise o texto a seguir, que se refere a um(a) '{transaction_type}', e extraia o VALOR monetário, a DATA da transação e uma DESCRIÇÃO.
 
     Regras de Extração:
     1. VALOR: Deve ser um número decimal. Extraia apenas o número (ex: "200", "150.75"). Se houver "reais", "R$", ignore.
     2. DATA:
-        - Converta datas relativas como "hoje", "ontem", "anteontem" para o formato YYYY-MM-DD. Considere a data atual: {datetime.now().date().strftime('%Y-%m-%d')}.
+        - Converta datas relativas como "hoje", "ontem", "anteontem" para o formato YYYY-MM-DD. Considere a data atual: {hoje_iso}.
         - Se for uma data específica (ex: "10/05/2025", "dia 5 do mês passado"), converta para YYYY-MM-DD.
-        - Se nenhuma data for explicitamente mencionada, assuma a data de HOJE ({datetime.now().date().strftime('%Y-%m-%d')}).
+        - Se nenhuma data for explicitamente mencionada, assuma a data de HOJE ({hoje_iso}).
     3. DESCRIÇÃO: Capture o propósito da transação (ex: "pagar o conserto do carro", "lanche", "referente ao aluguel"). Se não houver descrição clara, pode ser uma string vazia ou um valor padrão como "{transaction_type.capitalize()}".
+    4. PARCELAS (apenas empréstimos): se o texto falar em parcelas (ex: "em 6 parcelas", "6x de 50", "dividido em 3 vezes"), inclua "parcelas" com o número de parcelas e use como VALOR o total (em "6x de 50", o valor é 300). Sem parcelamento, não inclua o campo.
 
     Formato de Saída (JSON estrito):
     {{
       "valor": <numero_decimal_ou_inteiro>,
       "data": "<YYYY-MM-DD>",
-      "descricao": "<texto_da_descricao_opcional>"
+      "descricao": "<texto_da_descricao_opcional>",
+      "parcelas": <inteiro_opcional>
     }}
 
     Exemplos:
-    - Texto: "Emprestei 200 reais ontem para pagar o conserto do carro" (Empréstimo, Hoje é {datetime.now().date().strftime('%Y-%m-%d')})
-      JSON: {{"valor": 200, "data": "{(datetime.now().date() - timedelta(days=1)).strftime('%Y-%m-%d')}", "descricao": "pagar o conserto do carro"}}
-    - Texto: "Ela pagou 150.50 reais hoje" (Pagamento, Hoje é {datetime.now().date().strftime('%Y-%m-%d')})
-      JSON: {{"valor": 150.50, "data": "{datetime.now().date().strftime('%Y-%m-%d')}", "descricao": "Pagamento"}}
+    - Texto: "Emprestei 200 reais ontem para pagar o conserto do carro" (Empréstimo, Hoje é {hoje_iso})
+      JSON: {{"valor": 200, "data": "{ontem_iso}", "descricao": "pagar o conserto do carro"}}
+    - Texto: "Ela pagou 150.50 reais hoje" (Pagamento, Hoje é {hoje_iso})
+      JSON: {{"valor": 150.50, "data": "{hoje_iso}", "descricao": "Pagamento"}}
     - Texto: "emprestei 50 pila pro joao dia 10/05/2025 para o cinema" (Empréstimo)
       JSON: {{"valor": 50, "data": "2025-05-10", "descricao": "para o cinema"}}
     - Texto: "recebi 70 dela em 01-04-2025" (Pagamento)
       JSON: {{"valor": 70, "data": "2025-04-01", "descricao": "Pagamento"}}
-    - Texto: "R$300 para a festa de aniversário" (Empréstimo, sem data explícita, Hoje é {datetime.now().date().strftime('%Y-%m-%d')})
-      JSON: {{"valor": 300, "data": "{datetime.now().date().strftime('%Y-%m-%d')}", "descricao": "para a festa de aniversário"}}
-    - Texto: "Pagou a dívida de 25 pratas." (Pagamento, sem data explícita, Hoje é {datetime.now().date().strftime('%Y-%m-%d')})
-      JSON: {{"valor": 25, "data": "{datetime.now().date().strftime('%Y-%m-%d')}", "descricao": "Pagou a dívida"}}
+    - Texto: "R$300 para a festa de aniversário" (Empréstimo, sem data explícita, Hoje é {hoje_iso})
+      JSON: {{"valor": 300, "data": "{hoje_iso}", "descricao": "para a festa de aniversário"}}
+    - Texto: "Pagou a dívida de 25 pratas." (Pagamento, sem data explícita, Hoje é {hoje_iso})
+      JSON: {{"valor": 25, "data": "{hoje_iso}", "descricao": "Pagou a dívida"}}
+    - Texto: "Emprestei 300 em 6 parcelas para o celular novo" (Empréstimo, Hoje é {hoje_iso})
+      JSON: {{"valor": 300, "data": "{hoje_iso}", "descricao": "para o celular novo", "parcelas": 6}}
+    - Texto: "passei 4x de 25 no cartão pra ela ontem, tênis" (Empréstimo, Hoje é {hoje_iso})
+      JSON: {{"valor": 100, "data": "{ontem_iso}", "descricao": "tênis", "parcelas": 4}}
 
 
     Texto do usuário para '{transaction_type}': "{text_input}"
     JSON extraído:
     """
+
+
+def call_model(prompt: str) -> str:
+    """Única chamada à API (substituível por gravações no benchmark)."""
+    response = model.generate_content([prompt]) # Passar o prompt como uma lista de partes se necessário
+    return response.text
+
+def parse_model_response(response_text: str) -> dict:
+    """Converte a resposta do modelo em dicionário. Lança json.JSONDecodeError se não for JSON."""
+    # Limpeza básica da resposta da API (remover ```json ... ```)
+    cleaned_response_text = response_text.strip()
+    if cleaned_response_text.startswith("```json"):
+        cleaned_response_text = cleaned_response_text[7:]
+    if cleaned_response_text.endswith("```"):
+        cleaned_response_text = cleaned_response_text[:-3]
+    return json.loads(cleaned_response_text)
+
+def _normalize_date_field(data_str, text_input: str, hoje: DateObject) -> str:
+    normalized_date = None
+    if data_str:
+        normalized_date = normalize_date_string(str(data_str), hoje)
+
+    if not normalized_date: # Se ainda não conseguiu normalizar, ou se Gemini retornou algo estranho
+        # Tentar um fallback mais simples ou assumir hoje
+        test_date_norm = normalize_date_string(text_input, hoje) # Tenta achar data no texto original se Gemini falhou
+        if test_date_norm:
+            normalized_date = test_date_norm
+        else:
+            normalized_date = hoje.strftime("%Y-%m-%d") # Fallback final
+    return normalized_date
+
+def normalize_extracted_data(data: dict, text_input: str, transaction_type: str, hoje: DateObject) -> dict:
+    """Valida o valor, normaliza a data para YYYY-MM-DD, preenche a descrição padrão e valida as parcelas."""
+    if not isinstance(data.get("valor"), (int, float)) or data.get("valor") <= 0:
+        return {"error": "Valor monetário inválido ou não encontrado."}
+
+    data["data"] = _normalize_date_field(data.get("data"), text_input, hoje)
+
+    if "descricao" not in data or not data["descricao"]:
+        data["descricao"] = transaction_type.capitalize() # Descrição padrão
+
+    # Parcelas só em empréstimos, e só se for um inteiro entre 2 e MAX_INSTALLMENTS
+    parcelas = data.pop("parcelas", None)
+    if transaction_type == "emprestimo" and isinstance(parcelas, (int, float)) and parcelas == int(parcelas) \
+            and 2 <= parcelas <= MAX_INSTALLMENTS:
+        data["parcelas"] = int(parcelas)
+
+    return data
+
+def extract_transaction_data(text_input: str, transaction_type: str, hoje: DateObject | None = None,
+                             tempos: dict | None = None) -> dict:
+    """
+    Usa a Gemini API para extrair valor, data e descrição.
+    Retorna um dicionário com 'valor', 'data' (YYYY-MM-DD), 'descricao' e, em
+    empréstimos parcelados, 'parcelas'; ou 'error'.
+    Etapas: prompt -> chamada -> parse -> normalização; se `tempos` for passado,
+    recebe a duração de cada etapa em segundos (usado pelo benchmark_extracao.py).
+    """
+    hoje = hoje or datetime.now().date()
+    return _run_extraction(
+        lambda: build_prompt(text_input, transaction_type, hoje),
+        lambda data: normalize_extracted_data(data, text_input, transaction_type, hoje),
+        tempos,
+    )
+
+def _run_extraction(make_prompt, normalize, tempos: dict | None) -> dict:
+    """Etapas comuns às extrações: prompt -> chamada -> parse -> normalização, com os tempos de cada uma."""
+    tempos = tempos if tempos is not None else {}
+    response_text = None
     try:
-        response = model.generate_content([prompt]) # Passar o prompt como uma lista de partes se necessário
-        
-        # Limpeza básica da resposta da API (remover ```json ... ```)
-        cleaned_response_text = response.text.strip()
-        if cleaned_response_text.startswith("```json"):
-            cleaned_response_text = cleaned_response_text[7:]
-        if cleaned_response_text.endswith("```"):
-            cleaned_response_text = cleaned_response_text[:-3]
-        
-        data = json.loads(cleaned_response_text)
-
-        # Validação e normalização dos dados extraídos
-        if not isinstance(data.get("valor"), (int, float)) or data.get("valor") <= 0:
-            return {"error": "Valor monetário inválido ou não encontrado."}
-        
-        data_str = data.get("data")
-        normalized_date = None
-        if data_str:
-            normalized_date = normalize_date_string(str(data_str))
-        
-        if not normalized_date: # Se ainda não conseguiu normalizar, ou se Gemini retornou algo estranho
-            # Tentar um fallback mais simples ou assumir hoje
-            test_date_norm = normalize_date_string(text_input) # Tenta achar data no texto original se Gemini falhou
-            if test_date_norm:
-                normalized_date = test_date_norm
-            else:
-                 normalized_date = datetime.now().date().strftime("%Y-%m-%d") # Fallback final
-
-        data["data"] = normalized_date
-
-        if "descricao" not in data or not data["descricao"]:
-            data["descricao"] = transaction_type.capitalize() # Descrição padrão
+        inicio = time.perf_counter()
+        prompt = make_prompt()
+        tempos["prompt"] = time.perf_counter() - inicio
+
+        inicio = time.perf_counter()
+        response_text = call_model(prompt)
+        tempos["chamada"] = time.perf_counter() - inicio
 
+        inicio = time.perf_counter()
+        data = parse_model_response(response_text)
+        tempos["parse"] = time.perf_counter() - inicio
+
+        inicio = time.perf_counter()
+        data = normalize(data)
+        tempos["normalizacao"] = time.perf_counter() - inicio
         return data
 
     except json.JSONDecodeError:
-        error_msg = f"A IA retornou um formato JSON inválido. Resposta: {response.text if 'response' in locals() else 'N/A'}"
+        error_msg = f"A IA retornou um formato JSON inválido. Resposta: {response_text if response_text is not None else 'N/A'}"
         print(error_msg)
         return {"error": error_msg}
     except Exception as e:
-        error_msg = f"Erro ao processar sua solicitação com a IA: {str(e)}. Resposta da IA (se houver): {response.text if 'response' in locals() else 'N/A'}"
+        error_msg = f"Erro ao processar sua solicitação com a IA: {str(e)}. Resposta da IA (se houver): {response_text if response_text is not None else 'N/A'}"
         print(error_msg)
         return {"error": error_msg}
 
-# Exemplo de uso (para teste local)
+def build_split_prompt(text_input: str, nomes: list[str], hoje: DateObject) -> str:
+    """Prompt da despesa dividida: os nomes das pessoas selecionadas entram no texto para o modelo usar exatamente esses."""
+    hoje_iso = hoje.strftime('%Y-%m-%d')
+    ontem_iso = (hoje - timedelta(days=1)).strftime('%Y-%m-%d')
+    lista_nomes = ", ".join(f'"{nome}"' for nome in nomes)
+    return f"""
+    Você é um assistente que extrai informações de despesas divididas entre várias pessoas para um sistema de controle de dívidas.
+    O usuário pagou a despesa e as pessoas selecionadas devem a ele a parte de cada uma. Pessoas selecionadas: {lista_nomes}.
+
+    Regras de Extração:
+    1. VALOR_TOTAL: o valor total da despesa, como número decimal (ignore "reais", "R$").
+    2. DATA: converta "hoje", "ontem", "anteontem" e datas como "10/05/2025" para YYYY-MM-DD. Considere a data atual: {hoje_iso}. Sem data, use {hoje_iso}.
+    3. DESCRICAO: o que foi a despesa (ex: "churrasco", "jantar"). Sem descrição clara, use "Divisão".
+    4. INCLUI_USUARIO: true somente se o próprio usuário também entra na divisão (ex: "comigo", "eu", "nós", "a gente", "entre nós"). Caso contrário, false.
+    5. PARTES: somente os valores definidos explicitamente no texto para alguém, usando exatamente um dos nomes selecionados. Divisão igual ou "o resto" não entram em PARTES.
+
+    Formato de Saída (JSON estrito):
+    {{
+      "valor_total": <numero_decimal_ou_inteiro>,
+      "data": "<YYYY-MM-DD>",
+      "descricao": "<texto>",
+      "inclui_usuario": <true_ou_false>,
+      "partes": {{"<nome selecionado>": <valor>}}
+    }}
+
+    Exemplos (Hoje é {hoje_iso}):
+    - Texto: "racha 240 do churrasco entre joao, maria e pedro" (Selecionadas: "João", "Maria", "Pedro")
+      JSON: {{"valor_total": 240, "data": "{hoje_iso}", "descricao": "churrasco", "inclui_usuario": false, "partes": {{}}}}
+    - Texto: "pizza de 90 ontem dividida comigo e com a Ana" (Selecionadas: "Ana Souza")
+      JSON: {{"valor_total": 90, "data": "{ontem_iso}", "descricao": "pizza", "inclui_usuario": true, "partes": {{}}}}
+    - Texto: "jantar 200, o joão fica com 80 e o resto divide entre a maria e eu" (Selecionadas: "João", "Maria")
+      JSON: {{"valor_total": 200, "data": "{hoje_iso}", "descricao": "jantar", "inclui_usuario": true, "partes": {{"João": 80}}}}
+    - Texto: "mercado dia 02/06/2025: carla 45,50 e bia 30" (Selecionadas: "Carla", "Beatriz")
+      JSON: {{"valor_total": 75.50, "data": "2025-06-02", "descricao": "mercado", "inclui_usuario": false, "partes": {{"Carla": 45.50, "Beatriz": 30}}}}
+
+
+    Texto do usuário: "{text_input}"
+    JSON extraído:
+    """
+
+def normalize_split_data(data: dict, text_input: str, hoje: DateObject) -> dict:
+    """
+    Valida as partes explícitas (nome -> valor positivo), deduz o total das partes
+    se o modelo não o trouxe, normaliza a data e preenche a descrição padrão.
+    Quem recebe quanto é decidido depois, por divisao.calcular_partes.
+    """
+    partes = data.get("partes") or {}
+    if not isinstance(partes, dict) or not all(
+            isinstance(nome, str) and isinstance(valor, (int, float)) and valor > 0 for nome, valor in partes.items()):
+        return {"error": "Partes da divisão inválidas."}
+
+    valor_total = data.get("valor_total")
+    if not isinstance(valor_total, (int, float)) or valor_total <= 0:
+        if not partes:
+            return {"error": "Valor total inválido ou não encontrado."}
+        valor_total = sum(partes.values())
+
+    return {
+        "valor_total": round(float(valor_total), 2),
+        "data": _normalize_date_field(data.get("data"), text_input, hoje),
+        "descricao": data.get("descricao") or "Divisão",
+        "inclui_usuario": data.get("inclui_usuario") is True,
+        "partes": {nome: round(float(valor), 2) for nome, valor in partes.items()},
+    }
+
+def extract_split_data(text_input: str, nomes: list[str], hoje: DateObject | None = None,
+                       tempos: dict | None = None) -> dict:
+    """
+    Uma chamada só para a despesa dividida entre `nomes`. Retorna 'valor_total',
+    'data' (YYYY-MM-DD), 'descricao', 'inclui_usuario' e 'partes' (valores
+    explícitos por nome), ou 'error'.
+    """
+    hoje = hoje or datetime.now().date()
+    return _run_extraction(
+        lambda: build_split_prompt(text_input, nomes, hoje),
+        lambda data: normalize_split_data(data, text_input, hoje),
+        tempos,
+    )
+
+# Teste rápido de uma frase (para teste local). Para medir a extração num corpus rotulado: python benchmark_extracao.py
 if __name__ == "__main__":
+    import sys
     # Certifique-se de ter GEMINI_API_KEY no seu .env para testar
-    test_cases_emprestimo = [
-        "Emprestei 200 reais ontem para pagar o conserto do carro",
-        "emprestei 50 pila pro joao dia 10/05/2025 para o cinema",
-        "150 reais para maria em 01-04-2025, lanche",
-        "dei 25 para fulano hoje cedo",
-        "emprestimo de 300 para ciclano",
-        "R$ 123,45 para a compra de material dia 2 de fevereiro de 2024", # Testa data por extenso
-        "500 em 1/3/25", # Testa ano com 2 dígitos
-    ]
-    test_cases_pagamento = [
-        "Ela pagou 150 reais hoje",
-        "joao me pagou 25.50 em 12/05/2025 referente ao cinema",
-        "recebi 70 da maria ontem",
-        "pagamento de 100 do ciclano"
-    ]
-
-    print("--- TESTES EMPRÉSTIMO ---")
-    for text in test_cases_emprestimo:
-        print(f"Input: {text}")
-        extracted = extract_transaction_data(text, "emprestimo")
-        print(f"Extracted: {json.dumps(extracted, indent=2, ensure_ascii=False)}\n")
-
-    print("\n--- TESTES PAGAMENTO ---")
-    for text in test_cases_pagamento:
-        print(f"Input: {text}")
-        extracted = extract_transaction_data(text, "pagamento")
-        print(f"Extracted: {json.dumps(extracted, indent=2, ensure_ascii=False)}\n")
\ No newline at end of file
+    tipo = "pagamento" if "--pagamento" in sys.argv else "emprestimo"
+    texto = " ".join(a for a in sys.argv[1:] if a != "--pagamento") or "Emprestei 200 reais ontem para pagar o conserto do carro"
+    print(f"Input ({tipo}): {texto}")
+    print(f"Extracted: {json.dumps(extract_transaction_data(texto, tipo), indent=2, ensure_ascii=False)}")
@@ -0,0 +1,43 @@
+import logging
+import os
+import resource
+import sys
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# Registro simples de métricas (gauges) do processo.
+# Cada gauge é uma função sem argumentos que devolve o valor atual.
+_gauges: dict[str, Callable[[], float]] = {}
+
+
+def registrar_gauge(nome: str, funcao: Callable[[], float]) -> None:
+    """Registra (ou substitui) um gauge consultado sob demanda."""
+    _gauges[nome] = funcao
+
+
+def remover_gauge(nome: str) -> None:
+    _gauges.pop(nome, None)
+
+
+def coletar_metricas() -> dict[str, float]:
+    """Lê o valor atual de todos os gauges registrados."""
+    valores = {}
+    for nome, funcao in sorted(_gauges.items()):
+        try:
+            valores[nome] = funcao()
+        except Exception as e: # Um gauge com problema não deve derrubar os demais
+            valores[nome] = float("nan")
+            logger.warning(f"Erro ao coletar a métrica '{nome}': {e}")
+    return valores
+
+
+def memoria_residente_mb() -> float:
+    """Memória residente (RSS) atual do processo, em MiB. Fora do Linux, o pico (ru_maxrss)."""
+    try:
+        with open("/proc/self/statm") as statm:
+            paginas = int(statm.read().split()[1])
+        return paginas * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError):
+        pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # KiB no Linux, bytes no macOS
+        return pico / (1024 * 1024) if sys.platform == "darwin" else pico / 1024
@@ -0,0 +1,159 @@
+import bisect
+import re
+import threading
+import unicodedata
+from typing import Callable, Iterable
+
+# Palavras comuns em mensagens de transação que nunca fazem parte de um nome
+_PALAVRAS_IGNORADAS = {
+    "emprestei", "emprestimo", "emprestado", "paguei", "pagou", "pagamento", "recebi", "devolveu",
+    "reais", "real", "pila", "pilas", "conto", "contos", "pratas", "hoje", "ontem", "anteontem",
+    "para", "pra", "pro", "com", "dia", "mim", "ele", "ela", "dele", "dela", "que", "uma", "dos", "das",
+}
+
+
+def normalizar(texto: str) -> str:
+    """Minúsculas e sem acentos: 'João' -> 'joao'."""
+    sem_acentos = unicodedata.normalize("NFKD", texto).encode("ascii", "ignore").decode("ascii")
+    return sem_acentos.lower()
+
+
+def _palavras(texto: str) -> list[str]:
+    return re.findall(r"[a-z]+", normalizar(texto))
+
+
+def _trigramas(palavra: str) -> set[str]:
+    preenchida = f"  {palavra} "
+    return {preenchida[i:i + 3] for i in range(len(preenchida) - 2)}
+
+
+def _similaridade(a: set[str], b: set[str]) -> float:
+    """Coeficiente de Dice entre dois conjuntos de trigramas."""
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+class IndiceNomes:
+    """
+    Índice em memória dos nomes das pessoas: trigramas por palavra para casar
+    nomes escritos com erro ou sem acento numa mensagem livre, e uma lista
+    ordenada de palavras para busca por prefixo (modo inline).
+    É marcado como desatualizado a cada alteração em pessoas e recarregado no próximo uso.
+    """
+
+    def __init__(self, carregar: Callable[[], Iterable[tuple[int, str]]]):
+        self._carregar = carregar
+        self._lock = threading.Lock()
+        self._desatualizado = True
+        self._nomes: dict[int, str] = {}
+        self._palavras_por_pessoa: dict[int, list[str]] = {}
+        self._trigramas_palavra: dict[str, set[str]] = {}
+        self._palavras_por_trigrama: dict[str, set[str]] = {}
+        self._pessoas_por_palavra: dict[str, set[int]] = {}
+        self._prefixos: list[tuple[str, int]] = [] # (palavra normalizada, pessoa_id), ordenada
+        self._ordem_alfabetica: list[int] = []
+        self._posicao_alfabetica: dict[int, int] = {}
+
+    def invalidar(self) -> None:
+        self._desatualizado = True
+
+    def reconstruir(self, pessoas: Iterable[tuple[int, str]]) -> None:
+        nomes, palavras_por_pessoa, trigramas_palavra = {}, {}, {}
+        palavras_por_trigrama: dict[str, set[str]] = {}
+        pessoas_por_palavra: dict[str, set[int]] = {}
+        for pessoa_id, nome in pessoas:
+            nomes[pessoa_id] = nome
+            palavras = [p for p in _palavras(nome) if len(p) >= 2]
+            palavras_por_pessoa[pessoa_id] = palavras
+            for palavra in palavras:
+                pessoas_por_palavra.setdefault(palavra, set()).add(pessoa_id)
+                if palavra not in trigramas_palavra:
+                    trigramas_palavra[palavra] = _trigramas(palavra)
+                    for trigrama in trigramas_palavra[palavra]:
+                        palavras_por_trigrama.setdefault(trigrama, set()).add(palavra)
+        prefixos = sorted((palavra, pid) for pid, palavras in palavras_por_pessoa.items() for palavra in set(palavras))
+        ordem_alfabetica = sorted(nomes, key=lambda pid: normalizar(nomes[pid]))
+        with self._lock:
+            self._nomes = nomes
+            self._prefixos = prefixos
+            self._ordem_alfabetica = ordem_alfabetica
+            self._posicao_alfabetica = {pid: i for i, pid in enumerate(ordem_alfabetica)}
+            self._palavras_por_pessoa = palavras_por_pessoa
+            self._trigramas_palavra = trigramas_palavra
+            self._palavras_por_trigrama = palavras_por_trigrama
+            self._pessoas_por_palavra = pessoas_por_palavra
+            self._desatualizado = False
+
+    def _garantir_atualizado(self) -> None:
+        if self._desatualizado:
+            self.reconstruir(self._carregar())
+
+    def nome(self, pessoa_id: int) -> str | None:
+        self._garantir_atualizado()
+        return self._nomes.get(pessoa_id)
+
+    def buscar_prefixo(self, texto: str, limite: int = 20) -> list[int]:
+        """
+        Pessoas cujo nome tem palavras começando com cada palavra digitada
+        ('jo si' -> 'João Silva'). Sem texto, devolve as primeiras em ordem alfabética.
+        """
+        self._garantir_atualizado()
+        termos = _palavras(texto)
+        if not termos:
+            return self._ordem_alfabetica[:limite]
+
+        candidatos = None
+        for termo in termos:
+            inicio = bisect.bisect_left(self._prefixos, (termo,))
+            encontrados = set()
+            for palavra, pessoa_id in self._prefixos[inicio:]:
+                if not palavra.startswith(termo):
+                    break
+                encontrados.add(pessoa_id)
+            candidatos = encontrados if candidatos is None else candidatos & encontrados
+            if not candidatos:
+                return []
+        return sorted(candidatos, key=self._posicao_alfabetica.__getitem__)[:limite]
+
+    def encontrar(self, texto: str, limiar: float = 0.6) -> list[tuple[int, float]]:
+        """
+        Pessoas mencionadas no texto, com pontuação, da mais provável para a menos.
+        A pontuação é a melhor similaridade de uma palavra do nome, com bônus
+        quando outras palavras do nome (ex: sobrenome) também aparecem.
+        """
+        self._garantir_atualizado()
+        melhores: dict[int, dict[str, float]] = {} # pessoa -> palavra do nome -> similaridade
+        for palavra in _palavras(texto):
+            if len(palavra) < 3 or palavra in _PALAVRAS_IGNORADAS:
+                continue
+            trigramas = _trigramas(palavra)
+            candidatas = set()
+            for trigrama in trigramas:
+                candidatas |= self._palavras_por_trigrama.get(trigrama, set())
+            for candidata in candidatas:
+                similaridade = _similaridade(trigramas, self._trigramas_palavra[candidata])
+                if similaridade < limiar:
+                    continue
+                for pessoa_id in self._pessoas_por_palavra[candidata]:
+                    por_palavra = melhores.setdefault(pessoa_id, {})
+                    por_palavra[candidata] = max(por_palavra.get(candidata, 0.0), similaridade)
+
+        resultado = []
+        for pessoa_id, por_palavra in melhores.items():
+            pontuacao = max(por_palavra.values()) + 0.1 * (len(por_palavra) - 1)
+            resultado.append((pessoa_id, round(pontuacao, 3)))
+        resultado.sort(key=lambda r: r[1], reverse=True)
+        return resultado
+
+    def melhor_pessoa(self, texto: str, margem: float = 0.1) -> tuple[int | None, list[int]]:
+        """
+        (pessoa escolhida, candidatas). Se duas pessoas empatam dentro da margem
+        (ex: dois 'João'), nenhuma é escolhida e as candidatas são devolvidas.
+        """
+        encontradas = self.encontrar(texto)
+        if not encontradas:
+            return None, []
+        melhor_id, melhor_pontuacao = encontradas[0]
+        empatadas = [pid for pid, pontuacao in encontradas if melhor_pontuacao - pontuacao < margem]
+        if len(empatadas) > 1:
+            return None, empatadas
+        return melhor_id, [melhor_id]
@@ -0,0 +1,205 @@
+import asyncio
+import cProfile
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+# Desligado por padrão. "sampling": amostras da pilha em outra thread, só depois que o update
+# passa de PROFILE_SAMPLE_AFTER_MS (updates rápidos não pagam nada);
+# "cprofile": cProfile em todo update (custo alto, para reproduzir um caso)
+PAYTRACK_PROFILE = os.getenv("PAYTRACK_PROFILE", "").lower()
+# Só updates mais lentos que isso geram arquivo
+PROFILE_THRESHOLD_MS = float(os.getenv("PAYTRACK_PROFILE_THRESHOLD_MS", "1000"))
+PROFILE_DIR = os.getenv("PAYTRACK_PROFILE_DIR", "perfis")
+PROFILE_MAX_FILES = int(os.getenv("PAYTRACK_PROFILE_MAX_FILES", "50"))
+PROFILE_INTERVAL_MS = float(os.getenv("PAYTRACK_PROFILE_INTERVAL_MS", "5"))
+# A partir de quando o modo sampling começa a amostrar um update (vazio: o próprio limite)
+_amostrar_apos = os.getenv("PAYTRACK_PROFILE_SAMPLE_AFTER_MS")
+PROFILE_SAMPLE_AFTER_MS = float(_amostrar_apos) if _amostrar_apos else None
+
+
+def tipo_e_padrao(update: object) -> tuple[str, str]:
+    """
+    Tipo do update e um padrão estável para agrupar perfis:
+    ('callback_query', 'trans_sel_p_N'), ('message', '/status'), ('message', 'texto').
+    """
+    callback_query = getattr(update, "callback_query", None)
+    if callback_query:
+        return "callback_query", re.sub(r"\d+", "N", callback_query.data or "")
+    message = getattr(update, "message", None)
+    if message:
+        texto = message.text or ""
+        return "message", texto.split()[0].split("@")[0] if texto.startswith("/") else "texto"
+    if getattr(update, "inline_query", None):
+        return "inline_query", "consulta"
+    tipo = next((campo for campo in Update.ALL_TYPES if getattr(update, campo, None) is not None), type(update).__name__)
+    return tipo, "-"
+
+
+def _rotulo(codigo) -> str:
+    return f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{codigo.co_firstlineno})"
+
+
+def _pilha_da_corrotina(tarefa: asyncio.Task) -> list[str]:
+    """Cadeia de awaits da tarefa, da mais externa para a que está esperando."""
+    rotulos = []
+    coro = tarefa.get_coro()
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            rotulos.append(f"<{type(coro).__name__}>") # Future, Task do executor, etc.
+            break
+        rotulos.append(_rotulo(frame.f_code))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return rotulos
+
+
+class _Amostrador(threading.Thread):
+    """
+    Lê a pilha da thread do event loop em intervalos fixos enquanto um update está
+    em andamento, a partir de `atraso` segundos do início dele. Quando o loop está
+    parado no select (esperando I/O), registra a cadeia de awaits do update, para
+    separar espera de banco, Gemini e renderização.
+
+    Antes do atraso a thread só dorme, então um update que termina antes não é
+    amostrado nenhuma vez.
+    """
+
+    def __init__(self, intervalo: float):
+        super().__init__(name="paytrack-amostrador", daemon=True)
+        self._intervalo = intervalo
+        self._lock = threading.Lock()
+        self._ativo = threading.Event()
+        self._alvo: tuple[int, asyncio.Task, float] | None = None # (thread, tarefa, amostrar a partir de)
+        self._pilhas: Counter = Counter()
+
+    def iniciar(self, thread_id: int, tarefa: asyncio.Task, atraso: float = 0.0) -> None:
+        with self._lock:
+            self._pilhas = Counter()
+            self._alvo = (thread_id, tarefa, time.monotonic() + atraso)
+        self._ativo.set()
+
+    def terminar(self) -> Counter:
+        self._ativo.clear()
+        with self._lock:
+            self._alvo = None
+            pilhas, self._pilhas = self._pilhas, Counter()
+        return pilhas
+
+    def _amostrar(self, thread_id: int, tarefa: asyncio.Task) -> tuple[str, ...] | None:
+        frame = sys._current_frames().get(thread_id)
+        if frame is None:
+            return None
+        if frame.f_code.co_name == "select" and frame.f_code.co_filename.endswith("selectors.py"):
+            return ("<aguardando I/O>", *_pilha_da_corrotina(tarefa))
+        rotulos = []
+        while frame is not None:
+            rotulos.append(_rotulo(frame.f_code))
+            frame = frame.f_back
+        return tuple(reversed(rotulos))
+
+    def run(self) -> None:
+        while True:
+            self._ativo.wait()
+            with self._lock:
+                alvo = self._alvo
+            if alvo is not None and (espera := alvo[2] - time.monotonic()) > 0:
+                time.sleep(espera) # Um update novo só pode ter início mais tarde: nada se perde
+                continue
+            with self._lock:
+                if alvo is not None and self._alvo is alvo:
+                    pilha = self._amostrar(*alvo[:2])
+                    if pilha:
+                        self._pilhas[pilha] += 1
+            time.sleep(self._intervalo)
+
+
+class PerfiladorUpdates:
+    """
+    Mede cada update e, quando passa do limite, grava o perfil capturado em
+    PROFILE_DIR (pilhas colapsadas para flamegraph/speedscope, ou .prof do cProfile),
+    mantendo só os PROFILE_MAX_FILES mais recentes. No modo sampling o perfil cobre
+    só o trecho do update depois de `amostrar_apos_ms` (padrão: o próprio limite).
+    """
+
+    def __init__(self, modo: str, limite_ms: float = PROFILE_THRESHOLD_MS, pasta: str = PROFILE_DIR,
+                 max_arquivos: int = PROFILE_MAX_FILES, intervalo_ms: float = PROFILE_INTERVAL_MS,
+                 amostrar_apos_ms: float | None = PROFILE_SAMPLE_AFTER_MS):
+        if modo not in ("sampling", "cprofile"):
+            raise ValueError(f"Modo de profiling desconhecido: {modo!r} (use 'sampling' ou 'cprofile').")
+        self.modo = modo
+        self.limite_ms = limite_ms
+        self.pasta = pasta
+        self.max_arquivos = max_arquivos
+        self.amostrar_apos_ms = limite_ms if amostrar_apos_ms is None else amostrar_apos_ms
+        self.perfis_gravados = 0
+        self._amostrador: _Amostrador | None = None
+        if modo == "sampling":
+            self._amostrador = _Amostrador(intervalo_ms / 1000)
+            self._amostrador.start()
+        os.makedirs(pasta, exist_ok=True)
+
+    @asynccontextmanager
+    async def medir(self, update: object):
+        profiler = None
+        if self._amostrador:
+            self._amostrador.iniciar(threading.get_ident(), asyncio.current_task(), self.amostrar_apos_ms / 1000)
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            duracao_ms = (time.perf_counter() - inicio) * 1000
+            if profiler:
+                profiler.disable()
+            pilhas = self._amostrador.terminar() if self._amostrador else None
+            if duracao_ms >= self.limite_ms:
+                try:
+                    self._gravar(update, duracao_ms, profiler, pilhas)
+                except OSError as e:
+                    logger.error(f"Não foi possível gravar o perfil: {e}")
+
+    def _gravar(self, update: object, duracao_ms: float, profiler, pilhas: Counter | None) -> None:
+        tipo, padrao = tipo_e_padrao(update)
+        nome = f"{datetime.now():%Y%m%d-%H%M%S-%f}_{duracao_ms:.0f}ms_{tipo}_{padrao}"
+        nome = re.sub(r"[^\w.-]+", "_", nome)
+        if profiler:
+            caminho = os.path.join(self.pasta, nome + ".prof")
+            profiler.dump_stats(caminho)
+        else:
+            caminho = os.path.join(self.pasta, nome + ".collapsed")
+            with open(caminho, "w", encoding="utf-8") as arquivo:
+                for pilha, amostras in pilhas.most_common():
+                    arquivo.write(f"{';'.join(pilha)} {amostras}\n")
+        self.perfis_gravados += 1
+        logger.warning(f"Update lento ({tipo} {padrao}, {duracao_ms:.0f} ms): perfil em {caminho}")
+        self._rotacionar()
+
+    def _rotacionar(self) -> None:
+        arquivos = sorted(
+            (os.path.join(self.pasta, nome) for nome in os.listdir(self.pasta) if nome.endswith((".prof", ".collapsed"))),
+            key=os.path.getmtime,
+        )
+        for caminho in arquivos[:max(0, len(arquivos) - self.max_arquivos)]:
+            os.remove(caminho)
+
+
+def criar_perfilador() -> PerfiladorUpdates | None:
+    """Perfilador configurado por PAYTRACK_PROFILE, ou None quando desligado."""
+    if not PAYTRACK_PROFILE:
+        return None
+    perfilador = PerfiladorUpdates(PAYTRACK_PROFILE)
+    logger.info(f"Profiling '{perfilador.modo}' ativo: updates acima de {perfilador.limite_ms:.0f} ms vão para {perfilador.pasta}/")
+    return perfilador
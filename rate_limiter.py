@@ -0,0 +1,219 @@
+import asyncio
+import itertools
+import logging
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Any, Callable, Coroutine
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import registrar_gauge
+
+logger = logging.getLogger(__name__)
+
+# Prioridades aceitas em rate_limit_args={"prioridade": ...}. Menor valor sai primeiro.
+PRIORIDADE_INTERATIVA = 0      # Respostas diretas ao usuário (padrão)
+PRIORIDADE_SEGUNDO_PLANO = 10  # Lembretes, resumos, broadcasts
+
+# Chamadas que não contam para os limites de envio de mensagens
+_ENDPOINTS_SEM_LIMITE = {
+    "getUpdates", "getMe", "getFile", "answerCallbackQuery", "answerInlineQuery",
+    "sendChatAction", "setWebhook", "deleteWebhook", "getWebhookInfo", "setMyCommands",
+}
+
+
+class _BaldeTokens:
+    """Token bucket simples: `taxa` envios a cada `periodo` segundos, com rajada de até `capacidade`."""
+
+    def __init__(self, taxa: float, periodo: float, capacidade: float | None = None):
+        self.capacidade = capacidade if capacidade is not None else taxa
+        self._reposicao_por_segundo = taxa / periodo
+        self._tokens = self.capacidade
+        self._atualizado_em = None
+
+    def _repor(self, agora: float) -> None:
+        if self._atualizado_em is not None:
+            decorrido = agora - self._atualizado_em
+            self._tokens = min(self.capacidade, self._tokens + decorrido * self._reposicao_por_segundo)
+        self._atualizado_em = agora
+
+    def espera(self, agora: float) -> float:
+        """Segundos até existir um token disponível (0 se já existe)."""
+        self._repor(agora)
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self._reposicao_por_segundo
+
+    def consumir(self, agora: float) -> None:
+        self._repor(agora)
+        self._tokens -= 1
+
+    def ocioso(self, agora: float) -> bool:
+        self._repor(agora)
+        return self._tokens >= self.capacidade
+
+
+@dataclass(order=True)
+class _Pedido:
+    prioridade: int
+    sequencia: int
+    chat_id: Any = field(compare=False)
+    liberado: asyncio.Future = field(compare=False)
+
+
+def _segundos(retry_after: int | float | timedelta) -> float:
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class LimitadorEnvios(BaseRateLimiter[dict]):
+    """
+    Fila de saída para a Bot API com limites global e por chat.
+    Respostas interativas passam na frente de envios em segundo plano e
+    erros de flood control (RetryAfter) são repetidos com backoff.
+    """
+
+    def __init__(
+        self,
+        taxa_global: float = 30, periodo_global: float = 1.0,
+        taxa_chat: float = 1, periodo_chat: float = 1.0, rajada_chat: float = 3,
+        taxa_grupo: float = 20, periodo_grupo: float = 60.0,
+        max_tentativas: int = 3,
+    ):
+        self._balde_global = _BaldeTokens(taxa_global, periodo_global)
+        self._taxa_chat = (taxa_chat, periodo_chat, rajada_chat)
+        self._taxa_grupo = (taxa_grupo, periodo_grupo)
+        self._baldes_chat: dict[Any, _BaldeTokens] = {}
+        self._max_tentativas = max_tentativas
+        self._fila: list[_Pedido] = []
+        self._sequencia = itertools.count()
+        self._pausa_ate = 0.0
+        self._novo_pedido: asyncio.Event | None = None
+        self._despachante: asyncio.Task | None = None
+
+    @property
+    def tamanho_fila(self) -> int:
+        return len(self._fila)
+
+    def tamanho_fila_por_prioridade(self, prioridade: int) -> int:
+        return sum(1 for p in self._fila if p.prioridade == prioridade)
+
+    async def initialize(self) -> None:
+        self._novo_pedido = asyncio.Event()
+        self._despachante = asyncio.create_task(self._despachar())
+        registrar_gauge("telegram_fila_envio", lambda: self.tamanho_fila)
+        registrar_gauge("telegram_fila_envio_interativa", lambda: self.tamanho_fila_por_prioridade(PRIORIDADE_INTERATIVA))
+        registrar_gauge("telegram_fila_envio_segundo_plano", lambda: self.tamanho_fila_por_prioridade(PRIORIDADE_SEGUNDO_PLANO))
+
+    async def shutdown(self) -> None:
+        if self._despachante:
+            self._despachante.cancel()
+            try:
+                await self._despachante
+            except asyncio.CancelledError:
+                pass
+            self._despachante = None
+        for pedido in self._fila:
+            if not pedido.liberado.done():
+                pedido.liberado.cancel()
+        self._fila.clear()
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, bool | dict | list | None]],
+        args: Any,
+        kwargs: dict[str, Any],
+        endpoint: str,
+        data: dict[str, Any],
+        rate_limit_args: dict | None,
+    ) -> bool | dict | list | None:
+        if endpoint in _ENDPOINTS_SEM_LIMITE:
+            return await callback(*args, **kwargs)
+
+        prioridade = (rate_limit_args or {}).get("prioridade", PRIORIDADE_INTERATIVA)
+        chat_id = data.get("chat_id")
+        tentativa = 0
+        while True:
+            await self._aguardar_vez(prioridade, chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                tentativa += 1
+                if tentativa > self._max_tentativas:
+                    raise
+                # Backoff: espera o que o Telegram pediu, multiplicado pelo número de tentativas
+                espera = _segundos(exc.retry_after) * tentativa
+                logger.warning(f"Flood control em {endpoint} (chat {chat_id}). Nova tentativa {tentativa}/{self._max_tentativas} em {espera:.1f}s.")
+                self._pausar(espera)
+
+    def _pausar(self, segundos: float) -> None:
+        """Flood control vale para o bot inteiro: segura toda a fila."""
+        loop = asyncio.get_running_loop()
+        self._pausa_ate = max(self._pausa_ate, loop.time() + segundos)
+        self._novo_pedido.set()
+
+    async def _aguardar_vez(self, prioridade: int, chat_id: Any) -> None:
+        pedido = _Pedido(prioridade, next(self._sequencia), chat_id, asyncio.get_running_loop().create_future())
+        self._fila.append(pedido)
+        self._novo_pedido.set()
+        await pedido.liberado
+
+    def _balde_do_chat(self, chat_id: Any) -> _BaldeTokens:
+        balde = self._baldes_chat.get(chat_id)
+        if balde is None:
+            if isinstance(chat_id, int) and chat_id < 0: # Grupos e canais têm IDs negativos
+                balde = _BaldeTokens(*self._taxa_grupo)
+            else:
+                taxa, periodo, rajada = self._taxa_chat
+                balde = _BaldeTokens(taxa, periodo, rajada)
+            self._baldes_chat[chat_id] = balde
+        return balde
+
+    def _escolher(self, agora: float) -> tuple[_Pedido | None, float]:
+        """Pedido de maior prioridade cujo chat tem capacidade; senão, o tempo até algum liberar."""
+        menor_espera = float("inf")
+        for pedido in sorted(self._fila):
+            if pedido.chat_id is None:
+                return pedido, 0.0
+            espera = self._balde_do_chat(pedido.chat_id).espera(agora)
+            if espera <= 0:
+                return pedido, 0.0
+            menor_espera = min(menor_espera, espera)
+        return None, menor_espera
+
+    def _descartar_baldes_ociosos(self, agora: float) -> None:
+        if len(self._baldes_chat) > 1000:
+            em_uso = {p.chat_id for p in self._fila}
+            for chat_id in [c for c, b in self._baldes_chat.items() if c not in em_uso and b.ocioso(agora)]:
+                del self._baldes_chat[chat_id]
+
+    async def _despachar(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            # Pedidos cancelados por quem esperava saem da fila
+            self._fila = [p for p in self._fila if not p.liberado.done()]
+            espera = None
+            if self._fila:
+                agora = loop.time()
+                espera = self._pausa_ate - agora
+                if espera <= 0:
+                    espera = self._balde_global.espera(agora)
+                if espera <= 0:
+                    pedido, espera = self._escolher(agora)
+                    if pedido is not None:
+                        self._balde_global.consumir(agora)
+                        if pedido.chat_id is not None:
+                            self._balde_do_chat(pedido.chat_id).consumir(agora)
+                        self._fila.remove(pedido)
+                        pedido.liberado.set_result(None)
+                        self._descartar_baldes_ociosos(agora)
+                        continue
+
+            # Dorme até liberar capacidade ou chegar um pedido novo (que pode ser de outro chat)
+            self._novo_pedido.clear()
+            try:
+                await asyncio.wait_for(self._novo_pedido.wait(), espera)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,144 @@
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from sqlalchemy.orm import Session
+from telegram.ext import Application, CallbackContext, ConversationHandler, ExtBot
+
+from database import EscopoSessao, OrcamentoConsultasExcedido, escopo_sessao, sessao_atual
+from profiling import criar_perfilador
+
+logger = logging.getLogger(__name__)
+
+# Máximo de consultas SQL por update antes de avisar (ou falhar, no modo estrito)
+QUERY_BUDGET = int(os.getenv("QUERY_BUDGET", "25"))
+# Em testes: com QUERY_BUDGET_STRICT=1 a consulta que passar do orçamento levanta
+# OrcamentoConsultasExcedido dentro do handler, antes do commit, pegando regressões N+1
+QUERY_BUDGET_STRICT = os.getenv("QUERY_BUDGET_STRICT", "0") == "1"
+# user_data/chat_data sem acesso há mais que isso são descartados (TTL)...
+USER_DATA_TTL = float(os.getenv("USER_DATA_TTL_HOURS", "24")) * 3600
+# ...e, acima desse número de entradas, os menos usados recentemente vão primeiro (LRU)
+USER_DATA_MAX_ENTRIES = int(os.getenv("USER_DATA_MAX_ENTRIES", "10000"))
+# Sem persistência a PTB nunca esvazia estes conjuntos de ids pendentes: crescem com
+# cada usuário/chat já visto. São internos da PTB 22.x (versão fixada no requirements.txt);
+# se sumirem numa atualização, descartar_dados_ociosos avisa no log em vez de falhar.
+_PENDENTES_PERSISTENCIA_PTB = (
+    "_user_ids_to_be_updated_in_persistence", "_chat_ids_to_be_updated_in_persistence",
+    "_user_ids_to_be_deleted_in_persistence", "_chat_ids_to_be_deleted_in_persistence",
+)
+
+
+class ContextoPaytrack(CallbackContext[ExtBot, dict, dict, dict]):
+    """CallbackContext com a sessão do update em `context.db`."""
+
+    @property
+    def db(self) -> Session:
+        return sessao_atual()
+
+
+def _descrever_update(update: object) -> str:
+    if getattr(update, "callback_query", None):
+        return f"callback '{update.callback_query.data}'"
+    if getattr(update, "message", None) and update.message.text:
+        texto = update.message.text
+        return f"comando '{texto.split()[0]}'" if texto.startswith("/") else "mensagem de texto"
+    if getattr(update, "inline_query", None):
+        return "inline query"
+    return type(update).__name__
+
+
+class PaytrackApplication(Application):
+    """
+    Abre um escopo de sessão por update: os handlers usam `context.db`, a sessão só é
+    criada se alguém a usar e é sempre fechada no fim, mesmo com erro.
+    Com PAYTRACK_PROFILE definido, updates lentos também têm o perfil gravado.
+    Também registra o último acesso de cada usuário e chat, para que
+    `descartar_dados_ociosos` limite a memória de user_data e chat_data.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._perfilador = criar_perfilador()
+        # id -> último acesso (time.monotonic), do menos para o mais recente
+        self._acessos_usuarios: OrderedDict[int, float] = OrderedDict()
+        self._acessos_chats: OrderedDict[int, float] = OrderedDict()
+        self.dados_descartados = 0
+        self._aviso_pendentes_ptb = False
+
+    def _registrar_acesso(self, update: object) -> None:
+        agora = time.monotonic()
+        usuario = getattr(update, "effective_user", None)
+        chat = getattr(update, "effective_chat", None)
+        for entidade, acessos in ((usuario, self._acessos_usuarios), (chat, self._acessos_chats)):
+            if entidade is not None:
+                acessos[entidade.id] = agora
+                acessos.move_to_end(entidade.id)
+
+    def _em_conversa(self) -> tuple[set[int], set[int]]:
+        """
+        Usuários e chats com uma conversa ativa. Toda ConversationHandler do bot tem
+        conversation_timeout, então cada conversa ativa tem um job em `timeout_jobs`,
+        cuja chave é (chat_id, user_id) conforme per_chat/per_user.
+        """
+        usuarios, chats = set(), set()
+        for grupo in self.handlers.values():
+            for handler in grupo:
+                if not isinstance(handler, ConversationHandler):
+                    continue
+                for chave in handler.timeout_jobs:
+                    if handler.per_chat:
+                        chats.add(chave[0])
+                    if handler.per_user:
+                        usuarios.add(chave[1 if handler.per_chat else 0])
+        return usuarios, chats
+
+    def descartar_dados_ociosos(self, ttl: float = USER_DATA_TTL, maximo: int = USER_DATA_MAX_ENTRIES) -> int:
+        """
+        Descarta user_data/chat_data sem acesso há `ttl` segundos e, se ainda passar
+        de `maximo` entradas, os menos usados recentemente. Quem está no meio de uma
+        conversa nunca é descartado (os handlers leem o user_data da conversa, ex:
+        transaction_type). Retorna quantos descartou.
+        """
+        limite = time.monotonic() - ttl
+        descartados = 0
+        usuarios_em_conversa, chats_em_conversa = self._em_conversa()
+        for acessos, descartar, protegidos in ((self._acessos_usuarios, self.drop_user_data, usuarios_em_conversa),
+                                               (self._acessos_chats, self.drop_chat_data, chats_em_conversa)):
+            excesso = len(acessos) - maximo
+            for identificador, ultimo_acesso in list(acessos.items()): # Do menos para o mais recente
+                if ultimo_acesso >= limite and excesso <= 0:
+                    break
+                if identificador in protegidos:
+                    continue
+                del acessos[identificador]
+                descartar(identificador)
+                descartados += 1
+                excesso -= 1
+        if self.persistence is None:
+            for nome in _PENDENTES_PERSISTENCIA_PTB:
+                pendentes = getattr(self, nome, None)
+                if isinstance(pendentes, set):
+                    pendentes.clear()
+                elif not self._aviso_pendentes_ptb:
+                    self._aviso_pendentes_ptb = True
+                    logger.warning(f"Application.{nome} não existe nesta versão da PTB: ids pendentes de persistência "
+                                   "não são mais limpos. Revise descartar_dados_ociosos.")
+        self.dados_descartados += descartados
+        return descartados
+
+    async def process_update(self, update: object) -> None:
+        self._registrar_acesso(update)
+        if self._perfilador is None:
+            escopo = await self._processar_com_sessao(update)
+        else:
+            async with self._perfilador.medir(update):
+                escopo = await self._processar_com_sessao(update)
+
+        if escopo.consultas > QUERY_BUDGET:
+            logger.warning(f"{_descrever_update(update)} fez {escopo.consultas} consultas (orçamento: {QUERY_BUDGET})")
+
+    async def _processar_com_sessao(self, update: object) -> EscopoSessao:
+        with escopo_sessao(QUERY_BUDGET if QUERY_BUDGET_STRICT else None) as escopo:
+            await super().process_update(update)
+        return escopo